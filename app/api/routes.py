@@ -1,22 +1,84 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Request
+import shutil
+import tempfile
 import traceback
 from app.services.reasignador import reasignar_pdv
 from app.services.excel_reader import leer_maestro_pdv
 from app.models.schemas import ReasignarRequest
-from fastapi.responses import Response
-from app.services.exporter import generar_excel_final
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from app.services.exporter import exportar_plan, iterar_archivo, FORMATOS_EXPORTACION
 from app.models.schemas import OptimizeRequest
-from typing import List, Union 
+from typing import List, Union, Optional
 from pydantic import BaseModel
-from app.services.route_optimizer import optimizar_orden_pdvs
+from app.services.route_optimizer import optimizar_orden_pdvs, SECUENCIADORES
+from app.services.clustering import CLUSTERIZADORES
 from app.services.metrics import evaluar_ruta
 from app.services.territory_planner import planificar_bolsa_grandes
 from app.services.rutas_builder import construir_rutas as planificar_rutas_asignadas
+from app.core.jobs import enviar_job, estado_job, cancelar_job
+from app.core.result_cache import cache_resultados, clave_cache, hash_archivo
+from app.core.telemetria import iniciar_traza, contar, exposicion
+from app.core.respuestas import (
+    responder_plan, validar_formato, a_columnar, desde_json, FORMATO_ANIDADO, FORMATO_COLUMNAR
+)
+from app.config.settings import (
+    SECUENCIADOR_DEFAULT,
+    CLUSTERIZADOR_DEFAULT,
+    TELEMETRIA_ACTIVA,
+    TSP_VECINOS,
+    TSP_TIEMPO_MAX_SEG,
+    ORTOOLS_TIEMPO_MAX_SEG,
+    ORTOOLS_MIN_PDVS,
+    CAPACITADO_MAX_ITER,
+    CAPACITADO_CANDIDATOS,
+    GOLPEO_RUTAS_VECINAS,
+    BUSQUEDA_LOCAL_MAX_RONDAS,
+    BUSQUEDA_LOCAL_TIEMPO_MAX_SEG,
+    BUSQUEDA_LOCAL_VECINOS,
+    BUSQUEDA_LOCAL_PESO_CARGA_KM,
+    H3_PARTICION,
+    H3_RESOLUCION_MIN,
+    H3_RESOLUCION_MAX,
+    COUBICADOS_ACTIVO,
+    COUBICADOS_TOLERANCIA_M,
+)
+from app.services.proveedor_distancias import huella_distancias
+from app.core.plan_store import (
+    crear_plan,
+    obtener_plan,
+    actualizar_plan,
+    PlanNoEncontrado,
+    ConflictoVersion,
+)
+from app.services.reasignador import reasignar_pdv_en_plan, reasignar_masivo_en_plan, mover_pdvs_en_plan
+from app.services.replanificador import replanificar
+from app.services.plan_referencia import referencia_desde_plan
+from app.services.parallel import PlanificacionCancelada, verificar_cancelacion
 
 router = APIRouter()
 
+# Subir al cambiar la lógica de planificación: invalida el cache en disco
+VERSION_RESULTADOS = 5
+
+def validar_secuenciador(secuenciador: Optional[str]):
+    if secuenciador and secuenciador not in SECUENCIADORES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Secuenciador no soportado: {secuenciador}. Use uno de {list(SECUENCIADORES)}"
+        )
+
+def validar_clusterizador(clusterizador: Optional[str]):
+    if clusterizador and clusterizador not in CLUSTERIZADORES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Clusterizador no soportado: {clusterizador}. Use uno de {list(CLUSTERIZADORES)}"
+        )
+
+# def (no async): FastAPI lo corre en su threadpool, así el cálculo y la
+# espera de un cálculo coalescido no bloquean el event loop
 @router.post("/planificar")
-async def planificar(
+def planificar(
+    request: Request,
     file: UploadFile = File(...),
     # Parámetros Comunes
     flex: float = Form(0.2),
@@ -27,37 +89,441 @@ async def planificar(
     sabado: bool = Form(False),
     
     # Parámetros BOLSA (Mucho HC)
-    capacidad: int = Form(50) 
+    capacidad: int = Form(50),
+
+    # Motor TSP por ruta: "LOCAL" u "ORTOOLS" (vacío = default de settings)
+    secuenciador: Optional[str] = Form(None),
+
+    # Motor de agrupación: "H3" o "CAPACITADO" (vacío = default de settings)
+    clusterizador: Optional[str] = Form(None),
+
+    # Tiempos por etapa, conteos y memoria en diagnostico.etapas
+    incluir_etapas: bool = Form(False),
+
+    # "ANIDADO" (un objeto por PDV) o "COLUMNAR" (arrays por ruta + tabla de PDVs)
+    formato: str = Form(FORMATO_ANIDADO),
+
+    # Arranque en caliente desde un plan anterior: guardado (plan_id) o
+    # subido (JSON de una respuesta de /planificar). Ver clusterizar_rutas
+    plan_referencia: Optional[str] = Form(None),
+    archivo_referencia: Optional[UploadFile] = File(None)
 ):
+    validar_secuenciador(secuenciador)
+    validar_clusterizador(clusterizador)
+    validar_formato(formato)
+    referencia, huella_referencia = cargar_referencia(plan_referencia, archivo_referencia)
     try:
-        # 1. Leer y normalizar Excel (funciona para ambos formatos)
-        df = leer_maestro_pdv(file)
-
-        # 2. Decidir qué motor usar
-        if modo == "BOLSA":
-            # Flujo Cuentas Grandes (Territorios)
-            # PASAMOS EL PARAMETRO SABADO A LA FUNCIÓN DE BOLSA
-            return planificar_bolsa_grandes(
-                df=df,
-                capacidad_objetivo=capacidad,
-                flex=flex,
-                sabado_activo=sabado  # <--- CAMBIO AQUÍ
-            )
-        else:
-            # Flujo Cuentas Chicas (Asignado por Vendedor)
-            return planificar_rutas_asignadas(
-                df=df,
-                frecuencia=frecuencia,
-                sabado=sabado,
-                flex=flex
-            )
+        resultado = ejecutar_planificacion(
+            file, flex=flex, modo=modo, frecuencia=frecuencia,
+            sabado=sabado, capacidad=capacidad, secuenciador=secuenciador,
+            clusterizador=clusterizador, incluir_etapas=incluir_etapas,
+            referencia=referencia, huella_referencia=huella_referencia
+        )
+
+        # Guardamos el plan para poder editarlo luego por deltas (/planes/{id}/...)
+        plan = crear_plan(resultado)
+        resultado["plan_id"] = plan["plan_id"]
+        resultado["version"] = plan["version"]
+        # Serializado directo (sin jsonable_encoder) y comprimido si el cliente acepta
+        return responder_plan(resultado, formato, request.headers.get("accept-encoding"))
 
+    except HTTPException:
+        # Errores de validación del maestro (400) se propagan tal cual
+        raise
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
-    
+
+
+def ejecutar_planificacion(file: UploadFile, flex: float, modo: str, frecuencia: str,
+                           sabado: bool, capacidad: int, secuenciador: Optional[str],
+                           clusterizador: Optional[str] = None, incluir_etapas: bool = False,
+                           referencia: Optional[dict] = None, huella_referencia: Optional[dict] = None,
+                           cancelacion=None):
+    parametros = dict(
+        flex=flex, modo=modo, frecuencia=frecuencia, sabado=sabado, capacidad=capacidad,
+        secuenciador=secuenciador, clusterizador=clusterizador
+    )
+
+    def calcular():
+        return _calcular_planificacion(file, referencia=referencia, cancelacion=cancelacion, **parametros)
+
+    with iniciar_traza() as traza:
+        cache = cache_resultados()
+        if cache is None:
+            resultado, origen = calcular(), None
+        else:
+            # Mismo archivo + mismos parámetros efectivos = mismo resultado
+            # (semillas fijas); requests iguales simultáneos calculan una sola vez
+            parametros_cache = _parametros_cache(**parametros)
+            if huella_referencia is not None:
+                # Plan guardado: id + versión; subido: hash del JSON
+                parametros_cache["referencia"] = huella_referencia
+            clave = clave_cache(hash_archivo(file.file), **parametros_cache)
+            while True:
+                try:
+                    resultado, origen = cache.obtener_o_calcular(clave, calcular)
+                    break
+                except PlanificacionCancelada:
+                    # Se cancela este cálculo, o el job cancelado era otro
+                    # (este request esperaba su resultado): se calcula de nuevo
+                    verificar_cancelacion(cancelacion)
+
+        resultado["diagnostico"]["cache"] = origen
+        if huella_referencia is not None:
+            resultado["diagnostico"]["referencia"] = huella_referencia
+        contar("mercaderistas", len(resultado["mercaderistas"]))
+        contar("rutas", sum(len(m["rutas"]) for m in resultado["mercaderistas"]))
+        contar("pdvs", sum(m["total_pdv"] for m in resultado["mercaderistas"]))
+
+    # Fuera del cache: son los tiempos de este request (en un HIT, casi nada)
+    if incluir_etapas and traza is not None:
+        resultado["diagnostico"]["etapas"] = traza.resumen()
+    return resultado
+
+def _parametros_cache(flex: float, modo: str, frecuencia: str, sabado: bool, capacidad: int,
+                      secuenciador: Optional[str], clusterizador: Optional[str]):
+    """
+    Parámetros que realmente cambian el resultado, normalizados: los que no
+    aplican al modo no entran en la clave y los vacíos toman su default.
+    """
+    bolsa = modo == "BOLSA"
+    frecuencia = frecuencia.upper()
+    if frecuencia not in ("SEMANAL", "QUINCENAL"):
+        frecuencia = "MENSUAL"
+    return {
+        "version": VERSION_RESULTADOS,
+        "modo": "BOLSA" if bolsa else "ASIGNADO",
+        "flex": float(flex),
+        "sabado": bool(sabado),
+        "capacidad": int(capacidad) if bolsa else None,
+        "frecuencia": None if bolsa else frecuencia,
+        "secuenciador": secuenciador or SECUENCIADOR_DEFAULT,
+        "clusterizador": clusterizador or CLUSTERIZADOR_DEFAULT,
+        "configuracion": _huella_configuracion(),
+    }
+
+
+def _huella_configuracion():
+    """
+    Settings que cambian el resultado sin pasar por el formulario. El cache
+    en disco sobrevive reinicios: cambiar cualquiera de estos (o el
+    proveedor de distancias activo, ver huella_distancias) no debe servir
+    planes calculados con la configuración anterior.
+    """
+    return {
+        "tsp": [TSP_VECINOS, TSP_TIEMPO_MAX_SEG, ORTOOLS_TIEMPO_MAX_SEG, ORTOOLS_MIN_PDVS],
+        "capacitado": [CAPACITADO_MAX_ITER, CAPACITADO_CANDIDATOS],
+        "golpeo": GOLPEO_RUTAS_VECINAS,
+        "busqueda_local": [
+            BUSQUEDA_LOCAL_MAX_RONDAS, BUSQUEDA_LOCAL_TIEMPO_MAX_SEG,
+            BUSQUEDA_LOCAL_VECINOS, BUSQUEDA_LOCAL_PESO_CARGA_KM,
+        ],
+        "h3": [H3_PARTICION, H3_RESOLUCION_MIN, H3_RESOLUCION_MAX],
+        "coubicados": [COUBICADOS_ACTIVO, COUBICADOS_TOLERANCIA_M],
+        "distancias": huella_distancias(),
+    }
+
+
+def _calcular_planificacion(file: UploadFile, flex: float, modo: str, frecuencia: str,
+                            sabado: bool, capacidad: int, secuenciador: Optional[str],
+                            clusterizador: Optional[str], referencia: Optional[dict] = None,
+                            cancelacion=None):
+    # 1. Leer y normalizar el maestro (.xlsx, .csv, .csv.gz o .parquet)
+    df = leer_maestro_pdv(file)
+    contar("filas_maestro", len(df))
+    verificar_cancelacion(cancelacion)
+
+    # 2. Decidir qué motor usar
+    if modo == "BOLSA":
+        # Flujo Cuentas Grandes (Territorios)
+        # PASAMOS EL PARAMETRO SABADO A LA FUNCIÓN DE BOLSA
+        resultado = planificar_bolsa_grandes(
+            df=df,
+            capacidad_objetivo=capacidad,
+            flex=flex,
+            sabado_activo=sabado,  # <--- CAMBIO AQUÍ
+            secuenciador=secuenciador,
+            clusterizador=clusterizador,
+            referencia=referencia,
+            cancelacion=cancelacion
+        )
+    else:
+        # Flujo Cuentas Chicas (Asignado por Vendedor)
+        resultado = planificar_rutas_asignadas(
+            df=df,
+            frecuencia=frecuencia,
+            sabado=sabado,
+            flex=flex,
+            secuenciador=secuenciador,
+            clusterizador=clusterizador,
+            referencia=referencia,
+            cancelacion=cancelacion
+        )
+
+    # Tiempo y memoria de la lectura del maestro (formato, filas, MB)
+    resultado["diagnostico"] = {"lectura": df.attrs.get("diagnostico_lectura")}
+    return resultado
+
+
+def cargar_referencia(plan_referencia: Optional[str], archivo_referencia: Optional[UploadFile]):
+    """
+    Plan anterior para el arranque en caliente. Retorna (referencia por
+    mercaderista, huella para el cache y el diagnóstico) o (None, None).
+    """
+    if plan_referencia and archivo_referencia is not None:
+        raise HTTPException(status_code=400, detail="Use plan_referencia o archivo_referencia, no ambos")
+    try:
+        if plan_referencia:
+            plan = obtener_plan(plan_referencia)
+            if plan["data"] is None:
+                raise HTTPException(status_code=409, detail="El plan de referencia aún no tiene resultado")
+            huella = {"plan_id": plan_referencia, "version": plan["version"]}
+            return referencia_desde_plan(plan["data"]), huella
+        if archivo_referencia is not None:
+            huella = {"archivo": archivo_referencia.filename, "sha256": hash_archivo(archivo_referencia.file)}
+            return referencia_desde_plan(desde_json(archivo_referencia.file.read())), huella
+    except PlanNoEncontrado as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Plan de referencia inválido: {e}")
+    return None, None
+
+
+@router.get("/cache/estadisticas")
+def estadisticas_cache():
+    # Hits (memoria / disco), requests coalescidos, misses, desalojos y bytes
+    cache = cache_resultados()
+    return cache.estadisticas() if cache is not None else {"activo": False}
+
+
+@router.get("/metrics")
+def metricas_prometheus():
+    """
+    Histogramas de latencia (por etapa y por endpoint) y contadores en
+    formato de texto de Prometheus.
+    """
+    if not TELEMETRIA_ACTIVA:
+        raise HTTPException(status_code=404, detail="Telemetría desactivada (TELEMETRIA_ACTIVA)")
+
+    extra = []
+    cache = cache_resultados()
+    if cache is not None:
+        estadisticas = cache.estadisticas()
+        extra += ["# HELP ruteo_cache_total Consultas al cache de resultados por origen.",
+                  "# TYPE ruteo_cache_total counter"]
+        extra += [f'ruteo_cache_total{{origen="{origen}"}} {estadisticas[origen]}'
+                  for origen in ("hits", "hits_disco", "coalescidos", "misses")]
+        extra += ["# HELP ruteo_cache_bytes Bytes del cache de resultados en memoria.",
+                  "# TYPE ruteo_cache_bytes gauge",
+                  f"ruteo_cache_bytes {estadisticas['bytes']}"]
+    return PlainTextResponse(exposicion(extra), media_type="text/plain; version=0.0.4")
+
+
+# =========================
+# JOBS ASÍNCRONOS (submit + polling)
+# =========================
+@router.post("/planes", status_code=202)
+def enviar_planificacion(
+    file: UploadFile = File(...),
+    flex: float = Form(0.2),
+    modo: str = Form("ASIGNADO"),
+    frecuencia: str = Form("SEMANAL"),
+    sabado: bool = Form(False),
+    capacidad: int = Form(50),
+    secuenciador: Optional[str] = Form(None),
+    clusterizador: Optional[str] = Form(None),
+    incluir_etapas: bool = Form(False),
+    plan_referencia: Optional[str] = Form(None),
+    archivo_referencia: Optional[UploadFile] = File(None)
+):
+    """
+    Igual que /planificar pero responde de inmediato con un plan_id;
+    el resultado se consulta en GET /planes/{plan_id}.
+    """
+    validar_secuenciador(secuenciador)
+    validar_clusterizador(clusterizador)
+    # La referencia se resuelve ahora: fija la versión del plan usado
+    referencia, huella_referencia = cargar_referencia(plan_referencia, archivo_referencia)
+
+    # El UploadFile se cierra al terminar el request: copiamos el contenido
+    # a un temporal (en memoria hasta 10 MB, luego a disco) para el job
+    copia = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
+    shutil.copyfileobj(file.file, copia)
+    copia.seek(0)
+    archivo = UploadFile(file=copia, filename=file.filename)
+
+    plan = enviar_job(
+        _planificar_y_cerrar, archivo, flex=flex, modo=modo, frecuencia=frecuencia,
+        sabado=sabado, capacidad=capacidad, secuenciador=secuenciador,
+        clusterizador=clusterizador, incluir_etapas=incluir_etapas,
+        referencia=referencia, huella_referencia=huella_referencia
+    )
+    return {"plan_id": plan["plan_id"], "estado": plan["estado"]}
+
+
+def _planificar_y_cerrar(archivo: UploadFile, **parametros):
+    try:
+        return ejecutar_planificacion(archivo, **parametros)
+    finally:
+        archivo.file.close()
+
+
+@router.get("/planes/{plan_id}")
+def consultar_planificacion(plan_id: str, request: Request, formato: str = FORMATO_ANIDADO):
+    validar_formato(formato)
+    try:
+        estado = estado_job(plan_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    if estado["resultado"] is not None and formato == FORMATO_COLUMNAR:
+        estado["resultado"] = a_columnar(estado["resultado"])
+    return responder_plan(estado, accept_encoding=request.headers.get("accept-encoding"))
+
+
+@router.delete("/planes/{plan_id}")
+def cancelar_planificacion(plan_id: str):
+    try:
+        return {"plan_id": plan_id, "estado": cancelar_job(plan_id)}
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+# =========================
+# EDICIÓN POR DELTAS SOBRE PLANES GUARDADOS
+# =========================
+# El cliente manda plan_id + version + el movimiento; el servidor aplica el
+# cambio sobre su copia, la guarda con concurrencia optimista y responde
+# solo con las rutas modificadas.
+class MoverPdvPlanRequest(BaseModel):
+    version: int
+    mercaderista: str
+    cod_live_tra: Union[int, str]
+    from_ruta: int
+    to_ruta: int
+    secuenciador: Optional[str] = None
+
+class MoverMasivoPlanRequest(BaseModel):
+    version: int
+    mercaderista: str
+    codigos_pdv: List[Union[str, int]]
+    to_ruta: int # -1 = crear ruta nueva
+    secuenciador: Optional[str] = None
+
+class MovimientoPdv(BaseModel):
+    cod_live_tra: Union[int, str]
+    to_ruta: int # negativo = ruta nueva (mismo valor, misma ruta nueva)
+    from_ruta: Optional[int] = None # solo si el PDV está en varias rutas (BOLSA)
+
+class MoverLotePlanRequest(BaseModel):
+    version: int
+    mercaderista: str
+    movimientos: List[MovimientoPdv]
+    secuenciador: Optional[str] = None
+
+def _aplicar_edicion(plan_id: str, version: int, mercaderista: str, editar):
+    nueva_version, rutas_cambiadas = _guardar_edicion(plan_id, version, editar)
+    return {
+        "plan_id": plan_id,
+        "version": nueva_version,
+        "mercaderista": mercaderista,
+        "rutas": rutas_cambiadas
+    }
+
+def _guardar_edicion(plan_id: str, version: int, editar):
+    """
+    Aplica 'editar(data)' sobre el plan guardado y lo escribe con
+    concurrencia optimista. Retorna (nueva versión, lo que retorne editar).
+    """
+    try:
+        plan = obtener_plan(plan_id)
+        if plan["version"] != version:
+            raise ConflictoVersion(
+                f"Versión {version} desactualizada; la vigente es {plan['version']}"
+            )
+        data = plan["data"]
+        if data is None:
+            raise ValueError("El plan aún no tiene resultado")
+        cambios = editar(data)
+        nueva_version = actualizar_plan(plan_id, data, version=version)
+    except PlanNoEncontrado as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ConflictoVersion as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return nueva_version, cambios
+
+@router.post("/planes/{plan_id}/reasignar-pdv")
+def mover_pdv_en_plan(plan_id: str, payload: MoverPdvPlanRequest):
+    validar_secuenciador(payload.secuenciador)
+    return _aplicar_edicion(
+        plan_id, payload.version, payload.mercaderista,
+        lambda data: reasignar_pdv_en_plan(
+            data, payload.mercaderista, payload.cod_live_tra,
+            payload.from_ruta, payload.to_ruta, payload.secuenciador
+        )
+    )
+
+@router.post("/planes/{plan_id}/reasignar-masivo")
+def mover_masivo_en_plan(plan_id: str, payload: MoverMasivoPlanRequest):
+    validar_secuenciador(payload.secuenciador)
+    return _aplicar_edicion(
+        plan_id, payload.version, payload.mercaderista,
+        lambda data: reasignar_masivo_en_plan(
+            data, payload.mercaderista, payload.codigos_pdv,
+            payload.to_ruta, payload.secuenciador
+        )
+    )
+
+@router.post("/planes/{plan_id}/mover")
+def mover_lote_en_plan(plan_id: str, payload: MoverLotePlanRequest):
+    """
+    Muchos PDVs hacia muchas rutas en un solo request (selección múltiple
+    del supervisor); responde solo con las rutas tocadas.
+    """
+    validar_secuenciador(payload.secuenciador)
+    return _aplicar_edicion(
+        plan_id, payload.version, payload.mercaderista,
+        lambda data: mover_pdvs_en_plan(
+            data, payload.mercaderista,
+            [m.model_dump() for m in payload.movimientos], payload.secuenciador
+        )
+    )
+
+@router.post("/planes/{plan_id}/replanificar")
+def replanificar_plan(
+    plan_id: str,
+    file: UploadFile = File(...),
+    version: int = Form(...),
+    secuenciador: Optional[str] = Form(None),
+    # BOLSA: capacidad para mercaderistas nuevos (vacío = la del plan)
+    capacidad: Optional[int] = Form(None)
+):
+    """
+    Maestro actualizado sobre un plan guardado: altas, bajas y cambios de
+    coordenadas se aplican a las rutas existentes; solo se re-agrupan las
+    rutas que quedan fuera de rango. Responde solo con lo que cambió.
+    """
+    validar_secuenciador(secuenciador)
+    df = leer_maestro_pdv(file)
+    nueva_version, cambios = _guardar_edicion(
+        plan_id, version,
+        lambda data: replanificar(data, df, secuenciador=secuenciador, capacidad=capacidad)
+    )
+    return {
+        "plan_id": plan_id,
+        "version": nueva_version,
+        "mercaderistas": cambios
+    }
+
 @router.post("/rutas/reasignar-pdv")
 def mover_pdv(payload: ReasignarRequest):
+    validar_secuenciador(payload.secuenciador)
     try:
         # 1. Convertir lo que llega de Swagger a un diccionario Python
         datos = payload.model_dump() 
@@ -68,19 +534,28 @@ def mover_pdv(payload: ReasignarRequest):
         raise HTTPException(status_code=400, detail=str(e))
     
 @router.post("/exportar")
-def exportar_excel(payload: dict):
+def exportar_excel(payload: dict, formato: str = "xlsx", por_mercaderista: bool = False):
     # Recibimos el JSON completo (dataPlanificada del frontend)
-    try:
-        excel_file = generar_excel_final(payload)
-        
-        return Response(
-            content=excel_file.getvalue(),
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={"Content-Disposition": "attachment; filename=planificacion_final.xlsx"}
+    # ?formato=xlsx|csv|parquet  ?por_mercaderista=true -> .zip con un archivo por mercaderista
+    if formato not in FORMATOS_EXPORTACION:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Formato no soportado: {formato}. Use uno de {list(FORMATOS_EXPORTACION)}"
         )
+    try:
+        archivo, media_type, nombre = exportar_plan(payload, formato, por_mercaderista)
+    except HTTPException:
+        raise
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
+
+    # Se envía por bloques desde el temporal en disco (sin copia en memoria)
+    return StreamingResponse(
+        iterar_archivo(archivo),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={nombre}"}
+    )
     
 
 # Definimos el esquema para la petición masiva
@@ -91,9 +566,11 @@ class ReasignarMasivoRequest(BaseModel):
     to_ruta: int               
     rutas: List[dict]            
     rango: dict
+    secuenciador: Optional[str] = None
 
 @router.post("/rutas/reasignar-masivo")
 def reasignar_pdv_masivo(payload: ReasignarMasivoRequest):
+    validar_secuenciador(payload.secuenciador)
     try:
         ruta_destino = None
 
@@ -126,8 +603,10 @@ def reasignar_pdv_masivo(payload: ReasignarMasivoRequest):
                 raise HTTPException(status_code=404, detail="Ruta destino no encontrada")
 
         pdvs_a_mover = []
+        # Comparamos como str (el cliente puede mandar int o str) contra un set
+        codigos = {str(c) for c in payload.codigos_pdv}
 
-        # 3. Buscar y remover los PDVs de sus rutas originales
+        # 3. Buscar y remover los PDVs de sus rutas originales (una pasada)
         for ruta in payload.rutas:
             # Si es la misma ruta destino (recién creada), saltar
             if ruta["ruta_id"] == ruta_destino["ruta_id"]:
@@ -135,36 +614,25 @@ def reasignar_pdv_masivo(payload: ReasignarMasivoRequest):
 
             nuevos_pdvs = []
             for pdv in ruta["pdvs"]:
-                # Comparamos IDs (str/int safe)
-                if pdv["cod_live_tra"] in payload.codigos_pdv:
+                if str(pdv["cod_live_tra"]) in codigos:
                     pdvs_a_mover.append(pdv)
                 else:
                     nuevos_pdvs.append(pdv)
-            
+
             # Actualizamos la ruta origen
-            ruta["pdvs"] = nuevos_pdvs
-            ruta["total_pdv"] = len(ruta["pdvs"])
+            if len(nuevos_pdvs) != len(ruta["pdvs"]):
+                ruta["pdvs"] = nuevos_pdvs
+                ruta["total_pdv"] = len(ruta["pdvs"])
 
-        # Fallback de búsqueda (por si los tipos de dato difieren)
         if not pdvs_a_mover:
-            codigos_str = [str(c) for c in payload.codigos_pdv]
-            for ruta in payload.rutas:
-                if ruta["ruta_id"] == ruta_destino["ruta_id"]: continue
-                for pdv in list(ruta["pdvs"]): # Usamos list() para iterar copia segura
-                     if str(pdv["cod_live_tra"]) in codigos_str:
-                         pdvs_a_mover.append(pdv)
-                         ruta["pdvs"].remove(pdv)
-                         ruta["total_pdv"] = len(ruta["pdvs"])
-            
-            if not pdvs_a_mover:
-                raise HTTPException(status_code=400, detail="No se encontraron los PDVs enviados")
+            raise HTTPException(status_code=400, detail="No se encontraron los PDVs enviados")
 
         # 4. Agregarlos a la ruta destino
         ruta_destino["pdvs"].extend(pdvs_a_mover)
         
         # 5. Re-optimizar orden y métricas
         if ruta_destino["pdvs"]:
-            ruta_destino["pdvs"] = optimizar_orden_pdvs(ruta_destino["pdvs"])
+            ruta_destino["pdvs"] = optimizar_orden_pdvs(ruta_destino["pdvs"], secuenciador=payload.secuenciador)
             metricas = evaluar_ruta(ruta_destino, payload.rango)
             ruta_destino.update(metricas)
         
@@ -1 +1,153 @@
 USE_GOOGLE_OPTIMIZER = False
+
+# =========================
+# SECUENCIACIÓN (TSP) DE CADA RUTA
+# =========================
+# Vecinos más cercanos (KD-tree) que se evalúan en cada movimiento 2-opt / Or-opt
+TSP_VECINOS = 8
+# Presupuesto de tiempo de mejora local por ruta (segundos)
+TSP_TIEMPO_MAX_SEG = 0.5
+
+# Secuenciador por defecto: "LOCAL" (KD-tree + 2-opt/Or-opt) u "ORTOOLS".
+# Se puede elegir por request; USE_GOOGLE_OPTIMIZER solo cambia el default.
+SECUENCIADOR_DEFAULT = "ORTOOLS" if USE_GOOGLE_OPTIMIZER else "LOCAL"
+# Límite de tiempo (wall-clock) de Guided Local Search por ruta (segundos)
+ORTOOLS_TIEMPO_MAX_SEG = 1.0
+# Rutas más chicas que esto se secuencian con el motor LOCAL aunque se pida
+# ORTOOLS: ahí la búsqueda local ya llega al óptimo y GLS solo gastaría tiempo
+ORTOOLS_MIN_PDVS = 30
+
+# =========================
+# CLUSTERING DE RUTAS
+# =========================
+# "H3" (grupos por jerarquía H3 + fusión / balanceo / búsqueda local) o
+# "CAPACITADO" (k-means balanceado con flujo de costo mínimo).
+# Se puede elegir por request.
+CLUSTERIZADOR_DEFAULT = "H3"
+# K-means balanceado: iteraciones máximas asignación <-> centroides
+CAPACITADO_MAX_ITER = 5
+# Rutas candidatas (centroides más cercanos) por cliente en el flujo
+CAPACITADO_CANDIDATOS = 4
+
+# =========================
+# REPARTO DE VISITAS CON GOLPEO (BOLSA)
+# =========================
+# Rutas más cercanas (KD-tree de centroides) que se revisan por visita
+# repetida antes de abrir la búsqueda a todas
+GOLPEO_RUTAS_VECINAS = 8
+
+# =========================
+# PLANIFICACIÓN EN PARALELO (por mercaderista / departamento)
+# =========================
+# Procesos del pool; 1 = ejecución en serie (sin pool). El pool se crea al
+# primer uso y se reutiliza entre requests
+PLAN_WORKERS = 1
+# Cómo nacen los workers: "forkserver" (o "spawn"). Nunca "fork": el
+# servidor tiene hilos y el hijo heredaría sus locks tomados
+PLAN_METODO_INICIO = "forkserver"
+# Grupos que se envían juntos a cada proceso (reduce overhead de IPC en
+# masters con muchos vendedores chicos)
+PLAN_CHUNK_SIZE = 1
+
+# =========================
+# JOBS ASÍNCRONOS DE PLANIFICACIÓN
+# =========================
+# Máximo de planificaciones corriendo a la vez; el resto espera EN_COLA
+PLAN_JOBS_MAX_CONCURRENTES = 2
+
+# =========================
+# PERSISTENCIA DE PLANES
+# =========================
+# "sqlite" (durable, default) o "memoria" (tests / desarrollo)
+PLAN_STORE_BACKEND = "sqlite"
+PLAN_STORE_SQLITE_PATH = "planes.db"
+# Los planes que nadie editó (por deltas / replanificar) se borran pasadas
+# estas horas desde su creación; None = no expiran. Los editados se conservan
+PLAN_STORE_TTL_HORAS = 24
+# La poda corre al guardar un plan nuevo, como mucho una vez por intervalo
+PLAN_STORE_PODA_MIN = 10
+
+# =========================
+# CACHE DE RESULTADOS DE /planificar
+# =========================
+# Clave: hash del archivo + parámetros normalizados. LRU en memoria por
+# proceso (0 = sin memoria) y tier en disco opcional (None = desactivado),
+# compartido entre procesos / reinicios
+RESULT_CACHE_MAX_MB = 256
+RESULT_CACHE_DIR = None
+RESULT_CACHE_DISCO_MAX_MB = 2048
+
+# =========================
+# BÚSQUEDA LOCAL ENTRE RUTAS (relocate / swap tras el balanceo)
+# =========================
+# Rondas máximas; 0 desactiva la etapa
+BUSQUEDA_LOCAL_MAX_RONDAS = 30
+# Presupuesto de tiempo por mercaderista / departamento
+BUSQUEDA_LOCAL_TIEMPO_MAX_SEG = 0.05
+# Rutas vecinas (por centroide) con las que cada ruta intercambia PDVs
+BUSQUEDA_LOCAL_VECINOS = 8
+# Km equivalentes por (PDVs de desvío respecto al promedio)². Cada
+# movimiento se valida con km de recorrido (costo de inserción) + este
+# desvío: es lo máximo que la etapa cambia km por balance. 0 = solo km
+BUSQUEDA_LOCAL_PESO_CARGA_KM = 0.05
+
+# =========================
+# TELEMETRÍA (tiempos por etapa + /metrics)
+# =========================
+# Apagada: los decoradores devuelven la función original y /metrics
+# responde 404 (sin costo en el camino caliente)
+TELEMETRIA_ACTIVA = True
+# Límites (segundos) de los histogramas de latencia
+TELEMETRIA_BUCKETS_SEG = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Cada cuánto se muestrea el RSS durante un request para su pico de memoria
+TELEMETRIA_MEMORIA_INTERVALO_SEG = 0.01
+
+# =========================
+# PROVEEDOR DE DISTANCIAS (secuenciación y métricas)
+# =========================
+# "HAVERSINE" (línea recta) o "MATRIZ": matriz de viaje por calles
+# precalculada offline, en .npy (N, N) abierto con memory-map (compartido
+# entre procesos vía page cache). Los COD_LIVE_TRA que no estén en la
+# matriz usan haversine.
+DISTANCIAS_PROVEEDOR = "HAVERSINE"
+DISTANCIAS_MATRIZ_PATH = None
+# COD_LIVE_TRA de cada fila de la matriz (.npy); None = <matriz>.ids.npy
+DISTANCIAS_MATRIZ_IDS_PATH = None
+# Unidad de la matriz: "km", "m", "min" o "seg". Los tiempos se pasan a km
+# equivalentes a esta velocidad (la misma de metrics.tiempo_estimado)
+DISTANCIAS_MATRIZ_UNIDAD = "min"
+DISTANCIAS_MATRIZ_VELOCIDAD_KMH = 20
+
+# =========================
+# RESPUESTAS (serialización y compresión de planes)
+# =========================
+# Cuerpos menores a esto van sin comprimir (no compensa el costo)
+RESPUESTAS_COMPRIMIR_MIN_BYTES = 1024
+# gzip 5-6: casi la tasa de 9 a una fracción del costo
+RESPUESTAS_GZIP_NIVEL = 5
+# Brotli (solo si el módulo 'brotli' está instalado y el cliente manda br)
+RESPUESTAS_BROTLI_CALIDAD = 4
+
+# =========================
+# PARTICIÓN H3 (primera etapa del clusterizador "H3")
+# =========================
+# "ADAPTATIVA": recorre la jerarquía H3 (padres / hijas) hasta que cada
+# grupo quede cerca de rango["promedio"]; "FIJA": una ruta por celda de
+# resolución 9 y KMeans en las que superan el rango (comportamiento anterior)
+H3_PARTICION = "ADAPTATIVA"
+# Resolución más gruesa (un grupo por celda si entra en el rango; 6 ~ 36 km²)
+H3_RESOLUCION_MIN = 6
+# Resolución más fina antes de recurrir a KMeans (11 ~ 2 000 m²)
+H3_RESOLUCION_MAX = 11
+
+# =========================
+# PDVs CO-UBICADOS (mercados, galerías, centros comerciales)
+# =========================
+# PDVs en el mismo punto se marcan como un nodo al leer el maestro. El
+# clustering, la fusión y el balanceo trabajan sobre nodos (la capacidad se
+# cuenta por miembros/visitas, un nodo más grande que una ruta se corta) y
+# cada nodo se expande a sus PDVs, con sub-orden, recién al emitir la ruta
+COUBICADOS_ACTIVO = True
+# Distancia al primer PDV del grupo para considerarlos en el mismo punto
+# (0 = solo coordenadas idénticas)
+COUBICADOS_TOLERANCIA_M = 10
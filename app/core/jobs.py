@@ -0,0 +1,133 @@
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from app.config.settings import PLAN_JOBS_MAX_CONCURRENTES
+from app.services.parallel import PlanificacionCancelada
+from app.core.plan_store import (
+    ESTADO_GENERADO,
+    crear_plan,
+    obtener_plan,
+    actualizar_estado,
+    completar_plan,
+)
+
+# Ciclo de vida de un job:
+# EN_COLA -> EJECUTANDO -> TERMINADO | FALLIDO
+# EN_COLA / EJECUTANDO -> CANCELADO
+ESTADO_EN_COLA = "EN_COLA"
+ESTADO_EJECUTANDO = "EJECUTANDO"
+ESTADO_TERMINADO = "TERMINADO"
+ESTADO_FALLIDO = "FALLIDO"
+ESTADO_CANCELADO = "CANCELADO"
+ESTADOS_FINALES = (ESTADO_TERMINADO, ESTADO_FALLIDO, ESTADO_CANCELADO)
+
+_executor = None
+_executor_lock = threading.Lock()
+_futures = {}
+# plan_id -> threading.Event que el planificador revisa entre grupos
+_cancelaciones = {}
+
+
+def _pool():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=PLAN_JOBS_MAX_CONCURRENTES,
+                thread_name_prefix="plan-job"
+            )
+        return _executor
+
+
+def enviar_job(funcion, *args, **kwargs):
+    """
+    Registra un plan EN_COLA y lo encola en el pool de fondo.
+    'funcion' recibe además cancelacion=threading.Event: se activa con
+    cancelar_job y debe revisarse entre grupos (ver mapear_grupos).
+    Retorna el plan (con su plan_id) sin esperar a que termine.
+    """
+    plan = crear_plan(None, estado=ESTADO_EN_COLA)
+    plan_id = plan["plan_id"]
+    _cancelaciones[plan_id] = threading.Event()
+    _futures[plan_id] = _pool().submit(_ejecutar, plan_id, funcion, args, kwargs)
+    return plan
+
+
+def _ejecutar(plan_id, funcion, args, kwargs):
+    cancelacion = _cancelaciones.get(plan_id) or threading.Event()
+    try:
+        # EN_COLA -> EJECUTANDO solo si nadie lo canceló mientras esperaba
+        if not actualizar_estado(plan_id, ESTADO_EJECUTANDO, si_estado=ESTADO_EN_COLA,
+                                 iniciado_en=time.time()):
+            return
+        try:
+            data = funcion(*args, cancelacion=cancelacion, **kwargs)
+        except PlanificacionCancelada:
+            # El estado ya es CANCELADO (lo escribió cancelar_job)
+            return
+        except Exception as e:
+            traceback.print_exc()
+            actualizar_estado(
+                plan_id, ESTADO_FALLIDO, si_estado=ESTADO_EJECUTANDO,
+                error=str(getattr(e, "detail", e)),
+                terminado_en=time.time()
+            )
+            return
+
+        # Resultado y EJECUTANDO -> TERMINADO en una sola escritura
+        # condicional: si lo cancelaron mientras corría, se descarta
+        completar_plan(plan_id, data, ESTADO_TERMINADO, si_estado=ESTADO_EJECUTANDO, terminado_en=time.time())
+    finally:
+        _futures.pop(plan_id, None)
+        _cancelaciones.pop(plan_id, None)
+
+
+def cancelar_job(plan_id: str):
+    """
+    Cancela un job. Si aún está EN_COLA no llega a ejecutarse; si ya está
+    EJECUTANDO, el planificador corta en el próximo grupo (mercaderista /
+    departamento) y libera su lugar en el pool; el resultado se descarta.
+    Retorna el estado resultante (los jobs ya finalizados no cambian).
+    """
+    while True:
+        estado = obtener_plan(plan_id, con_data=False)["estado"]
+        if estado in ESTADOS_FINALES:
+            return estado
+        # Transición condicional: si el job terminó justo ahora, se respeta
+        if actualizar_estado(plan_id, ESTADO_CANCELADO, si_estado=estado, terminado_en=time.time()):
+            break
+
+    cancelacion = _cancelaciones.get(plan_id)
+    if cancelacion is not None:
+        cancelacion.set()
+    future = _futures.get(plan_id)
+    if future is not None and future.cancel():
+        # No llegó a empezar: _ejecutar no corre y no limpia sus registros
+        _futures.pop(plan_id, None)
+        _cancelaciones.pop(plan_id, None)
+    return ESTADO_CANCELADO
+
+
+def estado_job(plan_id: str):
+    """
+    Vista de polling: estado, versión, tiempo transcurrido y resultado si
+    el plan ya está disponible (job terminado o plan generado en línea).
+    """
+    plan = obtener_plan(plan_id, con_data=False)
+    con_resultado = plan["estado"] in (ESTADO_TERMINADO, ESTADO_GENERADO)
+    if con_resultado:
+        plan = obtener_plan(plan_id)
+
+    inicio = plan.get("iniciado_en") or plan["creado_en"]
+    fin = plan.get("terminado_en") or time.time()
+
+    return {
+        "plan_id": plan_id,
+        "estado": plan["estado"],
+        "version": plan["version"],
+        "tiempo_transcurrido_seg": round(fin - inicio, 2),
+        "error": plan.get("error"),
+        "resultado": plan["data"] if con_resultado else None
+    }
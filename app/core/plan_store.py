@@ -1,24 +1,362 @@
+import json
+import sqlite3
+import threading
+import time
 import uuid
+from copy import deepcopy
 
-# En prod esto sería Redis o DB
-PLANES = {}
+import numpy as np
 
-def crear_plan(data: dict):
-    plan_id = str(uuid.uuid4())
-    PLANES[plan_id] = {
-        "plan_id": plan_id,
-        "estado": "GENERADO",
-        "data": data
+from app.config.settings import (
+    PLAN_STORE_BACKEND,
+    PLAN_STORE_SQLITE_PATH,
+    PLAN_STORE_TTL_HORAS,
+    PLAN_STORE_PODA_MIN,
+)
+
+ESTADO_GENERADO = "GENERADO"
+# Jobs en curso (ver app.core.jobs): nunca se podan
+ESTADOS_EN_CURSO = ("EN_COLA", "EJECUTANDO")
+
+
+class PlanNoEncontrado(ValueError):
+    pass
+
+
+class ConflictoVersion(ValueError):
+    """
+    La versión enviada por el cliente no es la vigente: alguien más editó
+    el plan entre su lectura y su escritura (concurrencia optimista).
+    """
+    pass
+
+
+def _a_json(valor):
+    # Los planes traen tipos NumPy (cod_live_tra, lat/lon) que json no conoce
+    if isinstance(valor, np.generic):
+        return valor.item()
+    raise TypeError(f"Tipo no serializable: {type(valor).__name__}")
+
+
+# =========================
+# BACKEND EN MEMORIA (tests / desarrollo)
+# =========================
+class MemoriaPlanStore:
+    def __init__(self):
+        self.planes = {}
+        self.lock = threading.Lock()
+
+    def guardar_nuevo(self, registro: dict):
+        with self.lock:
+            self.planes[registro["plan_id"]] = deepcopy(registro)
+
+    def leer(self, plan_id: str, con_data: bool = True):
+        with self.lock:
+            if plan_id not in self.planes:
+                raise PlanNoEncontrado("Plan no encontrado")
+            registro = self.planes[plan_id]
+            if not con_data:
+                return {k: v for k, v in registro.items() if k != "data"}
+            # Copia: el llamador puede editar sin tocar la versión guardada
+            return deepcopy(registro)
+
+    def escribir_data(self, plan_id: str, data: dict, version: int = None):
+        with self.lock:
+            if plan_id not in self.planes:
+                raise PlanNoEncontrado("Plan no encontrado")
+            registro = self.planes[plan_id]
+            if version is not None and registro["version"] != version:
+                raise ConflictoVersion(
+                    f"Versión {version} desactualizada; la vigente es {registro['version']}"
+                )
+            registro["data"] = deepcopy(data)
+            registro["version"] += 1
+            if version is not None:
+                registro["editado_en"] = time.time()
+            return registro["version"]
+
+    def escribir_campos(self, plan_id: str, campos: dict, si_estado: str = None):
+        with self.lock:
+            if plan_id not in self.planes:
+                raise PlanNoEncontrado("Plan no encontrado")
+            if si_estado is not None and self.planes[plan_id]["estado"] != si_estado:
+                return False
+            self.planes[plan_id].update(campos)
+            return True
+
+    def escribir_resultado(self, plan_id: str, data: dict, campos: dict, si_estado: str):
+        with self.lock:
+            if plan_id not in self.planes:
+                raise PlanNoEncontrado("Plan no encontrado")
+            registro = self.planes[plan_id]
+            if registro["estado"] != si_estado:
+                return False
+            registro["data"] = deepcopy(data)
+            registro["version"] += 1
+            registro.update(campos)
+            return True
+
+    def podar(self, antes_de: float):
+        with self.lock:
+            vencidos = [
+                plan_id for plan_id, r in self.planes.items()
+                if r.get("editado_en") is None and r["creado_en"] < antes_de
+                and r["estado"] not in ESTADOS_EN_CURSO
+            ]
+            for plan_id in vencidos:
+                del self.planes[plan_id]
+            return len(vencidos)
+
+
+# =========================
+# BACKEND SQLITE (default, durable)
+# =========================
+class SQLitePlanStore:
+    """
+    Una fila por plan: data como JSON y metadatos (estado, timestamps,
+    error...) como JSON aparte, para que el polling de estado no tenga
+    que deserializar planes grandes.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS planes (
+                    plan_id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    meta TEXT NOT NULL,
+                    data TEXT
+                )
+                """
+            )
+
+    @staticmethod
+    def _separar(registro: dict):
+        meta = {k: v for k, v in registro.items() if k not in ("plan_id", "version", "data")}
+        return json.dumps(meta, default=_a_json)
+
+    def guardar_nuevo(self, registro: dict):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO planes (plan_id, version, meta, data) VALUES (?, ?, ?, ?)",
+                (
+                    registro["plan_id"],
+                    registro["version"],
+                    self._separar(registro),
+                    json.dumps(registro["data"], default=_a_json),
+                )
+            )
+
+    def leer(self, plan_id: str, con_data: bool = True):
+        columna_data = "data" if con_data else "NULL"
+        with self.lock:
+            fila = self.conn.execute(
+                f"SELECT version, meta, {columna_data} FROM planes WHERE plan_id = ?", (plan_id,)
+            ).fetchone()
+        if fila is None:
+            raise PlanNoEncontrado("Plan no encontrado")
+        version, meta, data = fila
+        registro = json.loads(meta)
+        registro.update(plan_id=plan_id, version=version)
+        if con_data:
+            registro["data"] = json.loads(data)
+        return registro
+
+    def escribir_data(self, plan_id: str, data: dict, version: int = None):
+        data_json = json.dumps(data, default=_a_json)
+        with self.lock, self.conn:
+            if version is None:
+                cursor = self.conn.execute(
+                    "UPDATE planes SET data = ?, version = version + 1 WHERE plan_id = ?",
+                    (data_json, plan_id)
+                )
+            else:
+                # Compare-and-set: solo escribe si nadie cambió la versión.
+                # Edición del usuario: editado_en lo excluye de la poda
+                cursor = self.conn.execute(
+                    "UPDATE planes SET data = ?, version = version + 1, "
+                    "meta = json_set(meta, '$.editado_en', ?) "
+                    "WHERE plan_id = ? AND version = ?",
+                    (data_json, time.time(), plan_id, version)
+                )
+            if cursor.rowcount == 0:
+                fila = self.conn.execute(
+                    "SELECT version FROM planes WHERE plan_id = ?", (plan_id,)
+                ).fetchone()
+                if fila is None:
+                    raise PlanNoEncontrado("Plan no encontrado")
+                raise ConflictoVersion(
+                    f"Versión {version} desactualizada; la vigente es {fila[0]}"
+                )
+            return self.conn.execute(
+                "SELECT version FROM planes WHERE plan_id = ?", (plan_id,)
+            ).fetchone()[0]
+
+    def escribir_campos(self, plan_id: str, campos: dict, si_estado: str = None):
+        with self.lock, self.conn:
+            fila = self.conn.execute(
+                "SELECT meta FROM planes WHERE plan_id = ?", (plan_id,)
+            ).fetchone()
+            if fila is None:
+                raise PlanNoEncontrado("Plan no encontrado")
+            meta = json.loads(fila[0])
+            if si_estado is not None and meta.get("estado") != si_estado:
+                return False
+            meta.update(campos)
+            if si_estado is None:
+                self.conn.execute(
+                    "UPDATE planes SET meta = ? WHERE plan_id = ?",
+                    (json.dumps(meta, default=_a_json), plan_id)
+                )
+                return True
+            # Compare-and-set sobre el estado: si otro proceso lo cambió entre
+            # el SELECT y el UPDATE, no se pisa
+            cursor = self.conn.execute(
+                "UPDATE planes SET meta = ? WHERE plan_id = ? AND json_extract(meta, '$.estado') = ?",
+                (json.dumps(meta, default=_a_json), plan_id, si_estado)
+            )
+            return cursor.rowcount > 0
+
+    def escribir_resultado(self, plan_id: str, data: dict, campos: dict, si_estado: str):
+        data_json = json.dumps(data, default=_a_json)
+        with self.lock, self.conn:
+            fila = self.conn.execute(
+                "SELECT meta FROM planes WHERE plan_id = ?", (plan_id,)
+            ).fetchone()
+            if fila is None:
+                raise PlanNoEncontrado("Plan no encontrado")
+            meta = json.loads(fila[0])
+            if meta.get("estado") != si_estado:
+                return False
+            meta.update(campos)
+            # Data, versión y estado en un solo compare-and-set sobre el estado
+            cursor = self.conn.execute(
+                "UPDATE planes SET data = ?, version = version + 1, meta = ? "
+                "WHERE plan_id = ? AND json_extract(meta, '$.estado') = ?",
+                (data_json, json.dumps(meta, default=_a_json), plan_id, si_estado)
+            )
+            return cursor.rowcount > 0
+
+    def podar(self, antes_de: float):
+        en_curso = ", ".join("?" * len(ESTADOS_EN_CURSO))
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "DELETE FROM planes "
+                "WHERE json_extract(meta, '$.editado_en') IS NULL "
+                "AND json_extract(meta, '$.creado_en') < ? "
+                f"AND json_extract(meta, '$.estado') NOT IN ({en_curso})",
+                (antes_de, *ESTADOS_EN_CURSO)
+            )
+            return cursor.rowcount
+
+
+def crear_backend(tipo: str = PLAN_STORE_BACKEND):
+    if tipo == "memoria":
+        return MemoriaPlanStore()
+    if tipo == "sqlite":
+        return SQLitePlanStore(PLAN_STORE_SQLITE_PATH)
+    raise ValueError(f"Backend de planes no soportado: {tipo}")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = crear_backend()
+        return _backend
+
+
+def configurar_backend(nuevo):
+    """
+    Reemplaza el backend activo (ej. MemoriaPlanStore() en tests).
+    """
+    global _backend
+    with _backend_lock:
+        _backend = nuevo
+
+
+# =========================
+# API DEL STORE
+# =========================
+_ultima_poda = 0.0
+_poda_lock = threading.Lock()
+
+
+def podar_planes(ttl_horas: float = PLAN_STORE_TTL_HORAS):
+    """
+    Borra los planes no editados creados hace más de 'ttl_horas' (los jobs
+    en curso y los editados se conservan). Retorna cuántos borró.
+    """
+    if ttl_horas is None:
+        return 0
+    return backend().podar(time.time() - ttl_horas * 3600)
+
+
+def _podar_si_corresponde():
+    global _ultima_poda
+    if PLAN_STORE_TTL_HORAS is None:
+        return
+    with _poda_lock:
+        ahora = time.time()
+        if ahora - _ultima_poda < PLAN_STORE_PODA_MIN * 60:
+            return
+        _ultima_poda = ahora
+    podar_planes()
+
+
+def crear_plan(data: dict, estado: str = ESTADO_GENERADO):
+    """
+    Guarda un plan nuevo (versión 1). De paso poda los vencidos (ver
+    PLAN_STORE_TTL_HORAS), como mucho una vez cada PLAN_STORE_PODA_MIN.
+    """
+    _podar_si_corresponde()
+    registro = {
+        "plan_id": str(uuid.uuid4()),
+        "estado": estado,
+        "version": 1,
+        "data": data,
+        "creado_en": time.time()
     }
-    return PLANES[plan_id]
-
-def obtener_plan(plan_id: str):
-    if plan_id not in PLANES:
-        raise ValueError("Plan no encontrado")
-    return PLANES[plan_id]
-
-def actualizar_plan(plan_id: str, data: dict):
-    if plan_id not in PLANES:
-        raise ValueError("Plan no encontrado")
-    PLANES[plan_id]["data"] = data
-    return PLANES[plan_id]
+    backend().guardar_nuevo(registro)
+    return registro
+
+def obtener_plan(plan_id: str, con_data: bool = True):
+    """
+    Con con_data=False solo trae metadatos (estado, versión...), útil para polling.
+    """
+    return backend().leer(plan_id, con_data)
+
+def actualizar_plan(plan_id: str, data: dict, version: int = None):
+    """
+    Guarda 'data' y sube la versión. Si se pasa 'version' (edición del
+    usuario), solo escribe si coincide con la vigente (si no,
+    ConflictoVersion) y el plan queda fuera de la poda. Retorna la nueva versión.
+    """
+    return backend().escribir_data(plan_id, data, version)
+
+def actualizar_estado(plan_id: str, estado: str, si_estado: str = None, **campos):
+    """
+    Cambia el estado del plan y registra campos extra (timestamps, error...).
+    Con 'si_estado', solo si el estado vigente es ese (transición atómica:
+    ej. un job cancelado no pasa a TERMINADO). Retorna si se escribió.
+    """
+    campos["estado"] = estado
+    return backend().escribir_campos(plan_id, campos, si_estado)
+
+
+def completar_plan(plan_id: str, data: dict, estado: str, si_estado: str, **campos):
+    """
+    Guarda 'data' (sube la versión) y pasa a 'estado' en una sola escritura,
+    solo si el estado vigente es 'si_estado': un job cancelado mientras
+    corría no recibe su resultado. Retorna si se escribió.
+    """
+    campos["estado"] = estado
+    return backend().escribir_resultado(plan_id, data, campos, si_estado)
@@ -0,0 +1,190 @@
+import gzip
+import json
+
+import numpy as np
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+from app.config.settings import (
+    RESPUESTAS_COMPRIMIR_MIN_BYTES,
+    RESPUESTAS_GZIP_NIVEL,
+    RESPUESTAS_BROTLI_CALIDAD,
+)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FORMATO_ANIDADO = "ANIDADO"
+FORMATO_COLUMNAR = "COLUMNAR"
+FORMATOS_RESPUESTA = (FORMATO_ANIDADO, FORMATO_COLUMNAR)
+
+# Atributos del PDV que el formato columnar manda una sola vez (tabla 'pdvs')
+ATRIBUTOS_PDV = ("razon_social", "subcanal", "distrito", "h3")
+
+
+# =========================
+# SERIALIZACIÓN
+# =========================
+def _por_defecto(valor):
+    # Escalares / arrays de NumPy que no pasaron por tolist()
+    if isinstance(valor, np.generic):
+        return valor.item()
+    if isinstance(valor, np.ndarray):
+        return valor.tolist()
+    raise TypeError(f"Tipo no serializable a JSON: {type(valor).__name__}")
+
+
+def a_json(contenido) -> bytes:
+    """
+    JSON compacto en bytes. Con orjson (Rust) si está instalado; si no,
+    json de la librería estándar (mismo resultado, más lento).
+    """
+    if orjson is not None:
+        return orjson.dumps(
+            contenido, default=_por_defecto,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        )
+    return json.dumps(
+        contenido, default=_por_defecto, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def desde_json(cuerpo: bytes):
+    """
+    Inverso de a_json (JSON subido por el cliente, ej. un plan anterior).
+    """
+    if orjson is not None:
+        return orjson.loads(cuerpo)
+    return json.loads(cuerpo)
+
+
+class RespuestaJSON(Response):
+    """
+    JSONResponse sin jsonable_encoder: el contenido ya son tipos nativos
+    (dicts / listas / números) y va directo a a_json.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return a_json(content)
+
+
+# =========================
+# COMPRESIÓN (Accept-Encoding)
+# =========================
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def _codificaciones_aceptadas(accept_encoding: str):
+    """
+    Codificaciones con q > 0 del header Accept-Encoding ("gzip, br;q=0.8").
+    """
+    aceptadas = set()
+    for parte in (accept_encoding or "").lower().split(","):
+        nombre, _, parametros = parte.strip().partition(";")
+        q = 1.0
+        if parametros.strip().startswith("q="):
+            try:
+                q = float(parametros.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if nombre and q > 0:
+            aceptadas.add(nombre)
+    return aceptadas
+
+
+def comprimir(cuerpo: bytes, accept_encoding: str):
+    """
+    (cuerpo, Content-Encoding o None). Prefiere br (si el módulo brotli está
+    instalado) y luego gzip; los cuerpos chicos van sin comprimir.
+    """
+    if len(cuerpo) < RESPUESTAS_COMPRIMIR_MIN_BYTES:
+        return cuerpo, None
+    aceptadas = _codificaciones_aceptadas(accept_encoding)
+    brotli = _brotli() if "br" in aceptadas else None
+    if brotli is not None:
+        return brotli.compress(cuerpo, quality=RESPUESTAS_BROTLI_CALIDAD), "br"
+    if "gzip" in aceptadas:
+        return gzip.compress(cuerpo, compresslevel=RESPUESTAS_GZIP_NIVEL), "gzip"
+    return cuerpo, None
+
+
+# =========================
+# FORMATO COLUMNAR
+# =========================
+def validar_formato(formato: str):
+    if formato not in FORMATOS_RESPUESTA:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Formato de respuesta no soportado: {formato}. Use uno de {list(FORMATOS_RESPUESTA)}"
+        )
+
+
+def a_columnar(resultado: dict) -> dict:
+    """
+    Mismo plan sin un objeto por PDV: cada ruta lleva arrays paralelos
+    (ids, lat, lon, orden) y los atributos de cada PDV van una sola vez en
+    'pdvs' (columnas paralelas, una fila por COD_LIVE_TRA). En BOLSA un PDV
+    con GOLPEO > 1 aparece en varias rutas pero en una sola fila de 'pdvs'.
+    El plan guardado sigue en formato anidado (edición y /exportar).
+    """
+    tabla = {"cod_live_tra": []}
+    tabla.update((atributo, []) for atributo in ATRIBUTOS_PDV)
+    vistos = set()
+
+    mercaderistas = []
+    for merc in resultado.get("mercaderistas", []):
+        rutas = []
+        for ruta in merc["rutas"]:
+            pdvs = ruta["pdvs"]
+            salida = {k: v for k, v in ruta.items() if k != "pdvs"}
+            salida["ids"] = [p["cod_live_tra"] for p in pdvs]
+            salida["lat"] = [p["latitud"] for p in pdvs]
+            salida["lon"] = [p["longitud"] for p in pdvs]
+            salida["orden"] = [p.get("orden") for p in pdvs]
+            rutas.append(salida)
+
+            for pdv in pdvs:
+                cod = pdv["cod_live_tra"]
+                if cod in vistos:
+                    continue
+                vistos.add(cod)
+                tabla["cod_live_tra"].append(cod)
+                for atributo in ATRIBUTOS_PDV:
+                    tabla[atributo].append(pdv.get(atributo))
+
+        salida_merc = {k: v for k, v in merc.items() if k != "rutas"}
+        salida_merc["rutas"] = rutas
+        mercaderistas.append(salida_merc)
+
+    columnar = {k: v for k, v in resultado.items() if k != "mercaderistas"}
+    columnar["formato"] = FORMATO_COLUMNAR
+    columnar["pdvs"] = tabla
+    columnar["mercaderistas"] = mercaderistas
+    return columnar
+
+
+# =========================
+# RESPUESTA DE PLANES
+# =========================
+def responder_plan(resultado: dict, formato: str = FORMATO_ANIDADO, accept_encoding: str = None,
+                   status_code: int = 200):
+    """
+    Respuesta de un plan (grande): serializado directo con a_json, en el
+    formato pedido y comprimido según Accept-Encoding.
+    """
+    if formato == FORMATO_COLUMNAR:
+        resultado = a_columnar(resultado)
+    cuerpo, codificacion = comprimir(a_json(resultado), accept_encoding)
+    headers = {"Vary": "Accept-Encoding"}
+    if codificacion:
+        headers["Content-Encoding"] = codificacion
+    return Response(cuerpo, status_code=status_code, media_type="application/json", headers=headers)
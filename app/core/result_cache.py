@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+from app.config.settings import (
+    RESULT_CACHE_MAX_MB,
+    RESULT_CACHE_DIR,
+    RESULT_CACHE_DISCO_MAX_MB,
+)
+
+# Cómo se obtuvo un resultado (se informa en diagnostico.cache)
+CACHE_HIT = "HIT"
+CACHE_HIT_DISCO = "HIT_DISCO"
+CACHE_COALESCIDO = "COALESCIDO"
+CACHE_MISS = "MISS"
+
+BLOQUE_HASH = 1024 * 1024
+
+
+def _a_json(valor):
+    if isinstance(valor, np.generic):
+        return valor.item()
+    raise TypeError(f"Tipo no serializable: {type(valor).__name__}")
+
+
+def hash_archivo(f) -> str:
+    """
+    SHA-256 del contenido de un archivo abierto (por bloques); lo deja
+    posicionado al inicio para poder leerlo después.
+    """
+    f.seek(0)
+    h = hashlib.sha256()
+    for bloque in iter(lambda: f.read(BLOQUE_HASH), b""):
+        h.update(bloque)
+    f.seek(0)
+    return h.hexdigest()
+
+
+def clave_cache(hash_contenido: str, **parametros) -> str:
+    """
+    Clave direccionada por contenido: hash del archivo + parámetros ya
+    normalizados (orden de claves fijo).
+    """
+    texto = json.dumps(parametros, sort_keys=True, default=str)
+    return hashlib.sha256(f"{hash_contenido}|{texto}".encode()).hexdigest()
+
+
+# =========================
+# CACHE DE RESULTADOS (LRU en memoria + disco opcional)
+# =========================
+class CacheResultados:
+    """
+    Resultados JSON por clave. Se guardan serializados: el tamaño en bytes
+    es exacto para el desalojo y cada lectura entrega una copia nueva (el
+    llamador puede modificarla).
+    - Memoria: LRU acotado por 'max_bytes'.
+    - Disco (opcional, 'directorio'): sobrevive reinicios y se comparte entre
+      procesos; se poda por antigüedad sobre 'max_bytes_disco'.
+    - Coalescencia: si llega una clave que ya se está calculando, se espera
+      ese cálculo en vez de repetirlo.
+    """
+
+    def __init__(self, max_bytes: int, directorio: str = None, max_bytes_disco: int = None):
+        self.max_bytes = max_bytes
+        self.directorio = directorio
+        self.max_bytes_disco = max_bytes_disco
+        self.entradas = OrderedDict()
+        self.bytes = 0
+        self.en_curso = {}
+        self.lock = threading.Lock()
+        self.contadores = {
+            "hits": 0, "hits_disco": 0, "coalescidos": 0, "misses": 0, "desalojos": 0
+        }
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+
+    # --- memoria ---
+    def _guardar_memoria(self, clave: str, contenido: bytes):
+        # Con el lock tomado
+        if len(contenido) > self.max_bytes:
+            return
+        anterior = self.entradas.pop(clave, None)
+        if anterior is not None:
+            self.bytes -= len(anterior)
+        self.entradas[clave] = contenido
+        self.bytes += len(contenido)
+        while self.bytes > self.max_bytes:
+            _, desalojado = self.entradas.popitem(last=False)
+            self.bytes -= len(desalojado)
+            self.contadores["desalojos"] += 1
+
+    # --- disco ---
+    def _ruta(self, clave: str):
+        return os.path.join(self.directorio, f"{clave}.json")
+
+    def _leer_disco(self, clave: str):
+        if not self.directorio:
+            return None
+        try:
+            with open(self._ruta(clave), "rb") as f:
+                contenido = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(self._ruta(clave))  # antigüedad = último uso
+        return contenido
+
+    def _guardar_disco(self, clave: str, contenido: bytes):
+        if not self.directorio:
+            return
+        # Escritura atómica: otro proceso nunca ve un archivo a medias
+        fd, tmp = tempfile.mkstemp(dir=self.directorio, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(contenido)
+        os.replace(tmp, self._ruta(clave))
+        self._podar_disco()
+
+    def _podar_disco(self):
+        if not self.max_bytes_disco:
+            return
+        archivos = []
+        for entrada in os.scandir(self.directorio):
+            if entrada.name.endswith(".json"):
+                stat = entrada.stat()
+                archivos.append((stat.st_mtime, stat.st_size, entrada.path))
+        total = sum(tamano for _, tamano, _ in archivos)
+        for _, tamano, ruta in sorted(archivos):
+            if total <= self.max_bytes_disco:
+                break
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass
+            total -= tamano
+
+    # --- API ---
+    def obtener_o_calcular(self, clave: str, calcular):
+        """
+        Retorna (resultado, origen): origen es HIT, HIT_DISCO, COALESCIDO o
+        MISS. Si 'calcular' falla, la excepción llega también a los requests
+        que estaban esperando la misma clave (y no se guarda nada).
+        """
+        with self.lock:
+            contenido = self.entradas.get(clave)
+            if contenido is not None:
+                self.entradas.move_to_end(clave)
+                self.contadores["hits"] += 1
+                return json.loads(contenido), CACHE_HIT
+
+            future = self.en_curso.get(clave)
+            esperar = future is not None
+            if esperar:
+                self.contadores["coalescidos"] += 1
+            else:
+                future = self.en_curso[clave] = Future()
+
+        if esperar:
+            return json.loads(future.result()), CACHE_COALESCIDO
+
+        try:
+            contenido = self._leer_disco(clave)
+            origen = CACHE_HIT_DISCO
+            if contenido is None:
+                origen = CACHE_MISS
+                contenido = json.dumps(calcular(), default=_a_json).encode()
+                self._guardar_disco(clave, contenido)
+        except BaseException as e:
+            with self.lock:
+                self.en_curso.pop(clave, None)
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            self.contadores["hits_disco" if origen == CACHE_HIT_DISCO else "misses"] += 1
+            self._guardar_memoria(clave, contenido)
+            self.en_curso.pop(clave, None)
+        future.set_result(contenido)
+        return json.loads(contenido), origen
+
+    def estadisticas(self):
+        with self.lock:
+            consultas = sum(self.contadores[c] for c in ("hits", "hits_disco", "coalescidos", "misses"))
+            aciertos = consultas - self.contadores["misses"]
+            return {
+                **self.contadores,
+                "tasa_aciertos": round(aciertos / consultas, 4) if consultas else None,
+                "entradas": len(self.entradas),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "en_curso": len(self.en_curso),
+                "disco": self.directorio,
+            }
+
+    def limpiar(self):
+        """
+        Vacía la memoria (el disco se conserva) y reinicia los contadores.
+        """
+        with self.lock:
+            self.entradas.clear()
+            self.bytes = 0
+            for c in self.contadores:
+                self.contadores[c] = 0
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def cache_resultados():
+    """
+    Cache del proceso (se crea al primer uso según settings); None si está
+    desactivado (RESULT_CACHE_MAX_MB = 0 y sin directorio).
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None and (RESULT_CACHE_MAX_MB or RESULT_CACHE_DIR):
+            _cache = CacheResultados(
+                max_bytes=int(RESULT_CACHE_MAX_MB * 1024 * 1024),
+                directorio=RESULT_CACHE_DIR,
+                max_bytes_disco=int(RESULT_CACHE_DISCO_MAX_MB * 1024 * 1024) if RESULT_CACHE_DISCO_MAX_MB else None,
+            )
+        return _cache
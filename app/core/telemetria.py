@@ -0,0 +1,310 @@
+import bisect
+import contextvars
+import functools
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+from app.config.settings import TELEMETRIA_ACTIVA, TELEMETRIA_BUCKETS_SEG, TELEMETRIA_MEMORIA_INTERVALO_SEG
+
+# Traza del request en curso (None fuera de un request instrumentado)
+_traza = contextvars.ContextVar("traza_planificacion", default=None)
+
+
+# =========================
+# MÉTRICAS DEL PROCESO (formato de texto Prometheus)
+# =========================
+def _escapar(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _etiquetas(nombres, valores, extra: str = ""):
+    pares = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+class Contador:
+    def __init__(self, nombre: str, ayuda: str, etiquetas=()):
+        self.nombre, self.ayuda, self.etiquetas = nombre, ayuda, tuple(etiquetas)
+        self.valores = {}
+        self.lock = threading.Lock()
+
+    def sumar(self, valor: float = 1, *etiquetas):
+        with self.lock:
+            self.valores[etiquetas] = self.valores.get(etiquetas, 0) + valor
+
+    def exponer(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        with self.lock:
+            for etiquetas, valor in sorted(self.valores.items()):
+                lineas.append(f"{self.nombre}{_etiquetas(self.etiquetas, etiquetas)} {valor}")
+        return lineas
+
+
+class Histograma:
+    def __init__(self, nombre: str, ayuda: str, etiquetas=(), buckets=TELEMETRIA_BUCKETS_SEG):
+        self.nombre, self.ayuda, self.etiquetas = nombre, ayuda, tuple(etiquetas)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}  # etiquetas -> [conteos por bucket (no acumulados), suma, total]
+        self.lock = threading.Lock()
+
+    def observar(self, valor: float, *etiquetas):
+        i = bisect.bisect_left(self.buckets, valor)
+        with self.lock:
+            serie = self.series.get(etiquetas)
+            if serie is None:
+                serie = self.series[etiquetas] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            serie[0][i] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    def exponer(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        with self.lock:
+            for etiquetas, (conteos, suma, total) in sorted(self.series.items()):
+                acumulado = 0
+                for limite, conteo in zip(self.buckets + (float("inf"),), conteos):
+                    acumulado += conteo
+                    le = "+Inf" if limite == float("inf") else repr(limite)
+                    serie = _etiquetas(self.etiquetas, etiquetas, f'le="{le}"')
+                    lineas.append(f"{self.nombre}_bucket{serie} {acumulado}")
+                lineas.append(f"{self.nombre}_sum{_etiquetas(self.etiquetas, etiquetas)} {suma}")
+                lineas.append(f"{self.nombre}_count{_etiquetas(self.etiquetas, etiquetas)} {total}")
+        return lineas
+
+
+ETAPA_SEGUNDOS = Histograma(
+    "ruteo_etapa_segundos", "Duración por etapa del motor (total por request).", ("etapa",)
+)
+REQUEST_SEGUNDOS = Histograma(
+    "ruteo_request_segundos", "Latencia de requests HTTP.", ("metodo", "ruta")
+)
+REQUESTS = Contador(
+    "ruteo_requests_total", "Requests HTTP atendidos.", ("metodo", "ruta", "estado")
+)
+CONTEOS = Contador(
+    "ruteo_procesados_total", "Elementos procesados (filas del maestro, rutas, PDVs...).", ("tipo",)
+)
+REGISTRO = (ETAPA_SEGUNDOS, REQUEST_SEGUNDOS, REQUESTS, CONTEOS)
+
+
+def exposicion(extra=()) -> str:
+    """
+    Todas las métricas en formato de texto de Prometheus. 'extra': líneas
+    adicionales ya formateadas (ej. gauges calculados al momento).
+    """
+    lineas = [linea for metrica in REGISTRO for linea in metrica.exponer()]
+    lineas.extend(extra)
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KB en Linux
+    lineas += [
+        "# HELP ruteo_memoria_pico_proceso_bytes Pico de RSS del proceso.",
+        "# TYPE ruteo_memoria_pico_proceso_bytes gauge",
+        f"ruteo_memoria_pico_proceso_bytes {pico}",
+    ]
+    return "\n".join(lineas) + "\n"
+
+
+# =========================
+# MEMORIA (pico de RSS por request)
+# =========================
+_BYTES_PAGINA = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_actual():
+    """
+    RSS actual del proceso en bytes (None sin /proc, ej. fuera de Linux).
+    """
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _BYTES_PAGINA
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _mb(valor):
+    return None if valor is None else round(valor / 1024 ** 2, 2)
+
+
+class MedidorMemoria:
+    """
+    Pico de RSS mientras está abierto: un hilo muestrea /proc/self/statm
+    cada 'intervalo' segundos, más una muestra al abrir y otra al cerrar.
+    ru_maxrss no sirve para esto: es el máximo de toda la vida del proceso.
+    El RSS es del proceso: requests simultáneos se suman entre sí, y un pico
+    más corto que el intervalo se puede perder.
+    """
+
+    def __init__(self, intervalo: float = TELEMETRIA_MEMORIA_INTERVALO_SEG):
+        self.intervalo = intervalo
+        self.inicial = self.pico = rss_actual()
+        self.lock = threading.Lock()
+        self._fin = threading.Event()
+        self._hilo = None
+        if self.inicial is not None:
+            self._hilo = threading.Thread(target=self._muestrear, name="medidor-memoria", daemon=True)
+            self._hilo.start()
+
+    def _muestrear(self):
+        while not self._fin.wait(self.intervalo):
+            self.observar()
+
+    def observar(self):
+        rss = rss_actual()
+        if rss is None:
+            return
+        with self.lock:
+            if rss > self.pico:
+                self.pico = rss
+
+    def cerrar(self):
+        # Idempotente: el pico queda fijo al cerrar
+        if self._hilo is not None:
+            self.observar()
+            self._fin.set()
+            self._hilo.join()
+            self._hilo = None
+
+    def resumen(self, sufijo: str = ""):
+        if self._hilo is not None:
+            self.observar()
+        with self.lock:
+            pico, inicial = self.pico, self.inicial
+        return {
+            f"memoria_pico{sufijo}_mb": _mb(pico),
+            f"memoria_incremento{sufijo}_mb": _mb(None if pico is None else pico - inicial),
+        }
+
+
+# =========================
+# TRAZA POR REQUEST
+# =========================
+class Traza:
+    """
+    Tiempos acumulados por etapa (segundos y llamadas) y conteos de un
+    request. Las etapas anidadas cuentan su tiempo completo (inclusivo):
+    'fusion' incluye 'balanceo' y 'busqueda_local'. Lo que corre en otros
+    procesos (PLAN_WORKERS > 1) no llega a la traza del request.
+    La memoria es el pico de RSS durante la traza y cuánto creció sobre el
+    RSS al abrirla (ver MedidorMemoria).
+    """
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.etapas = {}
+        self.conteos = {}
+        self.lock = threading.Lock()
+        self.memoria = MedidorMemoria()
+
+    def registrar(self, etapa: str, segundos: float):
+        with self.lock:
+            acumulado = self.etapas.get(etapa)
+            if acumulado is None:
+                self.etapas[etapa] = [segundos, 1]
+            else:
+                acumulado[0] += segundos
+                acumulado[1] += 1
+
+    def contar(self, tipo: str, valor: int):
+        with self.lock:
+            self.conteos[tipo] = self.conteos.get(tipo, 0) + valor
+
+    def resumen(self):
+        with self.lock:
+            return {
+                "total_seg": round(time.perf_counter() - self.inicio, 4),
+                "etapas": {
+                    etapa: {"seg": round(seg, 4), "llamadas": llamadas}
+                    for etapa, (seg, llamadas) in self.etapas.items()
+                },
+                "conteos": dict(self.conteos),
+                **self.memoria.resumen(),
+            }
+
+
+@contextmanager
+def iniciar_traza():
+    """
+    Abre la traza de un request; al cerrarla, sus totales por etapa van a
+    los histogramas del proceso (una observación por etapa y request).
+    Con la telemetría apagada entrega None.
+    """
+    if not TELEMETRIA_ACTIVA:
+        yield None
+        return
+    traza = Traza()
+    token = _traza.set(traza)
+    try:
+        yield traza
+    finally:
+        _traza.reset(token)
+        traza.memoria.cerrar()
+        for etapa, (segundos, _) in traza.etapas.items():
+            ETAPA_SEGUNDOS.observar(segundos, etapa)
+        for tipo, valor in traza.conteos.items():
+            CONTEOS.sumar(valor, tipo)
+
+
+def _registrar(etapa: str, segundos: float):
+    traza = _traza.get()
+    if traza is not None:
+        traza.registrar(etapa, segundos)
+    else:
+        # Fuera de una traza (edición de planes, exportar...): directo al histograma
+        ETAPA_SEGUNDOS.observar(segundos, etapa)
+
+
+def contar(tipo: str, valor: int):
+    """
+    Suma un conteo (filas, rutas, PDVs) a la traza del request en curso.
+    """
+    if not TELEMETRIA_ACTIVA:
+        return
+    traza = _traza.get()
+    if traza is not None:
+        traza.contar(tipo, valor)
+    else:
+        CONTEOS.sumar(valor, tipo)
+
+
+# =========================
+# INSTRUMENTACIÓN
+# =========================
+def medido(etapa: str):
+    """
+    Decorador: cronometra cada llamada como 'etapa'. Con la telemetría
+    apagada retorna la función tal cual (costo cero).
+    """
+    def decorar(funcion):
+        if not TELEMETRIA_ACTIVA:
+            return funcion
+
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                return funcion(*args, **kwargs)
+            finally:
+                _registrar(etapa, time.perf_counter() - inicio)
+        return envoltura
+    return decorar
+
+
+async def middleware_http(request, call_next):
+    """
+    Latencia y conteo por endpoint (ruta declarada, no la URL: /planes/{plan_id}).
+    """
+    inicio = time.perf_counter()
+    estado = 500
+    try:
+        respuesta = await call_next(request)
+        estado = respuesta.status_code
+        return respuesta
+    finally:
+        ruta = request.scope.get("route")
+        ruta = getattr(ruta, "path", "SIN_RUTA")
+        REQUEST_SEGUNDOS.observar(time.perf_counter() - inicio, request.method, ruta)
+        REQUESTS.sumar(1, request.method, ruta, estado)
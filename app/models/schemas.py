@@ -48,4 +48,6 @@ class ReasignarRequest(BaseModel):
     from_ruta: int
     to_ruta: int
     rango: Dict[str, float] # Espera {min, max, promedio}
-    rutas: List[RutaInput]
\ No newline at end of file
+    rutas: List[RutaInput]
+    # Motor TSP para re-secuenciar las rutas tocadas: "LOCAL" u "ORTOOLS" (None = default)
+    secuenciador: Optional[str] = None
\ No newline at end of file
@@ -1,95 +1,241 @@
-from collections import defaultdict
 import math
 import numpy as np
+import pandas as pd
 from sklearn.cluster import KMeans
 
+from app.config.settings import (
+    CLUSTERIZADOR_DEFAULT,
+    H3_PARTICION,
+    H3_RESOLUCION_MIN,
+    H3_RESOLUCION_MAX,
+)
+from app.services.h3_utils import celdas_h3
 # IMPORTANTE: Importamos la fusión inteligente en lugar de usar la función "ciega" interna
 from app.services.routes_merges import fusionar_rutas
+from app.services.clustering_capacitado import clusterizar_capacitado
+from app.services.plan_referencia import rutas_de_referencia, conservar_ids
+from app.core.telemetria import medido
 
-def serializar_pdv(row):
-    return {
-        "cod_live_tra": row["COD_LIVE_TRA"],
-        "razon_social": row["RAZON_SOCIAL"],
-        "subcanal": row.get("SUBCANAL"),
-        "latitud": row["LATITUD"],
-        "longitud": row["LONGITUD"],
-        "distrito": row["DISTRITO"],
-        "h3": row["h3_index"]
-    }
-
-def clusterizar_rutas(df, num_rutas: int, rango: dict):
-    rutas_finales = []
-    ruta_id_counter = 1
-
-    # 1. Agrupar por H3 (macro zonas)
-    h3_groups = df.groupby("h3_index")
-
-    for h3_index, grupo in h3_groups:
-        total = len(grupo)
-        
-        # Preparamos los datos serializados para no repetir código
-        puntos_grupo = [serializar_pdv(r) for _, r in grupo.iterrows()]
-
-        # 2. Caso ideal: entra en rango (ni muy chico ni muy grande)
-        if rango["min"] <= total <= rango["max"]:
-            rutas_finales.append({
-                "ruta_id": ruta_id_counter,
-                "total_pdv": total,
-                "pdvs": puntos_grupo
-            })
-            ruta_id_counter += 1
-            continue
+CLUSTERIZADOR_H3 = "H3"
+CLUSTERIZADOR_CAPACITADO = "CAPACITADO"
+CLUSTERIZADORES = (CLUSTERIZADOR_H3, CLUSTERIZADOR_CAPACITADO)
 
-        # 3. Caso grande: subdividir con KMeans
-        if total > rango["max"]:
-            # Calculamos k particiones basado en el promedio deseado
-            # Usamos np.ceil para asegurar que no queden muy apretados
-            k = math.ceil(total / rango["promedio"])
-            
-            # Extraemos coordenadas para el algoritmo
-            coords = grupo[["LATITUD", "LONGITUD"]].values
-
-            kmeans = KMeans(
-                n_clusters=k,
-                random_state=42,
-                n_init="auto"
-            )
-            labels = kmeans.fit_predict(coords)
-
-            # Subdividimos los puntos según la etiqueta que les dio KMeans
-            sub_clusters = defaultdict(list)
-            for idx, label in enumerate(labels):
-                sub_clusters[label].append(puntos_grupo[idx])
-
-            # Creamos las sub-rutas
-            for sub_puntos in sub_clusters.values():
-                rutas_finales.append({
-                    "ruta_id": ruta_id_counter,
-                    "total_pdv": len(sub_puntos),
-                    "pdvs": sub_puntos
-                })
-                ruta_id_counter += 1
-
-        # 4. Caso chico: Lo agregamos tal cual, la fusión inteligente se encargará después
-        else:
-            rutas_finales.append({
-                "ruta_id": ruta_id_counter,
-                "total_pdv": total,
-                "pdvs": puntos_grupo
-            })
-            ruta_id_counter += 1
+H3_PARTICION_ADAPTATIVA = "ADAPTATIVA"
+H3_PARTICION_FIJA = "FIJA"
+
+def _grupos_h3(h3):
+    """
+    Posiciones de cada celda H3, celdas en orden (como df.groupby) y filas
+    en su orden original dentro de cada grupo.
+    """
+    if not len(h3):
+        return []
+    codigos, _ = pd.factorize(h3, sort=True)
+    orden = np.argsort(codigos, kind="stable")
+    cortes = np.cumsum(np.bincount(codigos))[:-1]
+    return np.split(orden, cortes)
+
+def _carga(idx, pesos):
+    # PDVs (visitas) de un grupo: filas, o suma de pesos si se indican
+    return len(idx) if pesos is None else int(pesos[idx].sum())
+
+def clusterizar_rutas(tabla, num_rutas: int, rango: dict, clusterizador: str = None, pesos=None,
+                      referencia: dict = None, cupo_fila=None):
+    """
+    Agrupa los PDVs de 'tabla' (TablaPDV con h3) en rutas internas
+    {"ruta_id", "total_pdv", "idx"}, con 'idx' = posiciones en la tabla.
+    'clusterizador' elige el motor:
+    - "H3": grupos por jerarquía H3 (ver particionar_h3) -> fusión / balanceo.
+    - "CAPACITADO": k-means balanceado con flujo de costo mínimo
+      (ver clusterizar_capacitado); respeta el rango sin reparaciones.
+    'pesos' (visitas por fila: GOLPEO, o miembros de un nodo co-ubicado,
+    ver nodos_coubicados): cada fila cuenta como sus visitas. "CAPACITADO"
+    reparte las visitas (el 'idx' repite la posición de la fila en tantas
+    rutas como visitas, hasta 'cupo_fila' por ruta); "H3" agrupa filas
+    completas con carga = suma de pesos y deja el reparto de visitas a quien
+    lo llama (ver expandir_nodos).
+    'referencia' (opcional): rutas del mismo mercaderista en un plan anterior
+    (ver plan_referencia.referencia_desde_plan). Arranque en caliente:
+    "CAPACITADO" parte de sus centroides y "H3" de sus rutas como bloques
+    de fusión; en ambos las rutas conservan el ruta_id con el que más PDVs
+    comparten.
+    """
+    if not clusterizador:
+        clusterizador = CLUSTERIZADOR_DEFAULT
+    if clusterizador not in CLUSTERIZADORES:
+        raise ValueError(f"Clusterizador no soportado: {clusterizador}. Use uno de {CLUSTERIZADORES}")
+    if clusterizador == CLUSTERIZADOR_CAPACITADO:
+        centros = None
+        if referencia is not None:
+            centros = (referencia["lat"][referencia["con_pdvs"]], referencia["lon"][referencia["con_pdvs"]])
+        rutas = clusterizar_capacitado(tabla, num_rutas, rango, pesos=pesos, centros=centros,
+                                       cupo_fila=cupo_fila)
+        return rutas if referencia is None else conservar_ids(rutas, tabla, referencia)
+    if pesos is not None:
+        pesos = np.asarray(pesos, dtype=np.int64)
 
     # =========================================================================
-    # AQUÍ ESTÁ LA MAGIA: 
+    # AQUÍ ESTÁ LA MAGIA:
     # En lugar de llamar a la función interna que unía a ciegas,
     # llamamos a 'fusionar_rutas' del archivo routes_merges.py
     # que tiene la validación de distancia (MAX_MERGE_DISTANCE_KM).
     # =========================================================================
-    
+
+    if referencia is None:
+        particiones = particionar_h3(tabla, rango, pesos=pesos)
+    else:
+        particiones = particionar_referencia(tabla, rango, referencia, pesos=pesos)
+
     rutas_optimizadas = fusionar_rutas(
-        rutas=rutas_finales, 
-        rango=rango, 
-        target_n_rutas=num_rutas  # <--- Este es el dato clave para evitar las 40 rutas
+        rutas=particiones,
+        rango=rango,
+        target_n_rutas=num_rutas,  # <--- Este es el dato clave para evitar las 40 rutas
+        tabla=tabla,
+        pesos=pesos
+    )
+
+    if referencia is not None:
+        rutas_optimizadas = conservar_ids(rutas_optimizadas, tabla, referencia)
+    return rutas_optimizadas
+
+
+def _subdividir_kmeans(tabla, idx_grupo, rango: dict, pesos=None):
+    """
+    Parte un grupo que supera el rango en k = ceil(total / promedio)
+    sub-grupos con KMeans (en orden de primera aparición de cada etiqueta).
+    Con 'pesos' el total es la suma de pesos y cada punto pesa lo suyo
+    (sample_weight), sin puntos repetidos.
+    """
+    # Usamos np.ceil para asegurar que no queden muy apretados
+    k = min(math.ceil(_carga(idx_grupo, pesos) / rango["promedio"]), len(idx_grupo))
+
+    # Extraemos coordenadas para el algoritmo
+    coords = np.column_stack(tabla.coordenadas(idx_grupo))
+
+    kmeans = KMeans(
+        n_clusters=k,
+        random_state=42,
+        n_init="auto"
     )
-    
-    return rutas_optimizadas
\ No newline at end of file
+    labels = kmeans.fit_predict(coords, sample_weight=None if pesos is None else pesos[idx_grupo])
+
+    etiquetas, primera = np.unique(labels, return_index=True)
+    return [idx_grupo[labels == label] for label in etiquetas[np.argsort(primera)]]
+
+
+def particionar_referencia(tabla, rango: dict, referencia: dict, pesos=None):
+    """
+    Primera etapa de "H3" en caliente: los PDVs que ya estaban en el plan
+    de referencia arrancan agrupados en sus rutas anteriores (las que ahora
+    superan el rango se subdividen con KMeans) y solo los nuevos pasan por
+    la partición H3. fusionar_rutas parte así casi del resultado final.
+    """
+    ruta_ref = rutas_de_referencia(tabla, referencia)
+    rutas = []
+
+    conocidos = np.flatnonzero(ruta_ref >= 0)
+    if len(conocidos):
+        orden = conocidos[np.argsort(ruta_ref[conocidos], kind="stable")]
+        cortes = np.flatnonzero(np.diff(ruta_ref[orden])) + 1
+        for idx_grupo in np.split(orden, cortes):
+            if _carga(idx_grupo, pesos) > rango["max"]:
+                rutas.extend(_subdividir_kmeans(tabla, idx_grupo, rango, pesos))
+            else:
+                rutas.append(idx_grupo)
+
+    nuevos = np.flatnonzero(ruta_ref < 0)
+    if len(nuevos):
+        pesos_nuevos = None if pesos is None else pesos[nuevos]
+        rutas.extend(nuevos[r["idx"]] for r in particionar_h3(tabla.tomar(nuevos), rango, pesos=pesos_nuevos))
+
+    return [
+        {"ruta_id": i, "total_pdv": _carga(idx, pesos), "idx": idx}
+        for i, idx in enumerate(rutas, start=1)
+    ]
+
+@medido("particion_h3")
+def particionar_h3(tabla, rango: dict, pesos=None):
+    """
+    Primera etapa del clusterizador "H3" (antes de fusión / balanceo):
+    grupos de PDVs por celda H3 según H3_PARTICION ("ADAPTATIVA" o "FIJA").
+    Las rutas chicas quedan tal cual para fusionar_rutas. Con 'pesos' la
+    carga de cada celda es la suma de pesos de sus filas.
+    """
+    if H3_PARTICION == H3_PARTICION_ADAPTATIVA:
+        grupos = _grupos_adaptativos(tabla, rango, pesos)
+    else:
+        grupos = _grupos_fijos(tabla, rango, pesos)
+    return [
+        {"ruta_id": i, "total_pdv": _carga(idx, pesos), "idx": idx}
+        for i, idx in enumerate(grupos, start=1)
+    ]
+
+
+def _grupos_fijos(tabla, rango: dict, pesos=None):
+    """
+    Una ruta por celda de tabla.h3 (resolución 9), subdividiendo con KMeans
+    las que superan el rango.
+    """
+    grupos = []
+    for idx_grupo in _grupos_h3(tabla.h3):
+        if _carga(idx_grupo, pesos) > rango["max"]:
+            grupos.extend(_subdividir_kmeans(tabla, idx_grupo, rango, pesos))
+        else:
+            grupos.append(idx_grupo)
+    return grupos
+
+
+def _grupos_adaptativos(tabla, rango: dict, pesos=None):
+    """
+    Recorre la jerarquía H3 de H3_RESOLUCION_MIN a H3_RESOLUCION_MAX:
+    - zonas dispersas: una celda gruesa que entra en el rango es un solo
+      grupo (en vez de decenas de celdas de resolución 9 con 1-2 PDVs);
+    - zonas densas: la celda que supera el rango baja a sus hijas y las
+      hermanas chicas se empaquetan hasta acercarse a rango["promedio"].
+    KMeans solo queda para lo que sigue excediendo en la resolución más
+    fina (ej. muchos PDVs en el mismo punto).
+    """
+    if not len(tabla):
+        return []
+    resoluciones = range(H3_RESOLUCION_MIN, H3_RESOLUCION_MAX + 1)
+    celdas = celdas_h3(tabla.lat, tabla.lon, resoluciones=resoluciones)
+
+    grupos = []
+    for idx_grupo in _grupos_h3(celdas[H3_RESOLUCION_MIN]):
+        if _carga(idx_grupo, pesos) > rango["max"]:
+            grupos.extend(_bajar_nivel(tabla, celdas, idx_grupo, H3_RESOLUCION_MIN, rango, pesos))
+        else:
+            grupos.append(idx_grupo)
+    return grupos
+
+
+def _bajar_nivel(tabla, celdas: dict, idx_celda, resolucion: int, rango: dict, pesos=None):
+    """
+    Divide una celda que supera el rango en sus hijas (resolución + 1).
+    Las hijas grandes se siguen dividiendo; las que entran se empaquetan
+    con sus hermanas (en orden de índice H3, vecinas dentro del padre)
+    mientras el paquete no supere rango["max"], cerrándolo al llegar a
+    rango["promedio"].
+    """
+    if resolucion >= H3_RESOLUCION_MAX:
+        return _subdividir_kmeans(tabla, idx_celda, rango, pesos)
+
+    grupos = []
+    paquete, en_paquete = [], 0
+    for posiciones in _grupos_h3(celdas[resolucion + 1][idx_celda]):
+        hija = idx_celda[posiciones]
+        carga_hija = _carga(hija, pesos)
+        if carga_hija > rango["max"]:
+            grupos.extend(_bajar_nivel(tabla, celdas, hija, resolucion + 1, rango, pesos))
+            continue
+        if paquete and en_paquete + carga_hija > rango["max"]:
+            grupos.append(np.concatenate(paquete))
+            paquete, en_paquete = [], 0
+        paquete.append(hija)
+        en_paquete += carga_hija
+        if en_paquete >= rango["promedio"]:
+            grupos.append(np.concatenate(paquete))
+            paquete, en_paquete = [], 0
+    if paquete:
+        grupos.append(np.concatenate(paquete))
+    return grupos
@@ -0,0 +1,254 @@
+import math
+
+import numpy as np
+from ortools.graph.python import min_cost_flow
+from sklearn.neighbors import KDTree
+
+from app.config.settings import (
+    CAPACITADO_MAX_ITER,
+    CAPACITADO_CANDIDATOS,
+)
+from app.services.distances import proyectar_km
+from app.core.telemetria import medido, contar
+
+# Costo entero del flujo: distancia² en km² con esta escala (0.01 km -> 1)
+ESCALA_COSTO = 1e4
+
+
+def _limites(total: int, k: int, rango: dict):
+    """
+    Cotas [min, max] de PDVs por ruta, relajadas lo justo para que repartir
+    'total' en 'k' rutas sea factible (k·min <= total <= k·max).
+    """
+    minimo = max(1, min(int(rango["min"]), total // k))
+    maximo = max(int(math.ceil(rango["max"])), math.ceil(total / k))
+    return minimo, maximo
+
+
+def _biseccion_balanceada(x, y, visitas, k):
+    """
+    Partición inicial en k grupos de carga pareja: corta recursivamente por
+    el eje más largo en la proporción de rutas de cada lado. Retorna los
+    centroides (cx, cy) de cada grupo.
+    """
+    cx, cy = np.empty(k), np.empty(k)
+    pendientes = [(np.arange(len(x)), 0, k)]
+    while pendientes:
+        filas, primera, partes = pendientes.pop()
+        if partes == 1 or len(filas) <= 1:
+            peso = visitas[filas]
+            cx[primera:primera + partes] = np.average(x[filas], weights=peso)
+            cy[primera:primera + partes] = np.average(y[filas], weights=peso)
+            continue
+        eje = x if np.ptp(x[filas]) >= np.ptp(y[filas]) else y
+        filas = filas[np.argsort(eje[filas], kind="stable")]
+        izquierda = partes // 2
+        acumulado = np.cumsum(visitas[filas])
+        corte = int(np.searchsorted(acumulado, acumulado[-1] * izquierda / partes))
+        corte = min(max(corte, 1), len(filas) - 1)
+        pendientes.append((filas[:corte], primera, izquierda))
+        pendientes.append((filas[corte:], primera + izquierda, partes - izquierda))
+    return cx, cy
+
+
+def _centros_referencia(cx, cy, rx, ry):
+    """
+    Arranque en caliente: cada centroide de la bisección toma el de la ruta
+    de referencia más cercana (emparejamiento voraz por distancia, cada una
+    una sola vez). Si hay menos rutas de referencia que k, las que faltan
+    quedan de la bisección; si hay más, sobran las más alejadas.
+    """
+    cx, cy = cx.copy(), cy.copy()
+    d2 = (cx[:, None] - rx[None, :]) ** 2 + (cy[:, None] - ry[None, :]) ** 2
+    libre_centro = np.ones(len(cx), dtype=bool)
+    libre_ref = np.ones(len(rx), dtype=bool)
+    pendientes = min(len(cx), len(rx))
+    for plano in np.argsort(d2, axis=None, kind="stable").tolist():
+        i, j = divmod(plano, len(rx))
+        if libre_centro[i] and libre_ref[j]:
+            cx[i], cy[i] = rx[j], ry[j]
+            libre_centro[i] = libre_ref[j] = False
+            pendientes -= 1
+            if not pendientes:
+                break
+    return cx, cy
+
+
+def _asignar_flujo(x, y, visitas, cx, cy, minimo, maximo, candidatos, cupo=None):
+    """
+    Paso de asignación como flujo de costo mínimo:
+    cliente (oferta = visitas) -> ruta (cap. por cliente) -> sumidero.
+    Cada ruta recibe entre 'minimo' y 'maximo' visitas: demanda fija 'minimo'
+    más un arco al sumidero con capacidad 'maximo - minimo'. Un cliente solo
+    puede ir a sus 'candidatos' rutas más cercanas y como máximo una visita
+    por ruta (salvo GOLPEO > rutas), o 'cupo' visitas si se indica (ej. un
+    nodo co-ubicado: tantas como miembros). Además cada ruta se conecta con sus
+    'maximo' clientes más cercanos, para que una ruta aislada pueda llegar
+    a su mínimo. Si aun así no alcanza, un nodo puente (costo muy alto)
+    conecta cualquier cliente con cualquier ruta: el flujo siempre es
+    factible y el puente solo se usa cuando hace falta.
+    Retorna (cliente, ruta, flujo) de las visitas asignadas.
+    """
+    n_clientes, k = len(x), len(cx)
+    puntos, centros = np.column_stack((x, y)), np.column_stack((cx, cy))
+    candidatos = min(candidatos, k)
+    _, rutas_cand = KDTree(centros).query(puntos, k=candidatos)
+    _, clientes_cand = KDTree(puntos).query(centros, k=min(maximo, n_clientes))
+
+    # Arcos cliente -> ruta sin repetir (unión de ambas listas)
+    arcos = np.unique(np.concatenate((
+        np.repeat(np.arange(n_clientes), candidatos) * k + rutas_cand.ravel(),
+        clientes_cand.ravel() * k + np.repeat(np.arange(k), clientes_cand.shape[1])
+    )))
+    origen, destino = arcos // k, arcos % k
+    d2 = (x[origen] - cx[destino]) ** 2 + (y[origen] - cy[destino]) ** 2
+    capacidad = -(-visitas // k)
+    if cupo is not None:
+        capacidad = np.maximum(capacidad, cupo)
+    capacidad = capacidad[origen]
+
+    costo = np.rint(d2 * ESCALA_COSTO).astype(np.int64)
+
+    # Nodos: clientes, rutas, sumidero, puente
+    sumidero = n_clientes + k
+    puente = sumidero + 1
+    total = int(visitas.sum())
+    smcf = min_cost_flow.SimpleMinCostFlow()
+    smcf.add_arcs_with_capacity_and_unit_cost(origen, n_clientes + destino, capacidad, costo)
+    smcf.add_arcs_with_capacity_and_unit_cost(
+        n_clientes + np.arange(k), np.full(k, sumidero),
+        np.full(k, maximo - minimo), np.zeros(k, dtype=np.int64)
+    )
+    smcf.add_arcs_with_capacity_and_unit_cost(
+        np.arange(n_clientes), np.full(n_clientes, puente), visitas,
+        np.full(n_clientes, 10 * int(costo.max()) + 1)
+    )
+    smcf.add_arcs_with_capacity_and_unit_cost(
+        np.full(k, puente), n_clientes + np.arange(k),
+        np.full(k, total), np.zeros(k, dtype=np.int64)
+    )
+    smcf.set_nodes_supplies(
+        np.arange(puente + 1),
+        np.concatenate((visitas, np.full(k, -minimo), [-(total - k * minimo), 0]))
+    )
+
+    if smcf.solve() != smcf.OPTIMAL:
+        raise ValueError(f"Sin asignación factible para {k} rutas en [{minimo}, {maximo}]")
+
+    flujo = smcf.flows(np.arange(len(origen)))
+    usados = flujo > 0
+    origen, destino, flujo = origen[usados], destino[usados], flujo[usados]
+
+    # Visitas que pasaron por el puente: cliente -> puente -> ruta
+    n_arcos = len(arcos)
+    por_puente = smcf.flows(np.arange(n_arcos + k, n_arcos + k + n_clientes))
+    if por_puente.any():
+        hacia = smcf.flows(np.arange(n_arcos + k + n_clientes, n_arcos + 2 * k + n_clientes))
+        clientes_p = np.repeat(np.arange(n_clientes), por_puente)
+        rutas_p = np.repeat(np.arange(k), hacia)
+        # Cada visita puenteada va a la ruta con cupo más cercana a su cliente
+        d2_p = (x[clientes_p, None] - cx[rutas_p]) ** 2 + (y[clientes_p, None] - cy[rutas_p]) ** 2
+        libres = np.ones(len(rutas_p), dtype=bool)
+        rutas_asignadas = np.empty(len(clientes_p), dtype=np.int64)
+        for i in np.argsort(d2_p.min(axis=1), kind="stable"):
+            j = np.flatnonzero(libres)[np.argmin(d2_p[i, libres])]
+            libres[j] = False
+            rutas_asignadas[i] = rutas_p[j]
+        origen = np.concatenate((origen, clientes_p))
+        destino = np.concatenate((destino, rutas_asignadas))
+        flujo = np.concatenate((flujo, np.ones(len(clientes_p), dtype=flujo.dtype)))
+    return origen, destino, flujo
+
+
+@medido("clustering_capacitado")
+def clusterizar_capacitado(tabla, num_rutas: int, rango: dict, max_iter: int = None,
+                           candidatos: int = None, pesos=None, centros=None, cupo_fila=None):
+    """
+    K-means balanceado: alterna un paso de asignación con capacidad
+    (flujo de costo mínimo, OR-Tools) y la actualización de centroides.
+    Produce 'num_rutas' rutas con tamaño dentro de [rango["min"], rango["max"]]
+    en una sola pasada, sin fusiones ni balanceo posteriores.
+    Las visitas repetidas de un cliente (GOLPEO) son una sola oferta en el
+    flujo: nunca caen dos en la misma ruta mientras haya rutas suficientes.
+    'pesos' (opcional): visitas por fila de la tabla (GOLPEO). Así se
+    planifica sobre clientes únicos sin repetir filas: cada visita recién
+    aparece como una posición más en el 'idx' de su ruta. Sin pesos, cada
+    fila es una visita.
+    'cupo_fila' (opcional): visitas de una fila que pueden caer en una misma
+    ruta (ej. una fila por nodo co-ubicado: sus miembros). Sin él, una por
+    ruta mientras alcancen las rutas.
+    'centros' (opcional): (lats, lons) de las rutas de un plan anterior;
+    arrancan las iteraciones cerca del punto fijo (ver _centros_referencia).
+    Misma salida que clusterizar_rutas: rutas internas {"ruta_id",
+    "total_pdv", "idx"} ordenadas de mayor a menor.
+    """
+    if max_iter is None:
+        max_iter = CAPACITADO_MAX_ITER
+    if candidatos is None:
+        candidatos = CAPACITADO_CANDIDATOS
+
+    if pesos is None:
+        pesos = np.ones(len(tabla), dtype=np.int64)
+    # Fila de la tabla de cada visita (sin pesos: la identidad)
+    visita_fila = np.repeat(np.arange(len(tabla)), pesos)
+    total = len(visita_fila)
+    k = max(1, min(num_rutas, total))
+    if not total:
+        return []
+
+    # 1. Clientes únicos (un nodo del flujo por cliente, oferta = visitas)
+    clientes, primera, cliente_de = np.unique(tabla.id, return_index=True, return_inverse=True)
+    visitas = np.bincount(cliente_de, weights=pesos, minlength=len(clientes)).astype(np.int64)
+    x, y = proyectar_km(tabla.lat[primera], tabla.lon[primera])
+    minimo, maximo = _limites(total, k, rango)
+    cupo = None
+    if cupo_fila is not None:
+        cupo = np.zeros(len(clientes), dtype=np.int64)
+        np.maximum.at(cupo, cliente_de, np.asarray(cupo_fila, dtype=np.int64))
+        cupo = np.maximum(cupo, -(-visitas // k))
+    # Rutas que necesita cada cliente para repartir todas sus visitas
+    candidatos = max(candidatos, int((visitas if cupo is None else -(-visitas // cupo)).max()))
+
+    # 2. Centroides iniciales: bisección de carga pareja (ya cerca del rango)
+    cx, cy = _biseccion_balanceada(x, y, visitas, k)
+    if centros is not None and len(centros[0]):
+        # Arranque en caliente: centroides del plan anterior (mismo plano)
+        rx, ry = proyectar_km(*centros, lat_centro=float(tabla.lat[primera].mean()))
+        cx, cy = _centros_referencia(cx, cy, rx, ry)
+
+    # 3. Asignación con capacidad <-> centroides, hasta que no cambie
+    asignacion = anterior = None
+    for iteracion in range(1, max(1, max_iter) + 1):
+        asignacion = _asignar_flujo(x, y, visitas, cx, cy, minimo, maximo, candidatos, cupo)
+        origen, destino, flujo = asignacion
+
+        clave = (destino * len(clientes) + origen).tobytes()
+        if clave == anterior:
+            break
+        anterior = clave
+
+        peso = np.bincount(destino, weights=flujo, minlength=k)
+        cx = np.bincount(destino, weights=flujo * x[origen], minlength=k) / peso
+        cy = np.bincount(destino, weights=flujo * y[origen], minlength=k) / peso
+    contar("iteraciones_capacitado", iteracion)
+
+    # 4. Visitas -> ruta: cada cliente reparte sus visitas (en orden de tabla)
+    # entre las rutas que le asignó el flujo
+    origen, destino, flujo = asignacion
+    orden_arcos = np.argsort(origen, kind="stable")
+    rutas_visitas = np.repeat(destino[orden_arcos], flujo[orden_arcos])
+    ruta_de = np.empty(total, dtype=np.int64)
+    ruta_de[np.argsort(cliente_de[visita_fila], kind="stable")] = rutas_visitas
+
+    orden = np.argsort(ruta_de, kind="stable")
+    cortes = np.cumsum(np.bincount(ruta_de, minlength=k))[:-1]
+    rutas = [
+        {"ruta_id": 0, "total_pdv": len(idx), "idx": visita_fila[idx]}
+        for idx in np.split(orden, cortes) if len(idx)
+    ]
+
+    # Reordenar IDs (igual que fusionar_rutas)
+    rutas.sort(key=lambda r: len(r["idx"]), reverse=True)
+    for i, r in enumerate(rutas, start=1):
+        r["ruta_id"] = i
+    return rutas
@@ -0,0 +1,212 @@
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KDTree
+
+from app.config.settings import COUBICADOS_ACTIVO, COUBICADOS_TOLERANCIA_M
+from app.services.distances import proyectar_km
+from app.core.telemetria import medido, contar
+
+# Hasta esta cantidad de coordenadas distintas se buscan vecinas con la
+# matriz de pares (O(n²) en memoria); por encima, con KD-tree
+FUERZA_BRUTA_MAX_PUNTOS = 150
+
+
+# =========================
+# NODOS CO-UBICADOS (mercados, galerías, centros comerciales)
+# =========================
+def agrupar_coubicados(lats, lons, tolerancia_m: float = None):
+    """
+    Nodo de cada punto: los PDVs en el mismo punto (o a menos de
+    'tolerancia_m' del primero del grupo) comparten nodo. Agrupa por líder
+    en orden de entrada: el diámetro queda acotado a 2·tolerancia y una
+    calle con PDVs cada pocos metros no se encadena en un solo nodo.
+    tolerancia_m = 0: solo coordenadas idénticas.
+    Retorna (nodo_de, n_nodos), nodos numerados por primera aparición.
+    """
+    if tolerancia_m is None:
+        tolerancia_m = COUBICADOS_TOLERANCIA_M
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+
+    # Coordenadas idénticas: (lat, lon) como un complejo -> una clave por punto
+    nodo_de, unicos = pd.factorize(lats + 1j * lons)
+    if tolerancia_m <= 0 or len(unicos) < 2:
+        return nodo_de, len(unicos)
+
+    # Cercanas: cada coordenada libre es líder de las libres en su radio
+    x, y = proyectar_km(unicos.real, unicos.imag)
+    radio = tolerancia_m / 1000
+    if len(unicos) <= FUERZA_BRUTA_MAX_PUNTOS:
+        # Pocos puntos: la matriz de pares sale más barata que armar un KD-tree
+        cerca = (x[:, None] - x[None, :]) ** 2 + (y[:, None] - y[None, :]) ** 2 <= radio ** 2
+        con_vecinas = np.flatnonzero(cerca.sum(axis=1) > 1).tolist()
+        vecinas = [np.flatnonzero(cerca[i]).tolist() for i in con_vecinas]
+    else:
+        puntos = np.column_stack((x, y))
+        vecinos = KDTree(puntos).query_radius(puntos, r=radio)
+        con_vecinas = [i for i, v in enumerate(vecinos) if len(v) > 1]
+        vecinas = [vecinos[i].tolist() for i in con_vecinas]
+
+    # Las aisladas (solo ellas en su radio) son su propio líder: el bucle
+    # recorre solo las que tienen vecinas, en orden de entrada
+    lider = list(range(len(unicos)))
+    asignada = [False] * len(unicos)
+    for i, cercanas in zip(con_vecinas, vecinas):
+        if asignada[i]:
+            continue
+        for j in cercanas:
+            if not asignada[j]:
+                asignada[j] = True
+                lider[j] = i
+
+    nodo_unico, lideres = pd.factorize(np.asarray(lider))
+    return nodo_unico[nodo_de], len(lideres)
+
+
+def miembros_por_nodo(nodo_de, n_nodos: int):
+    """
+    Posiciones de cada nodo (en su orden de entrada), nodo por nodo.
+    """
+    orden = np.argsort(nodo_de, kind="stable")
+    return np.split(orden, np.cumsum(np.bincount(nodo_de, minlength=n_nodos))[:-1])
+
+
+# =========================
+# PRE-PROCESO DEL MAESTRO
+# =========================
+@medido("coubicados")
+def marcar_coubicados(df: pd.DataFrame, tolerancia_m: float = None) -> pd.DataFrame:
+    """
+    Agrega NODO_COUBICADO (entero, único en todo el maestro) con el nodo de
+    cada PDV según agrupar_coubicados. Se agrupa por NOMBRE_VENDEDOR: los
+    PDVs de carteras distintas nunca comparten nodo. Con COUBICADOS_ACTIVO
+    apagado cada PDV es su propio nodo.
+    """
+    nodo = np.arange(len(df), dtype=np.int64)
+    if COUBICADOS_ACTIVO and len(df):
+        posiciones = df.groupby("NOMBRE_VENDEDOR", sort=False).indices.values()
+        lats = df["LATITUD"].to_numpy(np.float64)
+        lons = df["LONGITUD"].to_numpy(np.float64)
+        desplazamiento = 0
+        for filas in posiciones:
+            nodo_de, n_nodos = agrupar_coubicados(lats[filas], lons[filas], tolerancia_m)
+            nodo[filas] = nodo_de + desplazamiento
+            desplazamiento += n_nodos
+        contar("pdvs_coubicados", len(df) - desplazamiento)
+    df["NODO_COUBICADO"] = nodo
+    return df
+
+
+# =========================
+# CLUSTERING SOBRE NODOS
+# =========================
+def nodos_coubicados(tabla, visitas, tope: float, parejos: bool = False):
+    """
+    Tabla para agrupar con una fila por nodo (la de su primer miembro) en
+    vez de una por PDV: el clustering, la fusión y el balanceo trabajan
+    sobre menos puntos y nunca parten un nodo por accidente.
+    'visitas': visitas de cada PDV de 'tabla' (1, o GOLPEO en BOLSA).
+    Un nodo con más de 'tope' visitas (ej. un mercado más grande que una
+    ruta) se corta en trozos de hasta 'tope', en orden de entrada.
+    'parejos': separa además los miembros por cantidad de visitas, para que
+    cada nodo quepa de a sus miembros en una ruta sin repetir ninguno
+    (ej. "CAPACITADO" con GOLPEO: con GOLPEO 4 y 1 en un nodo de 2 miembros,
+    3 rutas con 2, 2 y 1 visitas obligarían a repetir el primero).
+    Retorna (nodos, nodo_de, carga):
+    - nodos: TablaPDV de nodos; su golpeo es la cantidad de rebanadas del
+      nodo (máximo de visitas de sus miembros, ver expandir_nodos);
+    - nodo_de: nodo de cada fila de 'tabla';
+    - carga: visitas de cada nodo (peso para el clustering).
+    Sin co-ubicados (o con COUBICADOS_ACTIVO apagado) cada fila es su nodo.
+    """
+    visitas = np.asarray(visitas, dtype=np.int64)
+    if not COUBICADOS_ACTIVO:
+        nodo_de = np.arange(len(tabla), dtype=np.int64)
+    elif tabla.nodo is not None:
+        nodo_de = pd.factorize(tabla.nodo)[0].astype(np.int64)
+    else:
+        nodo_de = agrupar_coubicados(tabla.lat, tabla.lon)[0].astype(np.int64)
+    if parejos and len(tabla):
+        nodo_de = pd.factorize(nodo_de * (int(visitas.max()) + 1) + visitas)[0].astype(np.int64)
+
+    carga = np.bincount(nodo_de, weights=visitas).astype(np.int64) if len(tabla) else visitas
+    grandes = np.flatnonzero(carga > max(tope, 1))
+    if len(grandes):
+        # Trozos consecutivos de hasta 'tope' visitas (al menos un PDV)
+        miembros = miembros_por_nodo(nodo_de, len(carga))
+        siguiente = len(carga)
+        for nodo in grandes.tolist():
+            posiciones = miembros[nodo]
+            trozo = (np.cumsum(visitas[posiciones]) - visitas[posiciones]) // max(int(tope), 1)
+            nodo_de[posiciones] = np.where(trozo > 0, siguiente + trozo - 1, nodo)
+            siguiente += int(trozo.max())
+        nodo_de = pd.factorize(nodo_de)[0].astype(np.int64)
+        carga = np.bincount(nodo_de, weights=visitas).astype(np.int64)
+
+    n_nodos = len(carga)
+    _, primeros = np.unique(nodo_de, return_index=True)
+    nodos = tabla.tomar(primeros)
+    nodos.golpeo = np.zeros(n_nodos, dtype=np.int64)
+    np.maximum.at(nodos.golpeo, nodo_de, visitas)
+    nodos.nodo = np.arange(n_nodos, dtype=np.int64)
+    return nodos, nodo_de, carga
+
+
+def expandir_nodos(rutas, nodo_de, visitas, nodo_fila=None, pesos_fila=None):
+    """
+    Pasa rutas armadas sobre nodos a los PDVs de la tabla original (recién
+    al emitir cada ruta). Cada fila de una ruta aporta visitas de su nodo:
+    - 'nodo_fila': nodo de cada fila de las rutas (None: las filas son los
+      nodos, ej. salida de clusterizar_rutas sobre la tabla de nodos);
+    - 'pesos_fila': visitas que aporta cada fila (None: 1 por aparición,
+      como el 'idx' de "CAPACITADO" que repite el nodo por visita).
+    Por nodo, las rutas que más visitas suyas recibieron eligen primero y
+    toman los miembros con más visitas pendientes, sin repetir un miembro en
+    la misma ruta salvo que no alcancen (GOLPEO > rutas). Con visitas de a
+    rebanadas (la k-ésima visita de cada miembro, ver nodos_coubicados)
+    reproduce exactamente las rebanadas.
+    'nodo_de' y 'visitas' son por fila de la tabla original; las rutas
+    quedan con 'idx' = posiciones en ella.
+    """
+    if not rutas:
+        return rutas
+    filas = np.concatenate([r["idx"] for r in rutas])
+    ruta_de = np.repeat(np.arange(len(rutas)), [len(r["idx"]) for r in rutas])
+    nodo = filas if nodo_fila is None else np.asarray(nodo_fila)[filas]
+    cantidad = np.ones(len(filas), dtype=np.int64) if pesos_fila is None else np.asarray(pesos_fila)[filas]
+
+    # Visitas de cada nodo en cada ruta (nodos en orden de aparición)
+    por_ruta = (
+        pd.DataFrame({"nodo": nodo, "ruta": ruta_de, "cantidad": cantidad})
+        .groupby(["nodo", "ruta"], sort=False)["cantidad"].sum()
+        .reset_index()
+    )
+    miembros = miembros_por_nodo(nodo_de, int(nodo_de.max()) + 1)
+    tamanos = np.array([len(m) for m in miembros])
+    salida = [[] for _ in rutas]
+
+    # Nodos de un solo PDV: el PDV tantas veces como visitas
+    simples = tamanos[por_ruta["nodo"].to_numpy()] == 1
+    for ruta, nodo_s, veces in zip(
+        por_ruta["ruta"][simples].tolist(), por_ruta["nodo"][simples].tolist(),
+        por_ruta["cantidad"][simples].tolist()
+    ):
+        salida[ruta].extend([int(miembros[nodo_s][0])] * veces)
+
+    # Nodos con varios PDVs: reparto de sus miembros entre sus rutas
+    compuestos = por_ruta[~simples].sort_values(["nodo", "cantidad"], ascending=[True, False], kind="stable")
+    for nodo_c, grupo in compuestos.groupby("nodo", sort=False):
+        posiciones = miembros[nodo_c]
+        pendientes = visitas[posiciones].copy()
+        for ruta, veces in zip(grupo["ruta"].tolist(), grupo["cantidad"].tolist()):
+            while veces > 0:
+                orden = np.argsort(-pendientes, kind="stable")
+                toma = orden[:min(veces, int((pendientes > 0).sum()) or veces)]
+                pendientes[toma] -= 1
+                salida[ruta].extend(posiciones[toma].tolist())
+                veces -= len(toma)
+
+    for ruta, idx in zip(rutas, salida):
+        ruta["idx"] = np.asarray(idx, dtype=np.int64)
+        ruta["total_pdv"] = len(idx)
+    return rutas
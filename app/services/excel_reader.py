@@ -1,46 +1,180 @@
+import gzip
+import time
+
 import pandas as pd
 from fastapi import UploadFile, HTTPException
-import io
 
+from app.core.telemetria import medido, MedidorMemoria
+from app.services.coubicados import marcar_coubicados
+
+# 2. Mapeo de columnas (Diccionario de Sinónimos)
+RENAME_MAP = {
+    # Campos Principales
+    "ID": "COD_LIVE_TRA",
+    "CODIGO": "COD_LIVE_TRA",
+    "NOMBRE": "RAZON_SOCIAL",
+    "CLIENTE": "RAZON_SOCIAL",
+
+    # Ubicación
+    "DEPARTAMENTO": "DEPARTAMENTO",
+    "LAT": "LATITUD", "LATITUD": "LATITUD",
+    "LON": "LONGITUD", "LNG": "LONGITUD", "LONGITUD": "LONGITUD",
+
+    # --- NUEVO: CAMPO GOLPEO ---
+    "GOLPEO": "GOLPEO",
+    "FRECUENCIA": "GOLPEO", # Por si en el Excel le ponen Frecuencia
+    "VISITAS": "GOLPEO",
+
+    # Campos opcionales
+    "VENDEDOR": "NOMBRE_VENDEDOR"
+}
+
+# Columnas que ya vienen con su nombre final (no pasan por sinónimo)
+COLUMNAS_CANONICAS = {
+    "COD_LIVE_TRA", "RAZON_SOCIAL", "NOMBRE_VENDEDOR", "DISTRITO", "SUBCANAL"
+}
+
+# Solo se leen columnas que el motor usa; el resto del archivo se ignora
+COLUMNAS_UTILES = set(RENAME_MAP) | COLUMNAS_CANONICAS
+
+# Columnas de texto: dtype explícito para no gastar en inferencia
+COLUMNAS_TEXTO = {"RAZON_SOCIAL", "DEPARTAMENTO", "NOMBRE_VENDEDOR", "DISTRITO", "SUBCANAL"}
+
+REQUIRED = ["LATITUD", "LONGITUD", "COD_LIVE_TRA"]
+
+# Firmas (magic bytes) para detectar el formato por contenido, no por extensión
+FORMATO_XLSX = "xlsx"
+FORMATO_XLS = "xls"
+FORMATO_PARQUET = "parquet"
+FORMATO_CSV_GZIP = "csv.gz"
+FORMATO_CSV = "csv"
+
+try:
+    # Lector Rust de Excel: varias veces más rápido que openpyxl
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
+
+
+def _normalizar(columna) -> str:
+    # 1. Normalizar nombres de columnas (Mayúsculas y sin espacios)
+    return str(columna).strip().upper()
+
+
+def _es_util(columna) -> bool:
+    return _normalizar(columna) in COLUMNAS_UTILES
+
+
+def detectar_formato(f) -> str:
+    inicio = f.read(8)
+    f.seek(0)
+    if inicio.startswith(b"PK\x03\x04"):
+        return FORMATO_XLSX
+    if inicio.startswith(b"\xd0\xcf\x11\xe0"):
+        return FORMATO_XLS
+    if inicio.startswith(b"PAR1"):
+        return FORMATO_PARQUET
+    if inicio.startswith(b"\x1f\x8b"):
+        return FORMATO_CSV_GZIP
+    return FORMATO_CSV
+
+
+def validar_cabecera(columnas):
+    """
+    Valida la fila de cabecera ANTES de parsear el archivo completo.
+    Retorna el dict de dtypes (por nombre original) para la lectura.
+    """
+    finales = [RENAME_MAP.get(_normalizar(c), _normalizar(c)) for c in columnas]
+
+    # 3. VALIDACIÓN MÍNIMA
+    missing = [c for c in REQUIRED if c not in finales]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Faltan columnas obligatorias: {missing}")
+
+    return {c: str for c, final in zip(columnas, finales) if final in COLUMNAS_TEXTO}
+
+
+def _cabecera_csv(linea: bytes):
+    texto = linea.decode("utf-8-sig", errors="replace")
+    # Separador: el más frecuente en la cabecera (los CSV de Excel en español usan ';')
+    sep = max((",", ";", "\t", "|"), key=texto.count)
+    return [c.strip().strip('"') for c in texto.rstrip("\r\n").split(sep)], sep
+
+
+def _leer_csv(f, comprimido: bool):
+    if comprimido:
+        with gzip.GzipFile(fileobj=f, mode="rb") as gz:
+            primera = gz.readline()
+    else:
+        primera = f.readline()
+
+    columnas, sep = _cabecera_csv(primera)
+    dtypes = validar_cabecera(columnas)
+
+    def leer(encoding):
+        f.seek(0)
+        # Descomprime en streaming, nunca el archivo entero en memoria
+        fuente = gzip.GzipFile(fileobj=f, mode="rb") if comprimido else f
+        return pd.read_csv(
+            fuente, sep=sep, usecols=_es_util, dtype=dtypes, encoding=encoding,
+            float_precision="round_trip"  # coordenadas idénticas a las del origen
+        )
+
+    try:
+        return leer("utf-8-sig")
+    except UnicodeDecodeError:
+        # Exportaciones antiguas de Excel en Windows
+        return leer("latin-1")
+
+
+def _leer_excel(f, formato: str):
+    engine = EXCEL_ENGINE if formato == FORMATO_XLSX else None
+    with pd.ExcelFile(f, engine=engine) as libro:
+        cabecera = libro.parse(0, nrows=0).columns
+        dtypes = validar_cabecera(list(cabecera))
+        return libro.parse(0, usecols=_es_util, dtype=dtypes)
+
+
+def _leer_parquet(f):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise HTTPException(status_code=400, detail="Leer Parquet requiere 'pyarrow' instalado.")
+
+    archivo = pq.ParquetFile(f)
+    columnas = archivo.schema_arrow.names
+    validar_cabecera(columnas)
+    return archivo.read(columns=[c for c in columnas if _es_util(c)]).to_pandas()
+
+
+@medido("lectura_maestro")
 def leer_maestro_pdv(file: UploadFile) -> pd.DataFrame:
+    """
+    Lee el maestro de PDVs (.xlsx, .csv, .csv.gz o .parquet, detectado por
+    contenido) directo desde el temporal del upload, sin copiarlo a memoria.
+    Deja diagnósticos de lectura en df.attrs["diagnostico_lectura"].
+    """
+    memoria = MedidorMemoria()
     try:
-        # Leer el archivo en memoria
-        content = file.file.read()
-        df = pd.read_excel(io.BytesIO(content))
-
-        # 1. Normalizar nombres de columnas (Mayúsculas y sin espacios)
-        df.columns = [str(c).strip().upper() for c in df.columns]
-
-        # 2. Mapeo de columnas (Diccionario de Sinónimos)
-        rename_map = {
-            # Campos Principales
-            "ID": "COD_LIVE_TRA",
-            "CODIGO": "COD_LIVE_TRA",
-            "NOMBRE": "RAZON_SOCIAL",
-            "CLIENTE": "RAZON_SOCIAL",
-            
-            # Ubicación
-            "DEPARTAMENTO": "DEPARTAMENTO",
-            "LAT": "LATITUD", "LATITUD": "LATITUD",
-            "LON": "LONGITUD", "LNG": "LONGITUD", "LONGITUD": "LONGITUD",
-            
-            # --- NUEVO: CAMPO GOLPEO ---
-            "GOLPEO": "GOLPEO",
-            "FRECUENCIA": "GOLPEO", # Por si en el Excel le ponen Frecuencia
-            "VISITAS": "GOLPEO",
-            
-            # Campos opcionales
-            "VENDEDOR": "NOMBRE_VENDEDOR"
-        }
-        
-        df = df.rename(columns=rename_map)
+        inicio = time.perf_counter()
+        f = file.file
+        f.seek(0)
+        formato = detectar_formato(f)
+
+        if formato == FORMATO_PARQUET:
+            df = _leer_parquet(f)
+        elif formato in (FORMATO_CSV, FORMATO_CSV_GZIP):
+            df = _leer_csv(f, comprimido=formato == FORMATO_CSV_GZIP)
+        else:
+            df = _leer_excel(f, formato)
+        tiempo_parseo = time.perf_counter() - inicio
 
-        # 3. VALIDACIÓN MÍNIMA
-        required = ["LATITUD", "LONGITUD", "COD_LIVE_TRA"]
-        missing = [c for c in required if c not in df.columns]
-        
-        if missing:
-            raise HTTPException(status_code=400, detail=f"Faltan columnas obligatorias: {missing}")
+        df.columns = [_normalizar(c) for c in df.columns]
+        df = df.rename(columns=RENAME_MAP)
+        # Si dos sinónimos apuntan a la misma columna (ej. GOLPEO y FRECUENCIA)
+        # nos quedamos con la primera
+        df = df.loc[:, ~df.columns.duplicated()]
 
         # 4. LIMPIEZA DE COORDENADAS
         df = df.dropna(subset=["LATITUD", "LONGITUD"])
@@ -55,7 +189,7 @@ def leer_maestro_pdv(file: UploadFile) -> pd.DataFrame:
             # Convertir a numérico, los errores (texto) se vuelven NaN, luego NaN se vuelve 1
             df["GOLPEO"] = pd.to_numeric(df["GOLPEO"], errors='coerce').fillna(1).astype(int)
             # Asegurar que mínimo sea 1 (no pueden ser 0 o negativos)
-            df["GOLPEO"] = df["GOLPEO"].apply(lambda x: x if x > 0 else 1)
+            df["GOLPEO"] = df["GOLPEO"].clip(lower=1)
         else:
             # Si no existe la columna, asumimos 1 visita para todos
             df["GOLPEO"] = 1
@@ -75,8 +209,23 @@ def leer_maestro_pdv(file: UploadFile) -> pd.DataFrame:
         if "FRECUENCIA" not in df.columns:
             df["FRECUENCIA"] = "SEMANAL"
 
-        return df
+        memoria.cerrar()
+        df.attrs["diagnostico_lectura"] = {
+            "formato": formato,
+            "filas": len(df),
+            "columnas_leidas": len(df.columns),
+            "tiempo_parseo_seg": round(tiempo_parseo, 3),
+            "tiempo_total_seg": round(time.perf_counter() - inicio, 3),
+            "memoria_df_mb": round(df.memory_usage(deep=True).sum() / 1024 ** 2, 2),
+            # RSS durante esta lectura (pico y crecimiento sobre el inicio)
+            **memoria.resumen("_lectura"),
+        }
+
+        # 8. NODOS CO-UBICADOS (una sola vez por maestro, ver marcar_coubicados)
+        return marcar_coubicados(df)
 
     except Exception as e:
         if isinstance(e, HTTPException): raise e
-        raise HTTPException(status_code=400, detail=f"Error leyendo Excel: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=400, detail=f"Error leyendo Excel: {str(e)}")
+    finally:
+        memoria.cerrar()
@@ -1,101 +1,298 @@
-import pandas as pd
+import csv
 import io
-import math
-from app.services.metrics import haversine 
+import re
+import shutil
+import tempfile
+import zipfile
+
+import numpy as np
+import xlsxwriter
+from fastapi import HTTPException
+
+from app.services.distances import coordenadas_pdvs
+from app.services.proveedor_distancias import proveedor_distancias
+from app.core.telemetria import medido
 
 # Constantes para el cálculo de tiempos
 VELOCIDAD_PROMEDIO_KMH = 20
 TIEMPO_SERVICIO_MIN = 10
 
-def generar_excel_final(data: dict) -> io.BytesIO:
-    resumen_data = []
-    detalle_data = []
-
-    # Recorremos cada mercaderista
-    for merc in data["mercaderistas"]:
-        nombre_merc = merc["mercaderista"]
-        
-        # Recorremos cada ruta del mercaderista
-        for ruta in merc["rutas"]:
-            # 1. DATOS PARA HOJA RESUMEN (Igual que antes)
-            resumen_data.append({
-                "MERCADERISTA": nombre_merc,
-                "RUTA_ID": ruta["ruta_id"],
-                "TOTAL_PDV": ruta["total_pdv"],
-                "DISTANCIA_KM": ruta.get("distancia_total_km", 0),
-                "TIEMPO_ESTIMADO_MIN": ruta.get("tiempo_estimado_min", 0),
-                "ESTADO": ruta.get("estado", "OK"),
-                "WARNINGS": ", ".join(ruta.get("warnings", []))
-            })
-
-            # 2. DATOS PARA HOJA BASE DE DATOS (Con cálculo de tiempo acumulado)
-            
-            # Ordenamos los PDVs por el campo 'orden' para simular el recorrido real
-            pdvs_ordenados = sorted(ruta["pdvs"], key=lambda x: x.get("orden", 999))
-            
-            tiempo_acumulado = 0.0
-            prev_lat = None
-            prev_lon = None
-
-            for pdv in pdvs_ordenados:
-                lat_actual = pdv.get("latitud")
-                lon_actual = pdv.get("longitud")
-                
-                # Calcular tiempo de viaje desde el punto anterior
-                tiempo_viaje = 0.0
-                if prev_lat is not None and prev_lon is not None:
-                    dist_km = haversine(prev_lat, prev_lon, lat_actual, lon_actual)
-                    # Tiempo = (Distancia / Velocidad) * 60 minutos
-                    tiempo_viaje = (dist_km / VELOCIDAD_PROMEDIO_KMH) * 60
-                
-                # Sumamos: Tiempo acumulado previo + Viaje hasta aquí + Visita en este punto
-                tiempo_acumulado += tiempo_viaje + TIEMPO_SERVICIO_MIN
-                
-                # Actualizamos las coordenadas previas para la siguiente vuelta
-                prev_lat = lat_actual
-                prev_lon = lon_actual
-
-                # Construimos la fila
-                fila = {
-                    "COD_LIVE_TRA": pdv.get("cod_live_tra"),
-                    "RAZON_SOCIAL": pdv.get("razon_social"),
-                    "SUBCANAL": pdv.get("subcanal"),
-                    "DISTRITO": pdv.get("distrito"),
-                    "LATITUD": lat_actual,
-                    "LONGITUD": lon_actual,
-                    "MERCADERISTA_ASIGNADO": nombre_merc,
-                    "NRO_RUTA": ruta["ruta_id"],
-                    "ORDEN_VISITA": pdv.get("orden"),
-                    # Guardamos el acumulado redondeado
-                    "TIEMPO_APROX_ACUMULADO_MIN": round(tiempo_acumulado) 
-                }
-                detalle_data.append(fila)
-
-    # Convertimos a DataFrames
-    df_resumen = pd.DataFrame(resumen_data)
-    df_detalle = pd.DataFrame(detalle_data)
-
-    # Creamos el buffer en memoria
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df_resumen.to_excel(writer, sheet_name='Resumen Rutas', index=False)
-        df_detalle.to_excel(writer, sheet_name='Base de Datos', index=False)
-        
+# =========================
+# FORMATOS DE EXPORTACIÓN
+# =========================
+FORMATO_XLSX = "xlsx"
+FORMATO_CSV = "csv"
+FORMATO_PARQUET = "parquet"
+FORMATOS_EXPORTACION = (FORMATO_XLSX, FORMATO_CSV, FORMATO_PARQUET)
+
+MEDIA_TYPES = {
+    FORMATO_XLSX: "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    FORMATO_CSV: "text/csv",
+    FORMATO_PARQUET: "application/vnd.apache.parquet",
+    "zip": "application/zip",
+}
+
+HOJA_RESUMEN = "Resumen Rutas"
+HOJA_DETALLE = "Base de Datos"
+
+COLUMNAS_RESUMEN = (
+    "MERCADERISTA", "RUTA_ID", "TOTAL_PDV", "DISTANCIA_KM",
+    "TIEMPO_ESTIMADO_MIN", "ESTADO", "WARNINGS",
+)
+COLUMNAS_DETALLE = (
+    "COD_LIVE_TRA", "RAZON_SOCIAL", "SUBCANAL", "DISTRITO", "LATITUD", "LONGITUD",
+    "MERCADERISTA_ASIGNADO", "NRO_RUTA", "ORDEN_VISITA", "TIEMPO_APROX_ACUMULADO_MIN",
+)
+
+# Bytes por lectura al enviar el archivo (StreamingResponse)
+CHUNK_BYTES = 1024 * 1024
+
+
+# =========================
+# FILAS (una pasada por mercaderista)
+# =========================
+def _filas_resumen(merc: dict):
+    nombre_merc = merc["mercaderista"]
+    for ruta in merc["rutas"]:
+        yield (
+            nombre_merc,
+            ruta["ruta_id"],
+            ruta["total_pdv"],
+            ruta.get("distancia_total_km", 0),
+            ruta.get("tiempo_estimado_min", 0),
+            ruta.get("estado", "OK"),
+            ", ".join(ruta.get("warnings", [])),
+        )
+
+
+def _filas_detalle(merc: dict):
+    """
+    Filas de la hoja 'Base de Datos' de un mercaderista, ruta por ruta en
+    orden de visita. Los tiempos acumulados de todas sus rutas salen de una
+    sola pasada vectorizada: viaje desde el punto anterior (0 al inicio de
+    cada ruta) + visita en cada punto, con cumsum reiniciado por ruta.
+    """
+    nombre_merc = merc["mercaderista"]
+
+    # Ordenamos los PDVs por el campo 'orden' para simular el recorrido real
+    rutas = [
+        (ruta["ruta_id"], sorted(ruta["pdvs"], key=lambda x: x.get("orden", 999)))
+        for ruta in merc["rutas"]
+    ]
+    pdvs = [pdv for _, pdvs_ruta in rutas for pdv in pdvs_ruta]
+    if not pdvs:
+        return
+
+    largos = np.array([len(pdvs_ruta) for _, pdvs_ruta in rutas])
+    inicios = np.concatenate(([0], np.cumsum(largos)[:-1]))[largos > 0]
+
+    lats, lons = coordenadas_pdvs(pdvs)
+    codigos = [pdv["cod_live_tra"] for pdv in pdvs]
+    dist_km = np.concatenate(([0.0], proveedor_distancias().segmentos(lats, lons, codigos)))
+    dist_km[inicios] = 0.0
+    # Tiempo = (Distancia / Velocidad) * 60 minutos
+    tiempos = (dist_km / VELOCIDAD_PROMEDIO_KMH) * 60 + TIEMPO_SERVICIO_MIN
+    acumulado = np.cumsum(tiempos)
+    base = np.repeat(acumulado[inicios] - tiempos[inicios], largos[largos > 0])
+    # Guardamos el acumulado redondeado
+    tiempos_acumulados = np.round(acumulado - base).astype(np.int64).tolist()
+
+    nros_ruta = np.repeat([ruta_id for ruta_id, _ in rutas], largos).tolist()
+    for pdv, lat, lon, nro_ruta, tiempo in zip(
+        pdvs, lats.tolist(), lons.tolist(), nros_ruta, tiempos_acumulados
+    ):
+        yield (
+            pdv.get("cod_live_tra"),
+            pdv.get("razon_social"),
+            pdv.get("subcanal"),
+            pdv.get("distrito"),
+            lat,
+            lon,
+            nombre_merc,
+            nro_ruta,
+            pdv.get("orden"),
+            tiempo,
+        )
+
+
+# =========================
+# ESCRITORES POR FORMATO
+# =========================
+def _escribir_xlsx(mercaderistas, destino):
+    """
+    Excel con xlsxwriter en modo constant_memory: cada fila se escribe y se
+    descarta (sin DataFrames ni listas intermedias del plan completo).
+    """
+    workbook = xlsxwriter.Workbook(destino, {"constant_memory": True})
+
+    # Formato de cabecera (negrita)
+    header_fmt = workbook.add_format({'bold': True, 'bg_color': '#D9E1F2', 'border': 1})
+
+    for nombre, columnas, ancho, filas in (
+        (HOJA_RESUMEN, COLUMNAS_RESUMEN, 15, _filas_resumen),
+        (HOJA_DETALLE, COLUMNAS_DETALLE, 18, _filas_detalle),
+    ):
+        worksheet = workbook.add_worksheet(nombre)
         # Formato básico: Ajustar ancho de columnas
-        workbook = writer.book
-        worksheet_resumen = writer.sheets['Resumen Rutas']
-        worksheet_detalle = writer.sheets['Base de Datos']
-        
-        # Formato de cabecera (negrita)
-        header_fmt = workbook.add_format({'bold': True, 'bg_color': '#D9E1F2', 'border': 1})
-        
-        for col_num, value in enumerate(df_resumen.columns.values):
-            worksheet_resumen.write(0, col_num, value, header_fmt)
-            worksheet_resumen.set_column(col_num, col_num, 15)
-
-        for col_num, value in enumerate(df_detalle.columns.values):
-            worksheet_detalle.write(0, col_num, value, header_fmt)
-            worksheet_detalle.set_column(col_num, col_num, 18)
+        worksheet.set_column(0, len(columnas) - 1, ancho)
+        worksheet.write_row(0, 0, columnas, header_fmt)
+
+        fila_num = 1
+        for merc in mercaderistas:
+            for fila in filas(merc):
+                worksheet.write_row(fila_num, 0, fila)
+                fila_num += 1
+
+    workbook.close()
+
 
+def _escribir_csv(mercaderistas, destino, filas, columnas):
+    # utf-8-sig: Excel abre bien tildes y eñes
+    texto = io.TextIOWrapper(destino, encoding="utf-8-sig", newline="")
+    writer = csv.writer(texto)
+    writer.writerow(columnas)
+    for merc in mercaderistas:
+        writer.writerows(filas(merc))
+    texto.flush()
+    texto.detach()
+
+
+def _escribir_parquet(mercaderistas, destino, filas, columnas):
+    """
+    Parquet con un row group por mercaderista (memoria acotada por el
+    mercaderista más grande, no por el plan). Esquema fijo: los códigos
+    pueden llegar como número o texto desde el frontend.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise HTTPException(status_code=400, detail="Exportar Parquet requiere 'pyarrow' instalado.")
+
+    tipos = {
+        "RUTA_ID": pa.int64(), "TOTAL_PDV": pa.int64(), "NRO_RUTA": pa.int64(),
+        "ORDEN_VISITA": pa.int64(), "TIEMPO_APROX_ACUMULADO_MIN": pa.int64(),
+        "DISTANCIA_KM": pa.float64(), "TIEMPO_ESTIMADO_MIN": pa.float64(),
+        "LATITUD": pa.float64(), "LONGITUD": pa.float64(),
+    }
+    schema = pa.schema([(nombre, tipos.get(nombre, pa.string())) for nombre in columnas])
+
+    def columna(valores, tipo):
+        if tipo == pa.string():
+            valores = [None if v is None else str(v) for v in valores]
+        return pa.array(valores, type=tipo)
+
+    with pq.ParquetWriter(destino, schema) as writer:
+        for merc in mercaderistas:
+            valores = list(zip(*filas(merc)))
+            if valores:
+                writer.write_table(pa.Table.from_arrays(
+                    [columna(v, campo.type) for v, campo in zip(valores, schema)], schema=schema
+                ))
+
+
+def _escribir(formato: str, mercaderistas, destino, resumen: bool = False):
+    """
+    xlsx lleva ambas hojas; csv / parquet una tabla: la 'Base de Datos' o,
+    con resumen=True, el 'Resumen Rutas'.
+    """
+    if formato == FORMATO_XLSX:
+        _escribir_xlsx(mercaderistas, destino)
+        return
+    filas, columnas = (_filas_resumen, COLUMNAS_RESUMEN) if resumen else (_filas_detalle, COLUMNAS_DETALLE)
+    if formato == FORMATO_CSV:
+        _escribir_csv(mercaderistas, destino, filas, columnas)
+    else:
+        _escribir_parquet(mercaderistas, destino, filas, columnas)
+
+
+def _escribir_en_zip(zf, nombre: str, formato: str, mercaderistas, resumen: bool = False):
+    """
+    Las entradas de un zip no admiten seek: xlsx y parquet se arman en un
+    temporal y se copian por bloques; csv se escribe directo.
+    """
+    with zf.open(nombre, "w", force_zip64=True) as destino:
+        if formato == FORMATO_CSV:
+            _escribir(formato, mercaderistas, destino, resumen)
+            return
+        with tempfile.TemporaryFile() as tmp:
+            _escribir(formato, mercaderistas, tmp, resumen)
+            tmp.seek(0)
+            shutil.copyfileobj(tmp, destino, CHUNK_BYTES)
+
+
+def _nombre_archivo(nombre) -> str:
+    return re.sub(r"[^\w\-]+", "_", str(nombre)).strip("_") or "mercaderista"
+
+
+# =========================
+# API DEL EXPORTADOR
+# =========================
+@medido("exportacion")
+def exportar_plan(data: dict, formato: str = FORMATO_XLSX, por_mercaderista: bool = False):
+    """
+    Escribe el plan en un archivo temporal (en disco) y lo retorna
+    posicionado al inicio, junto con media type y nombre sugerido.
+    - xlsx: hojas 'Resumen Rutas' y 'Base de Datos'.
+    - csv / parquet: la 'Base de Datos'.
+    - por_mercaderista: un .zip con un archivo por mercaderista (más
+      'resumen.<formato>' para csv / parquet).
+    El llamador cierra el archivo (se borra solo al cerrarse).
+    """
+    if formato not in FORMATOS_EXPORTACION:
+        raise ValueError(f"Formato no soportado: {formato}. Use uno de {FORMATOS_EXPORTACION}")
+
+    mercaderistas = data["mercaderistas"]
+    archivo = tempfile.TemporaryFile()
+    try:
+        if not por_mercaderista:
+            _escribir(formato, mercaderistas, archivo)
+            nombre, media_type = f"planificacion_final.{formato}", MEDIA_TYPES[formato]
+        else:
+            with zipfile.ZipFile(archivo, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                usados = set()
+                for merc in mercaderistas:
+                    base = nombre = _nombre_archivo(merc["mercaderista"])
+                    i = 1
+                    while nombre in usados:
+                        i += 1
+                        nombre = f"{base}_{i}"
+                    usados.add(nombre)
+                    _escribir_en_zip(zf, f"{nombre}.{formato}", formato, [merc])
+
+                if formato != FORMATO_XLSX:
+                    _escribir_en_zip(zf, f"resumen.{formato}", formato, mercaderistas, resumen=True)
+            nombre, media_type = "planificacion_final.zip", MEDIA_TYPES["zip"]
+    except BaseException:
+        archivo.close()
+        raise
+
+    archivo.seek(0)
+    return archivo, media_type, nombre
+
+
+def iterar_archivo(archivo):
+    """
+    Generador de bloques para StreamingResponse; cierra (y borra) el
+    temporal al terminar.
+    """
+    try:
+        while True:
+            bloque = archivo.read(CHUNK_BYTES)
+            if not bloque:
+                break
+            yield bloque
+    finally:
+        archivo.close()
+
+
+@medido("exportacion")
+def generar_excel_final(data: dict) -> io.BytesIO:
+    """
+    Excel completo en memoria (compatibilidad). Para planes grandes usar
+    exportar_plan, que escribe a disco y se envía por bloques.
+    """
+    output = io.BytesIO()
+    _escribir_xlsx(data["mercaderistas"], output)
     output.seek(0)
-    return output
\ No newline at end of file
+    return output
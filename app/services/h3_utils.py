@@ -1,22 +1,74 @@
 import h3
+import numpy as np
 import pandas as pd
 
-def asignar_h3(df: pd.DataFrame, resolution: int = 9) -> pd.DataFrame:
+from app.core.telemetria import medido
+
+
+@medido("h3")
+def celdas_h3(lats, lons, resoluciones=(9,)):
+    """
+    Calcula celdas H3 en lote sobre arrays de coordenadas.
+    - Coordenadas no finitas o fuera de rango -> None (chequeo vectorizado,
+      sin try/except por fila).
+    - Coordenadas repetidas (ej. GOLPEO expandido) se calculan una sola vez.
+    - Varias resoluciones en una pasada: se calcula la más fina y las demás
+      se derivan con cell_to_parent sobre las celdas únicas.
+    Retorna {resolucion: array object de largo len(lats)}.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    resoluciones = sorted(set(resoluciones), reverse=True)
+
+    validos = (
+        np.isfinite(lats) & np.isfinite(lons)
+        & (np.abs(lats) <= 90) & (np.abs(lons) <= 180)
+    )
+
+    # Dedupe: (lat, lon) como un complejo -> una sola clave hasheable por punto
+    codigos, unicos = pd.factorize(lats[validos] + 1j * lons[validos])
+
+    fina = resoluciones[0]
+    celdas_unicas = {
+        fina: np.array(
+            [h3.latlng_to_cell(z.real, z.imag, fina) for z in unicos],
+            dtype=object
+        )
+    }
+    for res in resoluciones[1:]:
+        celdas_unicas[res] = np.array(
+            [h3.cell_to_parent(c, res) for c in celdas_unicas[fina]],
+            dtype=object
+        )
+
+    resultado = {}
+    for res, celdas in celdas_unicas.items():
+        columna = np.full(len(lats), None, dtype=object)
+        columna[validos] = celdas[codigos]
+        resultado[res] = columna
+    return resultado
+
+
+def asignar_h3(df: pd.DataFrame, resolution: int = 9, resoluciones_extra=()) -> pd.DataFrame:
     """
     Asigna el índice H3 a cada punto del DataFrame basado en Latitud/Longitud.
     Compatible con H3 versión 4.x
+    'resoluciones_extra' agrega columnas h3_index_r{res} (ej. padres para
+    agrupar a distinta escala) sin volver a recorrer las coordenadas.
     """
-    def get_h3(row):
-        try:
-            # EN H3 v4: geo_to_h3 se llama ahora latlng_to_cell
-            return h3.latlng_to_cell(row['LATITUD'], row['LONGITUD'], resolution)
-        except:
-            return None
-
-    # Creamos la columna H3
-    df['h3_index'] = df.apply(get_h3, axis=1)
-    
-    # Filtramos nulos por si acaso
+    celdas = celdas_h3(
+        df["LATITUD"].to_numpy(),
+        df["LONGITUD"].to_numpy(),
+        resoluciones=(resolution, *resoluciones_extra)
+    )
+
+    # Creamos la columna H3 (sobre una copia: df suele ser un slice de groupby)
+    df = df.assign(h3_index=celdas[resolution])
+    for res in resoluciones_extra:
+        if res != resolution:
+            df[f"h3_index_r{res}"] = celdas[res]
+
+    # Filtramos puntos sin celda (coordenadas inválidas)
     df = df.dropna(subset=['h3_index'])
-    
+
     return df
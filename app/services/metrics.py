@@ -1,21 +1,12 @@
-import math
 from typing import List
 
-
-# =========================
-# DISTANCIA (HAVERSINE)
-# =========================
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371  # km
-    phi1, phi2 = math.radians(lat1), math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-
-    a = (
-        math.sin(dphi / 2) ** 2
-        + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
-    )
-    return 2 * R * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+from app.services.distances import (
+    haversine,  # noqa: F401 (re-export: compatibilidad con imports existentes)
+    coordenadas_pdvs,
+    distancias_desde,
+)
+from app.services.proveedor_distancias import proveedor_distancias
+from app.core.telemetria import medido
 
 
 # =========================
@@ -31,13 +22,9 @@ def centroide(pdvs: List[dict]):
 # DISTANCIA TOTAL ORDENADA
 # =========================
 def distancia_total(pdvs: List[dict]):
-    total = 0.0
-    for i in range(len(pdvs) - 1):
-        total += haversine(
-            pdvs[i]["latitud"], pdvs[i]["longitud"],
-            pdvs[i + 1]["latitud"], pdvs[i + 1]["longitud"]
-        )
-    return round(total, 2)
+    lats, lons = coordenadas_pdvs(pdvs)
+    codigos = [p["cod_live_tra"] for p in pdvs]
+    return round(float(proveedor_distancias().segmentos(lats, lons, codigos).sum()), 2)
 
 
 # =========================
@@ -65,19 +52,27 @@ def evaluar_ruta(ruta: dict, rango: dict):
     """
     Retorna métricas + warnings sin romper flujo
     """
-    pdvs = ruta["pdvs"]
-    total = len(pdvs)
+    codigos = [p["cod_live_tra"] for p in ruta["pdvs"]]
+    return evaluar_coordenadas(*coordenadas_pdvs(ruta["pdvs"]), rango, codigos)
+
+
+@medido("metricas")
+def evaluar_coordenadas(lats, lons, rango: dict, codigos=None):
+    """
+    Igual que evaluar_ruta, sobre las coordenadas ya ordenadas de la ruta.
+    La distancia sale del proveedor configurado ('codigos' = COD_LIVE_TRA
+    de cada punto); el radio sigue siendo en línea recta.
+    """
+    total = len(lats)
 
     # Centroide + radio
-    lat_c, lon_c = centroide(pdvs)
-    distancias = [
-        haversine(lat_c, lon_c, p["latitud"], p["longitud"])
-        for p in pdvs
-    ]
-    radio = max(distancias) if distancias else 0
+    radio = 0
+    if total:
+        distancias = distancias_desde(lats.mean(), lons.mean(), lats, lons)
+        radio = float(distancias.max())
 
     # Distancia y tiempo
-    dist_total = distancia_total(pdvs)
+    dist_total = round(float(proveedor_distancias().segmentos(lats, lons, codigos).sum()), 2)
     tiempo = tiempo_estimado(dist_total, total)
 
     # Estado simple (legacy + útil)
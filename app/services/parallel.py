@@ -0,0 +1,126 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from threadpoolctl import threadpool_limits
+
+from app.config.settings import PLAN_WORKERS, PLAN_CHUNK_SIZE, PLAN_METODO_INICIO
+
+# Módulos que el servidor "forkserver" importa una vez: cada worker nace
+# con ellos cargados en vez de importarlos al arrancar
+MODULOS_PRECARGA = ["app.services.rutas_builder", "app.services.territory_planner"]
+
+
+def _init_worker():
+    # Cada proceso ya es una unidad de paralelismo: limitamos BLAS/OpenMP
+    # (KMeans) a 1 hilo para no sobresuscribir los núcleos
+    threadpool_limits(1)
+
+
+class PlanificacionCancelada(Exception):
+    """
+    La planificación se canceló (DELETE /planes/{plan_id}) antes de terminar.
+    """
+    pass
+
+
+def verificar_cancelacion(cancelacion):
+    """
+    Corta la planificación si 'cancelacion' (threading.Event o None) está activa.
+    """
+    if cancelacion is not None and cancelacion.is_set():
+        raise PlanificacionCancelada("Planificación cancelada")
+
+
+# =========================
+# POOL DEL PROCESO
+# =========================
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _contexto():
+    """
+    Contexto de multiprocessing para los workers. Nunca "fork": el servidor
+    corre hilos (threadpool de FastAPI, jobs) y un fork copiaría locks
+    tomados por otro hilo (ej. el del proveedor de distancias o el del
+    cache), que en el hijo quedan tomados para siempre.
+    """
+    metodo = PLAN_METODO_INICIO
+    if metodo not in multiprocessing.get_all_start_methods():
+        metodo = "spawn"
+    contexto = multiprocessing.get_context(metodo)
+    if metodo == "forkserver":
+        contexto.set_forkserver_preload(MODULOS_PRECARGA)
+    return contexto
+
+
+def _pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Pool de 'workers' procesos del proceso, creado al primer uso y
+    reutilizado entre requests: los workers arrancan una sola vez.
+    """
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=_contexto(), initializer=_init_worker)
+            _pools[workers] = pool
+        return pool
+
+
+def _descartar_pool(workers: int, pool: ProcessPoolExecutor):
+    # Un worker murió (BrokenProcessPool): el próximo uso crea otro pool
+    with _pools_lock:
+        if _pools.get(workers) is pool:
+            del _pools[workers]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def mapear_grupos(funcion, grupos, workers: int = None, chunk_size: int = None, cancelacion=None):
+    """
+    Aplica 'funcion' a cada grupo (ej. (vendedor, df_vendedor)) y retorna
+    los resultados EN EL MISMO ORDEN de entrada.
+
+    - workers <= 1 (o un solo grupo): ejecución en serie, sin pool.
+    - workers > 1: pool de procesos del proceso (ver _pool) acotado a
+      min(workers, CPUs), enviando los grupos en bloques de 'chunk_size'.
+
+    'cancelacion' (threading.Event, opcional) se revisa entre grupos: si se
+    activa, los grupos pendientes no se calculan y se lanza
+    PlanificacionCancelada (un grupo ya en curso termina igual).
+
+    'funcion' debe ser de nivel módulo (picklable), igual que los grupos.
+    """
+    if workers is None:
+        workers = PLAN_WORKERS
+    if chunk_size is None:
+        chunk_size = PLAN_CHUNK_SIZE
+
+    grupos = list(grupos)
+    workers = min(workers, os.cpu_count() or 1)
+
+    if workers <= 1 or len(grupos) <= 1:
+        resultados = []
+        for g in grupos:
+            verificar_cancelacion(cancelacion)
+            resultados.append(funcion(g))
+        return resultados
+
+    pool = _pool(workers)
+    # Executor.map respeta el orden de entrada: salida determinística. Al
+    # cerrar el iterador se cancelan los bloques que aún no empezaron (el
+    # pool es compartido: no se apaga)
+    iterador = pool.map(funcion, grupos, chunksize=max(1, chunk_size))
+    try:
+        resultados = []
+        for resultado in iterador:
+            verificar_cancelacion(cancelacion)
+            resultados.append(resultado)
+        return resultados
+    except BrokenProcessPool:
+        _descartar_pool(workers, pool)
+        raise
+    finally:
+        iterador.close()
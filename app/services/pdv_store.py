@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+
+from app.services.h3_utils import celdas_h3
+
+
+# =========================
+# TABLA COLUMNAR DE PDVs
+# =========================
+class TablaPDV:
+    """
+    PDVs de un grupo (mercaderista / zona) como columnas NumPy alineadas.
+    Dentro del planificador una ruta es solo un array de posiciones en la
+    tabla; los dicts por PDV se arman recién al serializar la respuesta.
+
+    - lat, lon: float64
+    - golpeo: visitas por ciclo
+    - id: COD_LIVE_TRA internado como entero (0..clientes-1), para comparar
+      y deduplicar clientes sin tocar strings
+    - cod, razon_social, subcanal, distrito: valores originales, solo salida
+    - h3: celda H3 (o None si aún no se asignó)
+    - nodo: grupo de PDVs co-ubicados (columna NODO_COUBICADO del maestro,
+      ver marcar_coubicados; None si no viene)
+    """
+
+    COLUMNAS = ("lat", "lon", "golpeo", "id", "cod", "razon_social", "subcanal", "distrito", "h3", "nodo")
+
+    def __init__(self, **columnas):
+        for nombre in self.COLUMNAS:
+            setattr(self, nombre, columnas.get(nombre))
+
+    @classmethod
+    def desde_df(cls, df: pd.DataFrame):
+        n = len(df)
+        ids, _ = pd.factorize(df["COD_LIVE_TRA"])
+        golpeo = df["GOLPEO"].to_numpy(np.int64) if "GOLPEO" in df.columns else np.ones(n, dtype=np.int64)
+
+        def texto(columna):
+            if columna not in df.columns:
+                return np.full(n, None, dtype=object)
+            return df[columna].to_numpy(dtype=object)
+
+        return cls(
+            lat=df["LATITUD"].to_numpy(np.float64),
+            lon=df["LONGITUD"].to_numpy(np.float64),
+            golpeo=golpeo,
+            id=ids.astype(np.int64),
+            cod=df["COD_LIVE_TRA"].to_numpy(dtype=object),
+            razon_social=df["RAZON_SOCIAL"].to_numpy(dtype=object),
+            subcanal=texto("SUBCANAL"),
+            distrito=df["DISTRITO"].to_numpy(dtype=object),
+            h3=df["h3_index"].to_numpy(dtype=object) if "h3_index" in df.columns else None,
+            nodo=df["NODO_COUBICADO"].to_numpy(np.int64) if "NODO_COUBICADO" in df.columns else None
+        )
+
+    def __len__(self):
+        return len(self.lat)
+
+    def tomar(self, indices):
+        """
+        Sub-tabla con las filas 'indices' (en ese orden, se pueden repetir).
+        """
+        return TablaPDV(**{
+            nombre: None if getattr(self, nombre) is None else getattr(self, nombre)[indices]
+            for nombre in self.COLUMNAS
+        })
+
+    def expandir_golpeo(self):
+        """
+        Una fila por visita: cada PDV se repite GOLPEO veces (filas contiguas).
+        """
+        return self.tomar(np.repeat(np.arange(len(self)), self.golpeo))
+
+    def visitas_de(self, idx):
+        """
+        Posiciones en expandir_golpeo() de las visitas de las filas 'idx'
+        (las GOLPEO visitas de cada fila, en el orden de 'idx').
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        inicio = np.cumsum(self.golpeo) - self.golpeo
+        veces = self.golpeo[idx]
+        desplazamiento = np.arange(int(veces.sum())) - np.repeat(np.cumsum(veces) - veces, veces)
+        return np.repeat(inicio[idx], veces) + desplazamiento
+
+    def con_h3(self, resolution: int = 9):
+        """
+        Asigna la celda H3 y descarta filas con coordenadas inválidas.
+        """
+        h3 = celdas_h3(self.lat, self.lon, resoluciones=(resolution,))[resolution]
+        validos = np.flatnonzero(h3 != None)  # noqa: E711 (comparación elemento a elemento)
+        tabla = self.tomar(validos)
+        tabla.h3 = h3[validos]
+        return tabla
+
+    def coordenadas(self, idx):
+        return self.lat[idx], self.lon[idx]
+
+    # =========================
+    # FRONTERA DE RESPUESTA (dicts)
+    # =========================
+    def serializar_pdvs(self, idx):
+        """
+        Dicts de PDV en el orden de 'idx', con 'orden' de visita 1..n.
+        tolist() deja tipos nativos de Python (JSON-serializables).
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        columnas = zip(
+            self.cod[idx].tolist(),
+            self.razon_social[idx].tolist(),
+            self.subcanal[idx].tolist(),
+            self.lat[idx].tolist(),
+            self.lon[idx].tolist(),
+            self.distrito[idx].tolist(),
+            self.h3[idx].tolist()
+        )
+        return [
+            {
+                "cod_live_tra": cod,
+                "razon_social": razon_social,
+                "subcanal": subcanal,
+                "latitud": lat,
+                "longitud": lon,
+                "distrito": distrito,
+                "h3": h3,
+                "orden": orden
+            }
+            for orden, (cod, razon_social, subcanal, lat, lon, distrito, h3) in enumerate(columnas, 1)
+        ]
+
+    def serializar_ruta(self, ruta: dict):
+        """
+        Ruta interna {"ruta_id", "idx", métricas...} -> ruta de la respuesta.
+        """
+        salida = {
+            "ruta_id": ruta["ruta_id"],
+            "total_pdv": len(ruta["idx"]),
+            "pdvs": self.serializar_pdvs(ruta["idx"])
+        }
+        salida.update((k, v) for k, v in ruta.items() if k not in ("ruta_id", "idx", "total_pdv"))
+        return salida
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+
+
+# =========================
+# REFERENCIA (plan anterior)
+# =========================
+def referencia_desde_plan(data: dict):
+    """
+    Resume un plan anterior (respuesta de /planificar o plan guardado, en
+    formato ANIDADO o COLUMNAR) para arrancar la planificación desde él:
+    por mercaderista, las visitas como arrays planos ("cod": COD_LIVE_TRA
+    como str, "ruta": fila de su ruta) y por ruta "ruta_id", el centroide
+    ("lat", "lon") y "con_pdvs".
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("mercaderistas"), list):
+        raise ValueError("El plan de referencia no tiene 'mercaderistas'")
+
+    referencia = {}
+    for merc in data["mercaderistas"]:
+        cods, lats, lons, filas, ruta_ids = [], [], [], [], []
+        for fila, ruta in enumerate(merc.get("rutas", [])):
+            if "ids" in ruta:
+                cods_ruta, lats_ruta, lons_ruta = ruta["ids"], ruta["lat"], ruta["lon"]
+            else:
+                pdvs = ruta.get("pdvs", [])
+                cods_ruta = [p["cod_live_tra"] for p in pdvs]
+                lats_ruta = [p["latitud"] for p in pdvs]
+                lons_ruta = [p["longitud"] for p in pdvs]
+            cods.extend(cods_ruta)
+            lats.extend(lats_ruta)
+            lons.extend(lons_ruta)
+            filas.extend([fila] * len(cods_ruta))
+            ruta_ids.append(int(ruta["ruta_id"]))
+
+        if not cods:
+            continue
+        filas = np.asarray(filas, dtype=np.int64)
+        n_rutas = len(ruta_ids)
+        conteo = np.maximum(np.bincount(filas, minlength=n_rutas), 1)
+        referencia[merc["mercaderista"]] = {
+            "cod": np.asarray(cods).astype(str),
+            "ruta": filas,
+            "ruta_id": np.asarray(ruta_ids, dtype=np.int64),
+            "lat": np.bincount(filas, weights=np.asarray(lats, dtype=np.float64), minlength=n_rutas) / conteo,
+            "lon": np.bincount(filas, weights=np.asarray(lons, dtype=np.float64), minlength=n_rutas) / conteo,
+            "con_pdvs": np.bincount(filas, minlength=n_rutas) > 0,
+        }
+    return referencia
+
+
+def rutas_de_referencia(tabla, referencia: dict):
+    """
+    Ruta de referencia (fila) de cada fila de 'tabla', -1 si el PDV es nuevo.
+    Con visitas repetidas (GOLPEO, una fila por visita) la k-ésima fila de
+    un COD va a la k-ésima ruta de referencia que lo tenía.
+    """
+    ref = pd.DataFrame({"cod": referencia["cod"], "ruta": referencia["ruta"]})
+    ref["vez"] = ref.groupby("cod", sort=False).cumcount()
+
+    filas = pd.DataFrame({"cod": np.asarray(tabla.cod).astype(str)})
+    filas["vez"] = filas.groupby("cod", sort=False).cumcount()
+
+    unidas = filas.merge(ref, on=["cod", "vez"], how="left")
+    return unidas["ruta"].fillna(-1).to_numpy(dtype=np.int64)
+
+
+# =========================
+# IDENTIDAD DE RUTAS
+# =========================
+def conservar_ids(rutas, tabla, referencia: dict):
+    """
+    Renombra 'ruta_id' de las rutas nuevas con el de la ruta de referencia
+    con la que más PDVs comparten (emparejamiento voraz, cada id una vez).
+    Las que no se parecen a ninguna toman los ids libres más bajos.
+    Retorna las rutas ordenadas por ruta_id.
+    """
+    if not rutas:
+        return rutas
+
+    idx = np.concatenate([r["idx"] for r in rutas])
+    nueva = np.repeat(np.arange(len(rutas)), [len(r["idx"]) for r in rutas])
+    ref = rutas_de_referencia(tabla, referencia)[idx]
+    comunes = ref >= 0
+
+    pares = pd.DataFrame({"nueva": nueva[comunes], "ref": ref[comunes]})
+    solapes = pares.groupby(["nueva", "ref"]).size().reset_index(name="comunes")
+    solapes = solapes.sort_values(["comunes", "nueva", "ref"], ascending=[False, True, True])
+
+    ids_ref = referencia["ruta_id"]
+    asignado = {}
+    usados = set()
+    for fila_nueva, fila_ref in zip(solapes["nueva"].tolist(), solapes["ref"].tolist()):
+        ruta_id = int(ids_ref[fila_ref])
+        if fila_nueva in asignado or ruta_id in usados:
+            continue
+        asignado[fila_nueva] = ruta_id
+        usados.add(ruta_id)
+
+    libre = 1
+    for fila_nueva in range(len(rutas)):
+        if fila_nueva not in asignado:
+            while libre in usados:
+                libre += 1
+            asignado[fila_nueva] = libre
+            usados.add(libre)
+
+    for fila_nueva, ruta in enumerate(rutas):
+        ruta["ruta_id"] = asignado[fila_nueva]
+    rutas.sort(key=lambda r: r["ruta_id"])
+    return rutas
@@ -0,0 +1,228 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from app.config.settings import (
+    DISTANCIAS_PROVEEDOR,
+    DISTANCIAS_MATRIZ_PATH,
+    DISTANCIAS_MATRIZ_IDS_PATH,
+    DISTANCIAS_MATRIZ_UNIDAD,
+    DISTANCIAS_MATRIZ_VELOCIDAD_KMH,
+)
+from app.services.distances import distancias_segmentos, matriz_distancias
+
+PROVEEDOR_HAVERSINE = "HAVERSINE"
+PROVEEDOR_MATRIZ = "MATRIZ"
+PROVEEDORES = (PROVEEDOR_HAVERSINE, PROVEEDOR_MATRIZ)
+
+
+def factor_km(unidad: str, velocidad_kmh: float) -> float:
+    """
+    Valor de la matriz -> km. Los tiempos pasan a km equivalentes a
+    'velocidad_kmh': así tiempo_estimado recupera los minutos de la matriz
+    y los umbrales en km del motor siguen valiendo.
+    """
+    factores = {
+        "km": 1.0,
+        "m": 0.001,
+        "min": velocidad_kmh / 60,
+        "seg": velocidad_kmh / 3600,
+    }
+    if unidad not in factores:
+        raise ValueError(f"Unidad de matriz no soportada: {unidad}. Use una de {list(factores)}")
+    return factores[unidad]
+
+
+# =========================
+# PROVEEDORES
+# =========================
+class ProveedorHaversine:
+    """
+    Distancia en línea recta (km). 'codigos' (COD_LIVE_TRA de cada punto)
+    se acepta por interfaz y se ignora.
+    """
+
+    usa_codigos = False
+
+    def huella(self) -> dict:
+        """
+        Lo que define las distancias de este proveedor, para claves de cache.
+        """
+        return {"proveedor": PROVEEDOR_HAVERSINE}
+
+    def matriz(self, lats, lons, codigos=None):
+        """
+        Matriz (n, n) en km; puede ser asimétrica (ida != vuelta).
+        """
+        return matriz_distancias(lats, lons)
+
+    def segmentos(self, lats, lons, codigos=None):
+        """
+        Distancias consecutivas p0->p1, p1->p2, ... (largo n-1) en km.
+        """
+        return distancias_segmentos(lats, lons)
+
+
+class ProveedorMatriz(ProveedorHaversine):
+    """
+    Matriz de viaje por calles precalculada offline: 'valores' (N, N)
+    abierto con np.load(mmap_mode="r") y 'ids' con el COD_LIVE_TRA de cada
+    fila. Solo se leen del archivo las celdas de los PDVs pedidos (nunca
+    la matriz completa); los procesos que abren el mismo archivo comparten
+    las páginas en memoria. Pares con algún COD desconocido: haversine.
+    """
+
+    usa_codigos = True
+
+    def __init__(self, valores, ids, factor: float = 1.0, origen: dict = None):
+        if valores.ndim != 2 or valores.shape[0] != valores.shape[1]:
+            raise ValueError(f"La matriz debe ser cuadrada, llegó {valores.shape}")
+        if len(ids) != valores.shape[0]:
+            raise ValueError(f"{len(ids)} ids para una matriz de {valores.shape[0]} filas")
+        self.valores = valores
+        self.factor = factor
+        # COD -> fila (como str: el maestro puede traer int o str)
+        self.indice = pd.Index(np.asarray(ids).astype(str))
+        if not self.indice.is_unique:
+            raise ValueError("Hay COD_LIVE_TRA repetidos en los ids de la matriz")
+        # Archivos de los que se cargó (ver desde_archivo); sin ellos la
+        # huella se calcula del contenido
+        self.origen = origen
+        self._huella = None
+
+    @classmethod
+    def desde_archivo(cls, ruta: str, ruta_ids: str = None, unidad: str = "min",
+                      velocidad_kmh: float = 20):
+        ruta_ids = ruta_ids or _ruta_ids(ruta)
+        # Estado de los archivos al cargarlos: reemplazar la matriz en disco
+        # no cambia lo que ya quedó mapeado en este proceso
+        origen = {nombre: _estado_archivo(r) for nombre, r in (("matriz", ruta), ("ids", ruta_ids))}
+        valores = np.load(ruta, mmap_mode="r")
+        ids = np.load(ruta_ids, allow_pickle=False)
+        return cls(valores, ids, factor_km(unidad, velocidad_kmh), origen=origen)
+
+    def huella(self) -> dict:
+        """
+        Proveedor, factor a km y, según cómo se cargó, ruta, tamaño y fecha
+        de modificación de sus archivos o un hash del contenido (una vez).
+        """
+        if self._huella is None:
+            huella = {"proveedor": PROVEEDOR_MATRIZ, "factor_km": self.factor}
+            if self.origen is not None:
+                huella.update(self.origen)
+            else:
+                contenido = hashlib.blake2b(digest_size=16)
+                contenido.update(str(self.valores.shape).encode())
+                for fila in range(0, self.valores.shape[0], 1024):
+                    contenido.update(np.ascontiguousarray(self.valores[fila:fila + 1024]).tobytes())
+                contenido.update("\n".join(self.indice).encode())
+                huella["contenido"] = contenido.hexdigest()
+            self._huella = huella
+        return self._huella
+
+    def filas(self, codigos):
+        """
+        Fila de cada COD en la matriz (-1 si no está).
+        """
+        return self.indice.get_indexer(np.asarray(codigos).astype(str))
+
+    def matriz(self, lats, lons, codigos=None):
+        if codigos is None:
+            return super().matriz(lats, lons)
+        filas = self.filas(codigos)
+        conocidos = np.flatnonzero(filas >= 0)
+        if len(conocidos) == len(filas):
+            return self._leer(filas, filas)
+
+        resultado = super().matriz(lats, lons)
+        if len(conocidos):
+            resultado[np.ix_(conocidos, conocidos)] = self._leer(filas[conocidos], filas[conocidos])
+        return resultado
+
+    def segmentos(self, lats, lons, codigos=None):
+        if codigos is None or len(codigos) < 2:
+            return super().segmentos(lats, lons)
+        filas = self.filas(codigos)
+        origen, destino = filas[:-1], filas[1:]
+        conocidos = (origen >= 0) & (destino >= 0)
+
+        resultado = super().segmentos(lats, lons) if not conocidos.all() else np.empty(len(origen))
+        resultado[conocidos] = np.asarray(
+            self.valores[origen[conocidos], destino[conocidos]], dtype=np.float64
+        ) * self.factor
+        return resultado
+
+    def _leer(self, filas, columnas):
+        # Indexado avanzado sobre el memory-map: solo se tocan esas celdas
+        return np.asarray(self.valores[np.ix_(filas, columnas)], dtype=np.float64) * self.factor
+
+
+def _ruta_ids(ruta: str) -> str:
+    return (ruta[:-4] if ruta.endswith(".npy") else ruta) + ".ids.npy"
+
+
+def _estado_archivo(ruta: str):
+    estado = os.stat(ruta)
+    return [os.path.abspath(ruta), estado.st_size, estado.st_mtime_ns]
+
+
+def guardar_matriz(ruta: str, codigos, valores, ruta_ids: str = None, dtype=np.float32):
+    """
+    Escribe una matriz precalculada (ej. tiempos de OSRM / Valhalla del
+    maestro completo) en el formato que lee ProveedorMatriz: 'ruta' (.npy
+    (N, N)) y los COD_LIVE_TRA de cada fila en <ruta>.ids.npy.
+    """
+    valores = np.asarray(valores, dtype=dtype)
+    codigos = np.asarray(codigos).astype(str)
+    ProveedorMatriz(valores, codigos)  # mismas validaciones que al leer
+    np.save(ruta, valores)
+    np.save(ruta_ids or _ruta_ids(ruta), codigos)
+
+
+# =========================
+# PROVEEDOR DEL PROCESO
+# =========================
+_proveedor = None
+_proveedor_lock = threading.Lock()
+
+
+def proveedor_distancias():
+    """
+    Proveedor configurado en settings (se crea al primer uso en cada
+    proceso; la matriz queda mapeada, no copiada).
+    """
+    global _proveedor
+    with _proveedor_lock:
+        if _proveedor is None:
+            if DISTANCIAS_PROVEEDOR not in PROVEEDORES:
+                raise ValueError(f"Proveedor de distancias no soportado: {DISTANCIAS_PROVEEDOR}. Use uno de {PROVEEDORES}")
+            if DISTANCIAS_PROVEEDOR == PROVEEDOR_MATRIZ:
+                if not DISTANCIAS_MATRIZ_PATH:
+                    raise ValueError("DISTANCIAS_PROVEEDOR = 'MATRIZ' requiere DISTANCIAS_MATRIZ_PATH")
+                _proveedor = ProveedorMatriz.desde_archivo(
+                    DISTANCIAS_MATRIZ_PATH, DISTANCIAS_MATRIZ_IDS_PATH,
+                    unidad=DISTANCIAS_MATRIZ_UNIDAD, velocidad_kmh=DISTANCIAS_MATRIZ_VELOCIDAD_KMH
+                )
+            else:
+                _proveedor = ProveedorHaversine()
+        return _proveedor
+
+
+def huella_distancias() -> dict:
+    """
+    Huella del proveedor activo del proceso (el de settings o el instalado
+    con configurar_proveedor), para claves de cache.
+    """
+    return proveedor_distancias().huella()
+
+
+def configurar_proveedor(nuevo):
+    """
+    Reemplaza el proveedor del proceso (ej. una matriz cargada a mano).
+    """
+    global _proveedor
+    with _proveedor_lock:
+        _proveedor = nuevo
@@ -10,6 +10,7 @@ def reasignar_pdv(payload: dict):
     from_ruta = payload["from_ruta"]
     to_ruta = payload["to_ruta"]
     rango = payload["rango"]
+    secuenciador = payload.get("secuenciador")
 
     rutas = deepcopy(payload["rutas"]) 
 
@@ -24,8 +25,8 @@ def reasignar_pdv(payload: dict):
     ruta_origen["pdvs"].remove(pdv)
     ruta_destino["pdvs"].append(pdv)
 
-    ruta_origen["pdvs"] = optimizar_orden_pdvs(ruta_origen["pdvs"])
-    ruta_destino["pdvs"] = optimizar_orden_pdvs(ruta_destino["pdvs"])
+    ruta_origen["pdvs"] = optimizar_orden_pdvs(ruta_origen["pdvs"], secuenciador=secuenciador)
+    ruta_destino["pdvs"] = optimizar_orden_pdvs(ruta_destino["pdvs"], secuenciador=secuenciador)
 
     for ruta in (ruta_origen, ruta_destino):
         metricas = evaluar_ruta(ruta, rango)
@@ -37,4 +38,170 @@ def reasignar_pdv(payload: dict):
         "mercaderista": mercaderista,
         "rutas": rutas, # Lista completa con las 2 rutas modificadas y las demás intactas
         "mensaje": "Reasignación exitosa"
-    }
\ No newline at end of file
+    }
+
+# =========================
+# EDICIÓN SOBRE PLANES GUARDADOS (deltas)
+# =========================
+# Trabajan sobre la 'data' de un plan del plan_store (copia privada del
+# request) y retornan solo las rutas modificadas.
+
+def buscar_mercaderista(data: dict, mercaderista: str):
+    merc = next((m for m in data["mercaderistas"] if m["mercaderista"] == mercaderista), None)
+    if merc is None:
+        raise LookupError(f"Mercaderista no encontrado: {mercaderista}")
+    return merc
+
+def _buscar_ruta(merc: dict, ruta_id: int):
+    ruta = next((r for r in merc["rutas"] if r["ruta_id"] == ruta_id), None)
+    if ruta is None:
+        raise LookupError(f"Ruta no encontrada: {ruta_id}")
+    return ruta
+
+def _nueva_ruta(merc: dict):
+    ruta = {
+        "ruta_id": max((r["ruta_id"] for r in merc["rutas"]), default=0) + 1,
+        "pdvs": [],
+        "total_pdv": 0,
+        "distancia_total_km": 0,
+        "tiempo_estimado_min": 0,
+        "estado": "NUEVA",
+        "warnings": []
+    }
+    merc["rutas"].append(ruta)
+    merc["num_rutas"] = len(merc["rutas"])
+    return ruta
+
+def recalcular_rutas(rutas, rango: dict, secuenciador: str = None):
+    """
+    Re-secuencia y re-evalúa solo las rutas tocadas por una edición.
+    """
+    for ruta in rutas:
+        ruta["pdvs"] = optimizar_orden_pdvs(ruta["pdvs"], secuenciador=secuenciador)
+        ruta.update(evaluar_ruta(ruta, rango))
+        ruta["total_pdv"] = len(ruta["pdvs"])
+        ruta["editado_manualmente"] = True
+    return rutas
+
+def reasignar_pdv_en_plan(data: dict, mercaderista: str, cod_live_tra, from_ruta: int,
+                          to_ruta: int, secuenciador: str = None):
+    merc = buscar_mercaderista(data, mercaderista)
+    ruta_origen = _buscar_ruta(merc, from_ruta)
+    ruta_destino = _buscar_ruta(merc, to_ruta)
+
+    pdv = next(
+        (p for p in ruta_origen["pdvs"] if str(p["cod_live_tra"]) == str(cod_live_tra)),
+        None
+    )
+    if pdv is None:
+        raise ValueError(f"PDV {cod_live_tra} no está en la ruta {from_ruta}")
+
+    ruta_origen["pdvs"].remove(pdv)
+    ruta_destino["pdvs"].append(pdv)
+
+    return recalcular_rutas([ruta_origen, ruta_destino], merc["rango"], secuenciador)
+
+def reasignar_masivo_en_plan(data: dict, mercaderista: str, codigos_pdv, to_ruta: int,
+                             secuenciador: str = None):
+    """
+    Mueve varios PDVs a una ruta (to_ruta = -1 crea una ruta nueva).
+    """
+    merc = buscar_mercaderista(data, mercaderista)
+    ruta_destino = _nueva_ruta(merc) if to_ruta == -1 else _buscar_ruta(merc, to_ruta)
+
+    # Comparamos como str: el cliente puede mandar int o str
+    codigos = {str(c) for c in codigos_pdv}
+    pdvs_a_mover = []
+    tocadas = []
+
+    for ruta in merc["rutas"]:
+        if ruta is ruta_destino:
+            continue
+        quedan = [p for p in ruta["pdvs"] if str(p["cod_live_tra"]) not in codigos]
+        if len(quedan) != len(ruta["pdvs"]):
+            pdvs_a_mover.extend(p for p in ruta["pdvs"] if str(p["cod_live_tra"]) in codigos)
+            ruta["pdvs"] = quedan
+            tocadas.append(ruta)
+
+    if not pdvs_a_mover:
+        raise ValueError("No se encontraron los PDVs enviados")
+
+    ruta_destino["pdvs"].extend(pdvs_a_mover)
+    tocadas.append(ruta_destino)
+
+    return recalcular_rutas(tocadas, merc["rango"], secuenciador)
+
+def indice_pdvs(merc: dict):
+    """
+    COD_LIVE_TRA (como str) -> [(ruta, posición)] de todas sus visitas,
+    en una sola pasada por las rutas del mercaderista.
+    """
+    indice = {}
+    for ruta in merc["rutas"]:
+        for pos, pdv in enumerate(ruta["pdvs"]):
+            indice.setdefault(str(pdv["cod_live_tra"]), []).append((ruta, pos))
+    return indice
+
+def mover_pdvs_en_plan(data: dict, mercaderista: str, movimientos, secuenciador: str = None):
+    """
+    Movimientos en lote, cada uno {"cod_live_tra", "to_ruta", "from_ruta"?}
+    hacia cualquier ruta. to_ruta negativo crea rutas nuevas: el mismo
+    valor negativo (-1, -2, ...) es la misma ruta nueva dentro del lote.
+    from_ruta solo hace falta si el PDV tiene visitas en varias rutas
+    (BOLSA). Se resuelve todo con un índice cod -> (ruta, posición) y solo
+    se re-secuencian las rutas tocadas.
+    """
+    merc = buscar_mercaderista(data, mercaderista)
+    indice = indice_pdvs(merc)
+    rutas_por_id = {r["ruta_id"]: r for r in merc["rutas"]}
+    nuevas = {}
+
+    quitar = {}      # id(ruta) -> (ruta, posiciones que salen)
+    llegan = {}      # id(ruta) -> (ruta, pdvs que entran)
+    for mov in movimientos:
+        cod = str(mov["cod_live_tra"])
+        visitas = indice.get(cod)
+        if not visitas:
+            raise ValueError(f"PDV {cod} no está en el plan de {mercaderista}")
+
+        from_ruta = mov.get("from_ruta")
+        if from_ruta is not None:
+            visitas = [(r, pos) for r, pos in visitas if r["ruta_id"] == from_ruta]
+            if not visitas:
+                raise ValueError(f"PDV {cod} no está en la ruta {from_ruta}")
+        elif len(visitas) > 1:
+            raise ValueError(f"PDV {cod} está en varias rutas: indique 'from_ruta'")
+        ruta_origen, pos = visitas[0]
+        if pos is None:
+            raise ValueError(f"PDV {cod} se mueve más de una vez en el lote")
+
+        to_ruta = mov["to_ruta"]
+        if to_ruta < 0:
+            if to_ruta not in nuevas:
+                nuevas[to_ruta] = _nueva_ruta(merc)
+            ruta_destino = nuevas[to_ruta]
+        elif to_ruta in rutas_por_id:
+            ruta_destino = rutas_por_id[to_ruta]
+        else:
+            raise LookupError(f"Ruta no encontrada: {to_ruta}")
+
+        if ruta_destino is ruta_origen:
+            continue
+        if any(r is ruta_destino for r, _ in indice[cod]):
+            raise ValueError(f"PDV {cod} ya tiene una visita en la ruta {ruta_destino['ruta_id']}")
+
+        quitar.setdefault(id(ruta_origen), (ruta_origen, set()))[1].add(pos)
+        llegan.setdefault(id(ruta_destino), (ruta_destino, []))[1].append(ruta_origen["pdvs"][pos])
+        # El índice refleja la visita ya movida (posición None: no se mueve de nuevo)
+        indice[cod] = [(r, p) for r, p in indice[cod] if not (r is ruta_origen and p == pos)]
+        indice[cod].append((ruta_destino, None))
+
+    tocadas = {}
+    for ruta, posiciones in quitar.values():
+        ruta["pdvs"] = [p for i, p in enumerate(ruta["pdvs"]) if i not in posiciones]
+        tocadas[id(ruta)] = ruta
+    for ruta, pdvs in llegan.values():
+        ruta["pdvs"].extend(pdvs)
+        tocadas[id(ruta)] = ruta
+
+    return recalcular_rutas(list(tocadas.values()), merc["rango"], secuenciador)
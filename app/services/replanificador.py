@@ -0,0 +1,288 @@
+import math
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from app.services.pdv_store import TablaPDV
+from app.services.clustering_capacitado import clusterizar_capacitado
+from app.services.distances import distancias_desde
+from app.services.metrics import evaluar_ruta
+from app.services.route_optimizer import optimizar_orden_pdvs
+from app.services.rutas_builder import construir_rutas
+from app.services.territory_planner import planificar_bolsa_grandes
+
+# Campos del PDV que se actualizan en sitio (no mueven al PDV de ruta)
+CAMPOS_DESCRIPTIVOS = ("razon_social", "subcanal", "distrito")
+
+# Diferencia de coordenadas (grados) a partir de la cual el PDV se reubica
+TOLERANCIA_COORDENADAS = 1e-7
+
+
+# =========================
+# RE-PLANIFICACIÓN INCREMENTAL (plan previo + maestro nuevo)
+# =========================
+def replanificar(data: dict, df: pd.DataFrame, secuenciador: str = None, capacidad: int = None):
+    """
+    Aplica un maestro nuevo sobre un plan existente sin rehacerlo:
+    - diff por COD_LIVE_TRA contra las rutas del plan;
+    - bajas y PDVs con coordenadas corregidas salen de su ruta;
+    - altas (y reubicados) entran a la ruta más cercana con cupo que aún no
+      tenga al cliente (una visita por ruta; GOLPEO en BOLSA);
+    - solo las rutas tocadas que quedan fuera de rango se re-agrupan, junto
+      con su vecina más cercana (clustering capacitado);
+    - solo las rutas tocadas se re-secuencian y re-evalúan.
+    Mercaderistas nuevos se planifican completos; los que ya no están en el
+    maestro se quitan. Modifica 'data' en sitio y retorna los cambios.
+    """
+    bolsa = data.get("frecuencia") == "TERRITORIO"
+    grupos = dict(tuple(df.groupby("NOMBRE_VENDEDOR")))
+
+    cambios = []
+    mercaderistas = []
+    for merc in data["mercaderistas"]:
+        df_merc = grupos.pop(merc["mercaderista"], None)
+        if df_merc is None:
+            cambios.append({"mercaderista": merc["mercaderista"], "eliminado": True, "rutas": []})
+            continue
+        cambios.append(_replanificar_mercaderista(merc, df_merc, bolsa, secuenciador))
+        mercaderistas.append(merc)
+
+    # Mercaderistas que no estaban en el plan: planificación completa
+    if grupos:
+        df_nuevos = pd.concat(grupos.values())
+        if bolsa:
+            if capacidad is None:
+                capacidad = next(
+                    (m["capacidad_objetivo_usada"] for m in data["mercaderistas"]), None
+                )
+            if capacidad is None:
+                raise ValueError("Indique 'capacidad' para planificar mercaderistas nuevos")
+            # La capacidad guardada ya viene ajustada por sábado
+            nuevos = planificar_bolsa_grandes(df_nuevos, capacidad, data["flex"], sabado_activo=False,
+                                              secuenciador=secuenciador)
+        else:
+            nuevos = construir_rutas(df_nuevos, data["frecuencia"], data["sabado"], data["flex"],
+                                     secuenciador=secuenciador)
+        for merc in nuevos["mercaderistas"]:
+            mercaderistas.append(merc)
+            cambios.append({
+                "mercaderista": merc["mercaderista"],
+                "nuevo": True,
+                "agregados": merc["total_pdv"],
+                "rutas": merc["rutas"]
+            })
+
+    data["mercaderistas"] = mercaderistas
+    return cambios
+
+
+def _replanificar_mercaderista(merc: dict, df_merc: pd.DataFrame, bolsa: bool, secuenciador: str = None):
+    rango = merc["rango"]
+    rutas = merc["rutas"]
+
+    # Maestro nuevo del mercaderista (mismas reglas de coordenadas que el planificador)
+    tabla = TablaPDV.desde_df(df_merc).con_h3(resolution=9)
+    filas = tabla.serializar_pdvs(np.arange(len(tabla)))
+    codigos = [str(fila["cod_live_tra"]) for fila in filas]
+    fila_de = {cod: i for i, cod in enumerate(codigos)}
+    objetivo = tabla.golpeo.tolist() if bolsa else [1] * len(tabla)
+
+    # 1. Diff por COD_LIVE_TRA: dónde está hoy cada cliente en el plan
+    en_plan = defaultdict(list)
+    for ruta in rutas:
+        for pdv in ruta["pdvs"]:
+            en_plan[str(pdv["cod_live_tra"])].append((ruta, pdv))
+
+    quitar = defaultdict(set)      # ruta_id -> id() de los dicts que salen
+    insertar = []                  # (fila en tabla, visitas)
+    tocadas = {}                   # ruta_id -> ruta
+    eliminados = reubicados = 0
+
+    for cod, visitas in en_plan.items():
+        i = fila_de.get(cod)
+        movido = i is not None and (
+            abs(visitas[0][1]["latitud"] - filas[i]["latitud"]) > TOLERANCIA_COORDENADAS
+            or abs(visitas[0][1]["longitud"] - filas[i]["longitud"]) > TOLERANCIA_COORDENADAS
+        )
+        if i is None or movido:
+            sobran = visitas
+            if movido:
+                reubicados += 1
+                insertar.append((i, objetivo[i]))
+            else:
+                eliminados += 1
+        else:
+            # Mismo lugar: datos descriptivos al día y visitas según GOLPEO
+            for ruta, pdv in visitas:
+                for campo in CAMPOS_DESCRIPTIVOS:
+                    if pdv.get(campo) != filas[i][campo]:
+                        pdv[campo] = filas[i][campo]
+                        tocadas[ruta["ruta_id"]] = ruta
+            sobran = visitas[objetivo[i]:]
+            if len(visitas) < objetivo[i]:
+                insertar.append((i, objetivo[i] - len(visitas)))
+
+        for ruta, pdv in sobran:
+            quitar[ruta["ruta_id"]].add(id(pdv))
+
+    agregados = 0
+    for cod, i in fila_de.items():
+        if cod not in en_plan:
+            insertar.append((i, objetivo[i]))
+            agregados += 1
+
+    for ruta in rutas:
+        ids = quitar.get(ruta["ruta_id"])
+        if ids:
+            ruta["pdvs"] = [p for p in ruta["pdvs"] if id(p) not in ids]
+            tocadas[ruta["ruta_id"]] = ruta
+
+    # 2. Inserción en la ruta más cercana con cupo (sin repetir cliente);
+    # centroides, tamaños y clientes por ruta se actualizan a cada alta
+    if insertar and rutas:
+        suma_lat = np.array([sum(p["latitud"] for p in r["pdvs"]) for r in rutas])
+        suma_lon = np.array([sum(p["longitud"] for p in r["pdvs"]) for r in rutas])
+        tamanos = np.array([len(r["pdvs"]) for r in rutas])
+        clientes = [{str(p["cod_live_tra"]) for p in r["pdvs"]} for r in rutas]
+        for i, n_visitas in insertar:
+            pdv = filas[i]
+            vacias = tamanos == 0
+            lats_c = np.where(vacias, pdv["latitud"], suma_lat / np.maximum(tamanos, 1))
+            lons_c = np.where(vacias, pdv["longitud"], suma_lon / np.maximum(tamanos, 1))
+            orden = np.argsort(distancias_desde(pdv["latitud"], pdv["longitud"], lats_c, lons_c), kind="stable")
+            for j in _rutas_destino(orden.tolist(), clientes, tamanos, codigos[i], n_visitas, rango):
+                rutas[j]["pdvs"].append(dict(pdv))
+                tocadas[rutas[j]["ruta_id"]] = rutas[j]
+                suma_lat[j] += pdv["latitud"]
+                suma_lon[j] += pdv["longitud"]
+                tamanos[j] += 1
+                clientes[j].add(codigos[i])
+
+    # 3. Re-agrupar solo las rutas tocadas que cruzaron los límites del rango
+    fuera = [
+        r for r in tocadas.values()
+        if not rango["min"] <= len(r["pdvs"]) <= rango["max"]
+    ]
+    reclusterizadas, eliminadas = [], []
+    if fuera:
+        reclusterizadas, eliminadas = _reclusterizar(merc, fuera, rango)
+        for ruta_id in eliminadas:
+            tocadas.pop(ruta_id, None)
+        for ruta in merc["rutas"]:
+            if ruta["ruta_id"] in reclusterizadas:
+                tocadas[ruta["ruta_id"]] = ruta
+
+    # 4. Re-secuenciar y re-evaluar solo las tocadas
+    for ruta in tocadas.values():
+        ruta["pdvs"] = optimizar_orden_pdvs(ruta["pdvs"], secuenciador=secuenciador)
+        ruta.update(evaluar_ruta(ruta, rango))
+        ruta["total_pdv"] = len(ruta["pdvs"])
+
+    merc["total_pdv"] = sum(len(r["pdvs"]) for r in merc["rutas"])
+    merc["num_rutas"] = len(merc["rutas"])
+    if "clientes_unicos" in merc:
+        merc["clientes_unicos"] = len(tabla)
+
+    return {
+        "mercaderista": merc["mercaderista"],
+        "agregados": agregados,
+        "eliminados": eliminados,
+        "reubicados": reubicados,
+        "rutas_reclusterizadas": sorted(reclusterizadas),
+        "rutas_eliminadas": sorted(eliminadas),
+        "rutas": sorted(tocadas.values(), key=lambda r: r["ruta_id"])
+    }
+
+
+def _rutas_destino(orden, clientes, tamanos, cod: str, n_visitas: int, rango: dict):
+    """
+    Las 'n_visitas' rutas (posiciones en 'orden', de la más cercana a la más
+    lejana) que no tienen al cliente; primero las que tienen cupo bajo
+    rango["max"]. Si no alcanzan las rutas sin el cliente, se completa con
+    las más cercanas.
+    """
+    libres = [j for j in orden if cod not in clientes[j]]
+    elegidas = [j for j in libres if tamanos[j] < rango["max"]][:n_visitas]
+    elegidas += [j for j in libres if j not in elegidas][:n_visitas - len(elegidas)]
+    elegidas += orden[:n_visitas - len(elegidas)]
+    return elegidas
+
+
+def _reclusterizar(merc: dict, fuera, rango: dict):
+    """
+    Junta las rutas fuera de rango con su vecina más cercana y reparte esos
+    PDVs en la cantidad de rutas que el rango pide (clustering capacitado).
+    Reutiliza los ruta_id del grupo; si hacen falta más rutas se crean y si
+    sobran se eliminan. Retorna (ids re-agrupados, ids eliminados).
+    """
+    rutas = merc["rutas"]
+    ids_fuera = {r["ruta_id"] for r in fuera}
+    centroides = {
+        r["ruta_id"]: (np.mean([p["latitud"] for p in r["pdvs"]]), np.mean([p["longitud"] for p in r["pdvs"]]))
+        for r in rutas if r["pdvs"]
+    }
+
+    grupo = set(ids_fuera)
+    for r in fuera:
+        if r["ruta_id"] not in centroides:
+            continue
+        lat, lon = centroides[r["ruta_id"]]
+        otras = [rid for rid in centroides if rid not in ids_fuera]
+        if otras:
+            dists = distancias_desde(lat, lon, *map(np.array, zip(*(centroides[rid] for rid in otras))))
+            grupo.add(otras[int(np.argmin(dists))])
+
+    miembros = [r for r in rutas if r["ruta_id"] in grupo]
+    pdvs = [p for r in miembros for p in r["pdvs"]]
+    total = len(pdvs)
+
+    # Clientes únicos del grupo: sus visitas (GOLPEO en BOLSA) viajan como
+    # peso, igual que en el planificador
+    codigos = pd.Series([str(p["cod_live_tra"]) for p in pdvs])
+    cliente_de, unicos = pd.factorize(codigos)
+    visitas = np.bincount(cliente_de, minlength=len(unicos))
+
+    # Rutas para el grupo: cerca del promedio, dentro de [min, max] si se
+    # puede, y nunca menos que las visitas de un cliente (no se repite en
+    # una ruta)
+    k = round(total / rango["promedio"]) if rango["promedio"] else 1
+    k = min(k, math.floor(total / rango["min"])) if rango["min"] else k
+    k = max(k, math.ceil(total / rango["max"]), int(visitas.max()) if total else 0, 1 if total else 0)
+
+    ids = sorted(grupo)
+    siguiente = max(r["ruta_id"] for r in rutas) + 1
+    while len(ids) < k:
+        ids.append(siguiente)
+        siguiente += 1
+    ids, eliminadas = ids[:k], ids[k:]
+
+    nuevas = []
+    if total:
+        primera = np.unique(cliente_de, return_index=True)[1]
+        tabla = TablaPDV(
+            lat=np.array([pdvs[i]["latitud"] for i in primera]),
+            lon=np.array([pdvs[i]["longitud"] for i in primera]),
+            id=np.arange(len(unicos), dtype=np.int64),
+        )
+        nuevas = clusterizar_capacitado(tabla, k, rango, pesos=visitas)
+
+    # Cada aparición de un cliente en una ruta toma una de sus visitas
+    pendientes = defaultdict(list)
+    for pdv, cliente in zip(pdvs, cliente_de.tolist()):
+        pendientes[cliente].append(pdv)
+
+    por_id = {r["ruta_id"]: r for r in miembros}
+    plantilla = miembros[0] if miembros else {}
+    resultado = []
+    for ruta_id, cluster in zip(ids, nuevas):
+        ruta = por_id.get(ruta_id) or {
+            **{c: v for c, v in plantilla.items() if c not in ("pdvs",)},
+            "ruta_id": ruta_id
+        }
+        ruta["pdvs"] = [pendientes[i].pop() for i in cluster["idx"].tolist()]
+        resultado.append(ruta)
+
+    merc["rutas"] = [r for r in rutas if r["ruta_id"] not in grupo] + resultado
+    merc["rutas"].sort(key=lambda r: r["ruta_id"])
+    return [r["ruta_id"] for r in resultado], eliminadas
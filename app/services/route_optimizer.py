@@ -1,74 +1,411 @@
 import math
+import time
 
-# Mantenemos tu función Haversine tal cual
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371
-    lat1, lon1 = math.radians(lat1), math.radians(lon1)
-    lat2, lon2 = math.radians(lat2), math.radians(lon2)
+import numpy as np
+import pandas as pd
+from ortools.constraint_solver import pywrapcp, routing_enums_pb2
+from sklearn.neighbors import KDTree
 
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
+from app.config.settings import (
+    TSP_VECINOS,
+    TSP_TIEMPO_MAX_SEG,
+    SECUENCIADOR_DEFAULT,
+    ORTOOLS_TIEMPO_MAX_SEG,
+    ORTOOLS_MIN_PDVS,
+    COUBICADOS_ACTIVO,
+)
+from app.services.distances import coordenadas_pdvs, proyectar_km
+from app.services.proveedor_distancias import proveedor_distancias
+from app.services.coubicados import agrupar_coubicados, miembros_por_nodo
+from app.core.telemetria import medido
 
-    a = math.sin(dlat / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
+SECUENCIADOR_LOCAL = "LOCAL"
+SECUENCIADOR_ORTOOLS = "ORTOOLS"
+SECUENCIADORES = (SECUENCIADOR_LOCAL, SECUENCIADOR_ORTOOLS)
 
-def optimizar_orden_pdvs(pdvs):
+# Mejora mínima (km) para aceptar un movimiento; evita ciclos por redondeo
+EPS_MEJORA = 1e-9
+
+# Hasta este tamaño se precalcula la matriz completa (consultas O(1) en Python);
+# por encima se calcula cada distancia al vuelo para no gastar O(n²) memoria
+MATRIZ_MAX_NODOS = 600
+
+
+def _listas_vecinos(x, y, k):
     """
-    Optimiza la ruta usando 'Nearest Neighbor' (Vecino más cercano).
-    Esto evita el 'bucle de retorno' de OR-Tools y crea un camino 
-    de serpiente mucho más natural para caminar.
+    Para cada punto, sus k vecinos más cercanos (sin incluirse a sí mismo),
+    con una sola consulta batch al KD-tree sobre coordenadas proyectadas.
+    """
+    n = len(x)
+    k = min(k, n - 1)
+    xy = np.column_stack((x, y))
+    _, idx = KDTree(xy).query(xy, k=k + 1)
+    vecinos = []
+    for i, fila in enumerate(idx.tolist()):
+        vecinos.append([j for j in fila if j != i][:k])
+    return vecinos
+
+
+def _tour_vecino_mas_cercano(x, y, vecinos, start):
+    """
+    Vecino más cercano usando primero la lista del KD-tree; solo si todos
+    esos vecinos ya fueron visitados se hace búsqueda completa (vectorizada)
+    sobre los pendientes.
+    """
+    n = len(x)
+    visitado = np.zeros(n, dtype=bool)
+    visitado[start] = True
+    tour = [start]
+    actual = start
+
+    for _ in range(n - 1):
+        siguiente = next((j for j in vecinos[actual] if not visitado[j]), None)
+        if siguiente is None:
+            pendientes = np.flatnonzero(~visitado)
+            d = np.hypot(x[pendientes] - x[actual], y[pendientes] - y[actual])
+            siguiente = int(pendientes[np.argmin(d)])
+        visitado[siguiente] = True
+        tour.append(siguiente)
+        actual = siguiente
+
+    return tour
+
+
+def _pasada_2opt(tour, pos, dist, vecinos, activos, deadline):
+    """
+    2-opt de camino abierto restringido a listas de vecinos.
+    Para cada arista (a,b) prueba invertir un tramo de modo que entre una
+    arista nueva (a,c) o (b,c) con c vecino cercano; si j+1 no existe
+    (final abierto) solo se paga una arista. La posición 0 nunca se mueve.
+    Los extremos de cada inversión se marcan en 'activos' para el Or-opt.
+    """
+    n = len(tour)
+    mejoro = False
+
+    def invertir(i, j):
+        tour[i:j + 1] = tour[i:j + 1][::-1]
+        for k in range(i, j + 1):
+            pos[tour[k]] = k
+        activos.update(tour[max(i - 1, 0):i + 1])
+        activos.update(tour[j:j + 2])
+
+    for i in range(n - 1):
+        if time.perf_counter() > deadline:
+            break
+        a, b = tour[i], tour[i + 1]
+        d_ab = dist(a, b)
+        movido = False
+
+        # Nueva arista (a, c): invierte el tramo entre b y c
+        for c in vecinos[a]:
+            d_ac = dist(a, c)
+            # Listas ordenadas por cercanía: si la nueva arista ya no es más
+            # corta que la que se quita, ningún vecino siguiente puede mejorar
+            if d_ac >= d_ab:
+                break
+            j = pos[c]
+            if j > i + 1:
+                # a b ... c d  ->  a c ... b d
+                delta = d_ac - d_ab
+                if j + 1 < n:
+                    d = tour[j + 1]
+                    delta += dist(b, d) - dist(c, d)
+                if delta < -EPS_MEJORA:
+                    invertir(i + 1, j)
+                    movido = True
+                    break
+            elif j < i:
+                # c e ... a b  ->  c a ... e b
+                e = tour[j + 1]
+                delta = d_ac + dist(e, b) - dist(c, e) - d_ab
+                if delta < -EPS_MEJORA:
+                    invertir(j + 1, i)
+                    movido = True
+                    break
+
+        if movido:
+            mejoro = True
+            continue
+
+        # Nueva arista (b, c): a b ... e c  ->  a e ... b c
+        for c in vecinos[b]:
+            d_bc = dist(b, c)
+            if d_bc >= d_ab:
+                break
+            j = pos[c] - 1
+            if j > i + 1:
+                e = tour[j]
+                delta = d_bc + dist(a, e) - dist(e, c) - d_ab
+                if delta < -EPS_MEJORA:
+                    invertir(i + 1, j)
+                    mejoro = True
+                    break
+
+    return mejoro
+
+
+def _pasada_or_opt(tour, pos, dist, vecinos, activos, deadline):
+    """
+    Or-opt: reubica segmentos de 1 a 3 PDVs (en cualquier orientación) junto
+    a alguno de los vecinos de sus extremos. La posición 0 nunca se mueve.
+    'activos' son los "don't look bits": solo se evalúan segmentos que
+    empiezan en un nodo cuyo entorno cambió desde la última vez.
+    """
+    n = len(tour)
+    mejoro = False
+
+    for largo in (1, 2, 3):
+        s = 1
+        while s + largo - 1 < n:
+            if time.perf_counter() > deadline:
+                return mejoro
+            e = s + largo - 1
+            if tour[s] not in activos and tour[e] not in activos:
+                s += 1
+                continue
+            p, x, y = tour[s - 1], tour[s], tour[e]
+            nx = tour[e + 1] if e + 1 < n else None
+
+            # Lo que se ahorra al sacar el segmento (y unir p con nx)
+            ahorro = dist(p, x)
+            if nx is not None:
+                ahorro += dist(y, nx) - dist(p, nx)
+
+            mejor = None
+            mejor_delta = -EPS_MEJORA
+            for ancla in (x, y):
+                for u in vecinos[ancla]:
+                    ju = pos[u]
+                    if s - 1 <= ju <= e:
+                        continue
+                    v = tour[ju + 1] if ju + 1 < n else None
+                    for primero, ultimo in ((x, y), (y, x)):
+                        costo = dist(u, primero)
+                        if v is not None:
+                            costo += dist(ultimo, v) - dist(u, v)
+                        delta = costo - ahorro
+                        if delta < mejor_delta:
+                            mejor_delta = delta
+                            mejor = (ju, primero != x)
+
+            if mejor is not None:
+                ju, invertir = mejor
+                activos.update((p, x, y, tour[ju]))
+                if nx is not None:
+                    activos.add(nx)
+                if ju + 1 < n:
+                    activos.add(tour[ju + 1])
+                segmento = tour[s:e + 1]
+                if invertir:
+                    segmento.reverse()
+                del tour[s:e + 1]
+                ins = ju + 1 if ju < s else ju + 1 - largo
+                tour[ins:ins] = segmento
+                for k, nodo in enumerate(tour):
+                    pos[nodo] = k
+                mejoro = True
+            elif largo == 3:
+                # Sin mejora con ningún largo: el nodo queda "quieto"
+                activos.discard(x)
+            s += 1
+
+    return mejoro
+
+
+def _tour_ortools(matriz_km, start, tiempo_max_seg):
+    """
+    TSP de camino abierto con OR-Tools Routing.
+    El 'bucle de retorno' se evita con un nodo ficticio de fin a distancia 0
+    de todos: el vehículo sale del PDV más al norte y "termina" donde quiera.
+    Matriz entera en metros (admite ida != vuelta) y Guided Local Search con
+    límite de tiempo. Retorna None si no se encontró solución dentro del límite.
+    """
+    n = len(matriz_km)
+    fin = n
+
+    matriz_m = np.zeros((n + 1, n + 1), dtype=np.int64)
+    matriz_m[:n, :n] = np.rint(matriz_km * 1000)
+
+    manager = pywrapcp.RoutingIndexManager(n + 1, 1, [start], [fin])
+    routing = pywrapcp.RoutingModel(manager)
+    transito = routing.RegisterTransitMatrix(matriz_m.tolist())
+    routing.SetArcCostEvaluatorOfAllVehicles(transito)
+
+    params = pywrapcp.DefaultRoutingSearchParameters()
+    params.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
+    params.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
+    params.time_limit.FromMilliseconds(max(1, int(tiempo_max_seg * 1000)))
+
+    solucion = routing.SolveWithParameters(params)
+    if solucion is None:
+        return None
+
+    tour = []
+    index = routing.Start(0)
+    while not routing.IsEnd(index):
+        tour.append(manager.IndexToNode(index))
+        index = solucion.Value(routing.NextVar(index))
+    return tour
+
+
+def optimizar_orden_pdvs(pdvs, tiempo_max_seg: float = None, secuenciador: str = None):
+    """
+    Ordena una ruta de PDVs (dicts) y les asigna 'orden'. Ver secuenciar().
     """
-    
-    # 1. Validaciones básicas
     if not pdvs:
         return []
-    if len(pdvs) <= 2:
-        for i, p in enumerate(pdvs, 1):
-            p["orden"] = i
-        return pdvs
+    lats, lons = coordenadas_pdvs(pdvs)
+    codigos = [p["cod_live_tra"] for p in pdvs] if proveedor_distancias().usa_codigos else None
+    tour = secuenciar(lats, lons, tiempo_max_seg=tiempo_max_seg, secuenciador=secuenciador, codigos=codigos)
+    return _asignar_orden([pdvs[i] for i in tour])
+
+
+@medido("secuenciacion")
+def secuenciar(lats, lons, tiempo_max_seg: float = None, secuenciador: str = None, codigos=None,
+               nodos=None):
+    """
+    Optimiza el orden de visita como camino abierto (sin retorno al inicio)
+    y retorna el tour como lista de posiciones en (lats, lons):
+    1. Inicio fijo en el PDV más al norte.
+    2. Tour inicial por 'Nearest Neighbor' con KD-tree sobre coordenadas proyectadas.
+    3. Según 'secuenciador':
+       - LOCAL: mejora 2-opt + Or-opt con listas de vecinos, hasta que no haya
+         mejora o se agote el presupuesto de tiempo de la ruta.
+       - ORTOOLS: TSP abierto (nodo ficticio de fin) con Guided Local Search.
+         Solo para rutas de ORTOOLS_MIN_PDVS o más; si el límite de tiempo
+         vence sin solución se usa el orden voraz.
+    Los costos salen del proveedor de distancias ('codigos' = COD_LIVE_TRA
+    de cada punto, para una matriz por calles). El inicio voraz y las
+    listas de vecinos siguen siendo geométricos (KD-tree); 2-opt / Or-opt
+    usan el promedio ida/vuelta, ya que invierten tramos.
+    Los PDVs de un mismo nodo co-ubicado se secuencian como un solo punto
+    y se visitan seguidos (ver _ordenar_miembros). 'nodos': nodo de cada
+    punto (ej. TablaPDV.nodo); sin él, con COUBICADOS_ACTIVO se calcula
+    aquí (rutas editadas, ver agrupar_coubicados).
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if len(lats) > 2 and (nodos is not None or COUBICADOS_ACTIVO):
+        if nodos is not None:
+            nodo_de, unicos = pd.factorize(np.asarray(nodos))
+            n_nodos = len(unicos)
+        else:
+            nodo_de, n_nodos = agrupar_coubicados(lats, lons)
+        if n_nodos < len(lats):
+            miembros = miembros_por_nodo(nodo_de, n_nodos)
+            representantes = np.array([m[0] for m in miembros])
+            if codigos is not None:
+                codigos = np.asarray(codigos, dtype=object)[representantes]
+            tour = _secuenciar_puntos(
+                lats[representantes], lons[representantes], tiempo_max_seg, secuenciador, codigos
+            )
+            return _ordenar_miembros(tour, miembros, representantes, lats, lons)
+    return _secuenciar_puntos(lats, lons, tiempo_max_seg, secuenciador, codigos)
+
+
+def _ordenar_miembros(tour, miembros, representantes, lats, lons):
+    """
+    Expande el tour de nodos a sus PDVs. Dentro de un nodo (a metros entre
+    sí) se avanza en la dirección del nodo anterior al siguiente: se entra
+    por el lado que mira al anterior y se sale hacia el siguiente.
+    """
+    x, y = proyectar_km(lats, lons)
+    orden = []
+    for posicion, nodo in enumerate(tour):
+        grupo = miembros[nodo]
+        if len(grupo) > 1:
+            desde = representantes[tour[posicion - 1]] if posicion > 0 else representantes[nodo]
+            hacia = representantes[tour[posicion + 1]] if posicion + 1 < len(tour) else representantes[nodo]
+            dx, dy = x[hacia] - x[desde], y[hacia] - y[desde]
+            if dx or dy:
+                grupo = grupo[np.argsort(x[grupo] * dx + y[grupo] * dy, kind="stable")]
+        orden.extend(grupo.tolist())
+    return orden
+
+
+def _secuenciar_puntos(lats, lons, tiempo_max_seg, secuenciador, codigos):
+    """
+    Núcleo de secuenciar() sobre puntos ya distintos.
+    """
+    n = len(lats)
+
+    # 1. Validaciones básicas
+    if n <= 2:
+        return list(range(n))
+
+    if not secuenciador:
+        secuenciador = SECUENCIADOR_DEFAULT
+    if secuenciador not in SECUENCIADORES:
+        raise ValueError(f"Secuenciador no soportado: {secuenciador}. Use uno de {SECUENCIADORES}")
+    usar_ortools = secuenciador == SECUENCIADOR_ORTOOLS and n >= ORTOOLS_MIN_PDVS
+
+    if tiempo_max_seg is None:
+        tiempo_max_seg = ORTOOLS_TIEMPO_MAX_SEG if usar_ortools else TSP_TIEMPO_MAX_SEG
+    deadline = time.perf_counter() + tiempo_max_seg
 
     # 2. ESTRATEGIA DE INICIO:
     # Para evitar que empiece en el medio y haga espirales, forzamos
     # el inicio en el punto más al NORTE (Mayor Latitud).
     # En Perú (Hemisferio Sur), mayor latitud (más cercano a 0) es más al Norte.
     # Esto garantiza un "barrido" ordenado de arriba a abajo.
-    start_node = max(pdvs, key=lambda p: p['latitud'])
-    
-    ruta_ordenada = [start_node]
-    
-    # Creamos una lista de pendientes (excluyendo el inicial)
-    pendientes = [p for p in pdvs if p != start_node]
-
-    current_node = start_node
-
-    # 3. ALGORITMO VORAZ (GREEDY)
-    while pendientes:
-        # Buscamos el punto más cercano al actual
-        # Usamos tu función haversine para calcular la distancia real
-        siguiente_mas_cercano = min(
-            pendientes,
-            key=lambda p: haversine(
-                current_node['latitud'], current_node['longitud'], 
-                p['latitud'], p['longitud']
-            )
-        )
-        
-        # Lo agregamos a la ruta y lo sacamos de pendientes
-        ruta_ordenada.append(siguiente_mas_cercano)
-        pendientes.remove(siguiente_mas_cercano)
-        
-        # Avanzamos
-        current_node = siguiente_mas_cercano
-
-    # 4. ASIGNAR ORDEN FINAL
+    start = int(np.argmax(lats))
+
+    x, y = proyectar_km(lats, lons)
+    vecinos = _listas_vecinos(x, y, TSP_VECINOS)
+
+    # 3. TOUR INICIAL (GREEDY)
+    tour = _tour_vecino_mas_cercano(x, y, vecinos, start)
+
+    proveedor = proveedor_distancias()
+    por_calles = proveedor.usa_codigos and codigos is not None
+
+    # 4A. OR-TOOLS (si no hay solución a tiempo, queda el voraz)
+    if usar_ortools:
+        matriz_km = proveedor.matriz(lats, lons, codigos if por_calles else None)
+        return _tour_ortools(matriz_km, start, tiempo_max_seg) or tour
+
+    # 4B. MEJORA LOCAL (2-opt + Or-opt)
+    if por_calles and n <= MATRIZ_MAX_NODOS:
+        matriz_km = proveedor.matriz(lats, lons, codigos)
+        matriz = ((matriz_km + matriz_km.T) / 2).tolist()
+
+        def dist(i, j):
+            return matriz[i][j]
+    elif n <= MATRIZ_MAX_NODOS:
+        matriz = np.hypot(x[:, None] - x[None, :], y[:, None] - y[None, :]).tolist()
+
+        def dist(i, j):
+            return matriz[i][j]
+    else:
+        xs, ys = x.tolist(), y.tolist()
+
+        def dist(i, j):
+            return math.hypot(xs[i] - xs[j], ys[i] - ys[j])
+
+    pos = [0] * len(tour)
+    for k, nodo in enumerate(tour):
+        pos[nodo] = k
+
+    activos = set(tour)
+
+    # 2-opt hasta converger; Or-opt (más caro) solo sobre un tour ya sin cruces
+    while time.perf_counter() <= deadline:
+        while _pasada_2opt(tour, pos, dist, vecinos, activos, deadline):
+            pass
+        if not _pasada_or_opt(tour, pos, dist, vecinos, activos, deadline):
+            break
+
+    return tour
+
+
+def _asignar_orden(ruta_ordenada):
+    # ASIGNAR ORDEN FINAL
     for i, pdv in enumerate(ruta_ordenada, 1):
         pdv["orden"] = i
-
     return ruta_ordenada
 
 def ordenar_y_marcar(pdvs):
     """
     Wrapper estable para el sistema
     """
-    return optimizar_orden_pdvs(pdvs)
\ No newline at end of file
+    return optimizar_orden_pdvs(pdvs)
@@ -0,0 +1,374 @@
+import math
+import time
+from collections import Counter
+
+import numpy as np
+from sklearn.neighbors import KDTree
+
+from app.config.settings import (
+    BUSQUEDA_LOCAL_VECINOS,
+    BUSQUEDA_LOCAL_MAX_RONDAS,
+    BUSQUEDA_LOCAL_TIEMPO_MAX_SEG,
+    BUSQUEDA_LOCAL_PESO_CARGA_KM,
+)
+from app.services.distances import proyectar_km
+from app.core.telemetria import medido
+
+# Largo esperado de un TSP sobre n puntos en un área A: ~0.7124·sqrt(n·A)
+# (Beardwood–Halton–Hammersley). Con A ≈ 2π·SSE/n (SSE = suma de distancias²
+# al centroide) queda largo ≈ 1.79·sqrt(SSE), que se actualiza en O(1).
+FACTOR_LONGITUD = 0.7124 * math.sqrt(2 * math.pi)
+
+# Mejora mínima (km equivalentes) para aceptar un movimiento
+EPS_MEJORA = 1e-9
+
+# Candidatos re-evaluados por ronda (por ruta)
+CANDIDATOS_POR_RUTA = 4
+
+# PDVs más cercanos (de cualquier ruta) que se revisan para ubicar los dos
+# vecinos de un PDV dentro de una ruta (costo de inserción)
+VECINOS_INSERCION = 16
+
+
+def _costo(n, sx, sy, s2, promedio, peso_carga):
+    """
+    Costo de una ruta a partir de sus sumas (vectorizado):
+    largo estimado + penalización cuadrática por desvío de carga.
+    """
+    sse = np.maximum(s2 - (sx * sx + sy * sy) / np.maximum(n, 1), 0.0)
+    return FACTOR_LONGITUD * np.sqrt(sse) + peso_carga * (n - promedio) ** 2
+
+
+def _costo_escalar(n, sx, sy, s2, promedio, peso_carga):
+    # Igual que _costo para una sola ruta (sin overhead de NumPy)
+    sse = s2 - (sx * sx + sy * sy) / n if n > 0 else 0.0
+    return FACTOR_LONGITUD * math.sqrt(sse if sse > 0 else 0.0) + peso_carga * (n - promedio) ** 2
+
+
+def _exceso(n, minimo, maximo):
+    # PDVs fuera de rango (0 si la ruta está dentro de [min, max])
+    return np.maximum(n - maximo, 0) + np.maximum(minimo - n, 0)
+
+
+def _exceso_escalar(n, minimo, maximo):
+    return max(n - maximo, 0) + max(minimo - n, 0)
+
+
+def _fronteras(x, y, ruta_de, vecinas, cx, cy):
+    """
+    frontera[r, j]: punto de la ruta r más cercano al centroide de su j-ésima
+    vecina. Mínimo agrupado con reduceat sobre los puntos ordenados por ruta
+    (todas las rutas tienen al menos un PDV).
+    """
+    orden = np.argsort(ruta_de, kind="stable")
+    inicios = np.concatenate(([0], np.cumsum(np.bincount(ruta_de, minlength=len(vecinas)))[:-1]))
+    vec_p = vecinas[ruta_de[orden]]
+    d = np.hypot(x[orden, None] - cx[vec_p], y[orden, None] - cy[vec_p])
+    minimos = np.minimum.reduceat(d, inicios, axis=0)
+    posicion = np.where(
+        d == np.repeat(minimos, np.diff(np.append(inicios, len(orden))), axis=0),
+        np.arange(len(orden))[:, None],
+        len(orden)
+    )
+    return orden[np.minimum.reduceat(posicion, inicios, axis=0)]
+
+
+@medido("busqueda_local")
+def mejorar_rutas(rutas, rango, tabla, vecinos: int = None, max_rondas: int = None,
+                  tiempo_max_seg: float = None, peso_carga_km: float = None, pesos=None):
+    """
+    Búsqueda local entre rutas vecinas (después del balanceo).
+    Listas de candidatos granulares: cada ruta solo interactúa con sus k
+    rutas más cercanas (KD-tree sobre centroides).
+    - RELOCATE: mover un PDV a una de las k rutas vecinas de la suya.
+    - SWAP: intercambiar los PDVs frontera de dos rutas vecinas (el de cada
+      una más cercano al centroide de la otra).
+    Cada ruta se resume en sumas (n, Σx, Σy, Σx²+y²) sobre coordenadas
+    proyectadas en km, así el delta de costo (largo estimado + desvío de
+    carga) de cualquier movimiento es O(1). Por ronda se evalúan en bloque
+    (NumPy) los candidatos de rutas que cambiaron y se aplican los que
+    mejoran, de mejor a peor, re-evaluando cada uno contra las sumas vigentes.
+    El largo estimado solo preselecciona: cada movimiento se valida con el
+    costo de inserción de sus PDVs entre sus dos vecinos más cercanos de
+    cada ruta (km de recorrido, ver km_en) más el desvío de carga, y se
+    aplica solo si ese total baja. Así la etapa no cambia km de recorrido
+    por balance salvo lo que pague 'peso_carga_km'.
+    Nunca aumenta los PDVs fuera de rango ni repite un cliente (GOLPEO) en
+    una ruta. Corta por rondas o por tiempo, lo que ocurra primero.
+    'rutas' son rutas internas ({"idx": posiciones en 'tabla'}); se modifican
+    en sitio y se retornan.
+    'pesos' (opcional, por fila de 'tabla'): carga de cada punto, p. ej.
+    GOLPEO cuando cada fila es un cliente y no una visita. La carga de una
+    ruta (y su total_pdv) pasa a ser la suma de pesos; los centroides y la
+    dispersión también se ponderan.
+    """
+    if vecinos is None:
+        vecinos = BUSQUEDA_LOCAL_VECINOS
+    if max_rondas is None:
+        max_rondas = BUSQUEDA_LOCAL_MAX_RONDAS
+    if tiempo_max_seg is None:
+        tiempo_max_seg = BUSQUEDA_LOCAL_TIEMPO_MAX_SEG
+    if peso_carga_km is None:
+        peso_carga_km = BUSQUEDA_LOCAL_PESO_CARGA_KM
+
+    n_rutas = len(rutas)
+    k = min(vecinos, n_rutas - 1)
+    if k < 1 or max_rondas <= 0:
+        return rutas
+    deadline = time.perf_counter() + tiempo_max_seg
+
+    # 1. Puntos planos: posición en tabla, ruta actual y coordenadas en km
+    puntos = np.concatenate([r["idx"] for r in rutas])
+    ruta_de = np.repeat(np.arange(n_rutas), [len(r["idx"]) for r in rutas])
+    total = len(puntos)
+
+    x, y = proyectar_km(tabla.lat[puntos], tabla.lon[puntos])
+    q2 = x * x + y * y
+    # Peso (carga) de cada punto: 1 por visita salvo que se indique
+    w = np.ones(total) if pesos is None else np.asarray(pesos, dtype=np.float64)[puntos]
+
+    n = np.bincount(ruta_de, weights=w, minlength=n_rutas)
+    sx = np.bincount(ruta_de, weights=w * x, minlength=n_rutas)
+    sy = np.bincount(ruta_de, weights=w * y, minlength=n_rutas)
+    s2 = np.bincount(ruta_de, weights=w * q2, minlength=n_rutas)
+
+    promedio = rango["promedio"]
+    minimo, maximo = rango["min"], rango["max"]
+
+    # 2. Rutas vecinas: k centroides más cercanos (sin incluirse a sí misma)
+    centros = np.column_stack((sx / n, sy / n))
+    _, vecinas = KDTree(centros).query(centros, k=k + 1)
+    vecinas = np.array([[v for v in fila if v != r][:k] for r, fila in enumerate(vecinas.tolist())])
+
+    # Para el par (a, j-ésima vecina b): posición de a en la lista de b (-1 si no está)
+    coincide = vecinas[vecinas] == np.arange(n_rutas)[:, None, None]
+    inversa = np.where(coincide.any(axis=2), coincide.argmax(axis=2), -1)
+
+    # Clientes repetidos (GOLPEO): contamos visitas por (ruta, cliente)
+    clientes = tabla.id[puntos].tolist()
+    hay_repetidos = len(set(clientes)) < total
+    visitas = Counter(zip(ruta_de.tolist(), clientes)) if hay_repetidos else None
+
+    # La fase de aplicación es escalar: listas de Python (acceso O(1) barato)
+    xl, yl, q2l, wl = x.tolist(), y.tolist(), q2.tolist(), w.tolist()
+    # Sumas ponderadas de cada punto (lo que aporta a las sumas de su ruta)
+    wx, wy, wq2 = w * x, w * y, w * q2
+    wxl, wyl, wq2l = wx.tolist(), wy.tolist(), wq2.tolist()
+
+    # Vecinos de cada punto para validar con el costo de inserción; se
+    # consultan solo para los candidatos, la primera vez que aparecen
+    arbol_puntos = KDTree(np.column_stack((x, y)))
+    k_insercion = min(VECINOS_INSERCION + 1, total)
+    vecinos_de = {}
+
+    def consultar_vecinos(nuevos):
+        nuevos = [p for p in dict.fromkeys(nuevos) if p not in vecinos_de]
+        if not nuevos:
+            return
+        dist, vec = arbol_puntos.query(np.column_stack((x[nuevos], y[nuevos])), k=k_insercion)
+        for p, d, v in zip(nuevos, dist.tolist(), vec.tolist()):
+            vecinos_de[p] = (v, d)
+
+    def km_en(p, r):
+        """
+        Costo (km) de p dentro de la ruta r sin conocer su secuencia: el
+        recorrido pasa por sus dos vecinos más cercanos de r, así que p
+        cuesta d1 + d2 - d12 (inserción más barata entre ellos). Con un solo
+        vecino a la vista, 2·d1 (se engancha en un extremo); sin ninguno,
+        inf (la ruta le queda lejos).
+        """
+        v1 = d1 = None
+        for v, d in zip(*vecinos_de[p]):
+            if v == p or ruta_l[v] != r:
+                continue
+            if v1 is None:
+                v1, d1 = v, d
+            else:
+                return d1 + d - math.hypot(xl[v1] - xl[v], yl[v1] - yl[v])
+        return 2 * d1 if v1 is not None else math.inf
+
+    def km_ahorro(p):
+        # Lo que ahorra su ruta al sacarlo; sin vecinos de su ruta a la
+        # vista, al menos ida y vuelta hasta el más lejano revisado
+        costo_p = km_en(p, ruta_l[p])
+        return costo_p if costo_p < math.inf else 2 * vecinos_de[p][1][-1]
+
+    def carga(r, dn=0):
+        return peso_carga_km * (nl[r] + dn - promedio) ** 2
+
+    def puede_entrar(cliente, ruta):
+        return visitas is None or visitas[(ruta, cliente)] == 0
+
+    def costo(r, dn=0, dsx=0.0, dsy=0.0, ds2=0.0):
+        return _costo_escalar(nl[r] + dn, sxl[r] + dsx, syl[r] + dsy, s2l[r] + ds2,
+                              promedio, peso_carga_km)
+
+    def mover(punto, de, hacia):
+        ruta_l[punto] = hacia
+        nl[de] -= wl[punto]; sxl[de] -= wxl[punto]; syl[de] -= wyl[punto]; s2l[de] -= wq2l[punto]
+        nl[hacia] += wl[punto]; sxl[hacia] += wxl[punto]; syl[hacia] += wyl[punto]; s2l[hacia] += wq2l[punto]
+        if visitas is not None:
+            visitas[(de, clientes[punto])] -= 1
+            visitas[(hacia, clientes[punto])] += 1
+
+    # Don't-look bits por ruta: solo se re-evalúan candidatos que tocan
+    # alguna ruta que cambió en la ronda anterior
+    activas = np.ones(n_rutas, dtype=bool)
+    # Rutas que cambiaron desde la última vez que se evaluaron los swap
+    pendientes_swap = np.zeros(n_rutas, dtype=bool)
+
+    for _ in range(max_rondas):
+        if time.perf_counter() > deadline:
+            break
+
+        costo_r = _costo(n, sx, sy, s2, promedio, peso_carga_km)
+        exceso_r = _exceso(n, minimo, maximo)
+        cx, cy = sx / np.maximum(n, 1), sy / np.maximum(n, 1)
+
+        # --- RELOCATE: (punto, ruta vecina de la suya) ---
+        filas = np.flatnonzero(activas[ruta_de] | activas[vecinas[ruta_de]].any(axis=1))
+        p = filas[:, None]
+        a = ruta_de[filas][:, None]
+        b = vecinas[ruta_de[filas]]
+        wp = w[p]
+        delta_rel = (
+            _costo(n[a] - wp, sx[a] - wx[p], sy[a] - wy[p], s2[a] - wq2[p], promedio, peso_carga_km)
+            + _costo(n[b] + wp, sx[b] + wx[p], sy[b] + wy[p], s2[b] + wq2[p], promedio, peso_carga_km)
+            - costo_r[a] - costo_r[b]
+        )
+        # Fuera de rango: cambio al sacar p de su ruta y al sumarlo a la vecina
+        no_empeora = (
+            _exceso(n[a] - wp, minimo, maximo) - exceso_r[a]
+            + _exceso(n[b] + wp, minimo, maximo) - exceso_r[b]
+        ) <= 0
+        delta_rel = np.where(no_empeora & (n[a] > wp), delta_rel, np.inf)
+        mejor = np.argmin(delta_rel, axis=1)
+        sel = np.arange(len(filas))
+        delta_rel = delta_rel[sel, mejor]
+        ok_rel = delta_rel < -EPS_MEJORA
+
+        # --- SWAP: frontera de a hacia b <-> frontera de b hacia a ---
+        # Solo cuando los relocate no llenan la ronda (primero se reparte carga)
+        tope = CANDIDATOS_POR_RUTA * n_rutas
+        pa = qb = b_sw = np.empty(0, dtype=np.int64)
+        delta_sw = np.empty(0)
+        pendientes_swap |= activas
+        if ok_rel.sum() < tope:
+            frontera = _fronteras(x, y, ruta_de, vecinas, cx, cy)
+            qb = np.where(inversa >= 0, frontera[vecinas, np.maximum(inversa, 0)], -1)
+            validos = (qb >= 0) & (pendientes_swap[:, None] | pendientes_swap[vecinas])
+            a_sw = np.broadcast_to(np.arange(n_rutas)[:, None], validos.shape)[validos]
+            b_sw, pa, qb = vecinas[validos], frontera[validos], qb[validos]
+            dw, dx, dy, dq2 = w[qb] - w[pa], wx[qb] - wx[pa], wy[qb] - wy[pa], wq2[qb] - wq2[pa]
+            delta_sw = (
+                _costo(n[a_sw] + dw, sx[a_sw] + dx, sy[a_sw] + dy, s2[a_sw] + dq2, promedio, peso_carga_km)
+                + _costo(n[b_sw] - dw, sx[b_sw] - dx, sy[b_sw] - dy, s2[b_sw] - dq2, promedio, peso_carga_km)
+                - costo_r[a_sw] - costo_r[b_sw]
+            )
+            # Con pesos distintos el intercambio también mueve carga
+            no_empeora_sw = (
+                _exceso(n[a_sw] + dw, minimo, maximo) + _exceso(n[b_sw] - dw, minimo, maximo)
+                <= exceso_r[a_sw] + exceso_r[b_sw]
+            )
+            delta_sw = np.where(no_empeora_sw, delta_sw, np.inf)
+            pendientes_swap[:] = False
+        ok_sw = delta_sw < -EPS_MEJORA
+
+        # Candidatos (delta, punto, ruta destino, punto de intercambio o -1)
+        delta_c = np.concatenate((delta_rel[ok_rel], delta_sw[ok_sw]))
+        if not delta_c.size:
+            break
+        punto_c = np.concatenate((filas[ok_rel], pa[ok_sw]))
+        destino_c = np.concatenate((b[sel, mejor][ok_rel], b_sw[ok_sw]))
+        cambio_c = np.concatenate((np.full(int(ok_rel.sum()), -1), qb[ok_sw]))
+
+        # Tras los primeros movimientos de una ruta el resto de sus candidatos
+        # suele quedar obsoleto: solo se re-evalúan los mejores de la ronda
+        if delta_c.size > tope:
+            mejores = np.argpartition(delta_c, tope)[:tope]
+        else:
+            mejores = np.arange(delta_c.size)
+        mejores = mejores[np.argsort(delta_c[mejores], kind="stable")]
+        candidatos = list(zip(
+            punto_c[mejores].tolist(), destino_c[mejores].tolist(), cambio_c[mejores].tolist()
+        ))
+        consultar_vecinos([p for c in candidatos for p in (c[0], c[2]) if p >= 0])
+
+        # 3. Aplicar de mejor a peor. Los movimientos anteriores de la ronda
+        # cambian las sumas: cada uno se re-evalúa exacto (O(1)) antes de aplicarse
+        ruta_l = ruta_de.tolist()
+        nl, sxl, syl, s2l = n.tolist(), sx.tolist(), sy.tolist(), s2.tolist()
+        activas = np.zeros(n_rutas, dtype=bool)
+        aplicados = 0
+
+        for i, (pm, rb, qm) in enumerate(candidatos):
+            if not i % 256 and time.perf_counter() > deadline:
+                break
+            ra = ruta_l[pm]
+
+            if qm < 0:
+                # RELOCATE pm: ra -> rb
+                wm = wl[pm]
+                if ra == rb or nl[ra] <= wm:
+                    continue
+                exceso_antes = _exceso_escalar(nl[ra], minimo, maximo) + _exceso_escalar(nl[rb], minimo, maximo)
+                exceso_despues = (
+                    _exceso_escalar(nl[ra] - wm, minimo, maximo)
+                    + _exceso_escalar(nl[rb] + wm, minimo, maximo)
+                )
+                delta = (
+                    costo(ra, -wm, -wxl[pm], -wyl[pm], -wq2l[pm])
+                    + costo(rb, wm, wxl[pm], wyl[pm], wq2l[pm])
+                    - costo(ra) - costo(rb)
+                )
+                if (delta >= -EPS_MEJORA or exceso_despues > exceso_antes
+                        or not puede_entrar(clientes[pm], rb)):
+                    continue
+                # Validación con el costo de inserción (km) + desvío de carga
+                km = km_en(pm, rb) - km_ahorro(pm)
+                if km + carga(ra, -wm) + carga(rb, wm) - carga(ra) - carga(rb) >= -EPS_MEJORA:
+                    continue
+                mover(pm, ra, rb)
+            else:
+                # SWAP pm (ra) <-> qm (rb)
+                rb = ruta_l[qm]
+                if ra == rb:
+                    continue
+                dw_m = wl[qm] - wl[pm]
+                dx_m, dy_m, dq2_m = wxl[qm] - wxl[pm], wyl[qm] - wyl[pm], wq2l[qm] - wq2l[pm]
+                delta = (
+                    costo(ra, dw_m, dx_m, dy_m, dq2_m) + costo(rb, -dw_m, -dx_m, -dy_m, -dq2_m)
+                    - costo(ra) - costo(rb)
+                )
+                if delta >= -EPS_MEJORA:
+                    continue
+                if (_exceso_escalar(nl[ra] + dw_m, minimo, maximo) + _exceso_escalar(nl[rb] - dw_m, minimo, maximo)
+                        > _exceso_escalar(nl[ra], minimo, maximo) + _exceso_escalar(nl[rb], minimo, maximo)):
+                    continue
+                if not (puede_entrar(clientes[pm], rb) and puede_entrar(clientes[qm], ra)):
+                    continue
+                # Costo de inserción + cambio de carga (nulo si pesan igual)
+                km = km_en(pm, rb) + km_en(qm, ra) - km_ahorro(pm) - km_ahorro(qm)
+                if km + carga(ra, dw_m) + carga(rb, -dw_m) - carga(ra) - carga(rb) >= -EPS_MEJORA:
+                    continue
+                mover(pm, ra, rb)
+                mover(qm, rb, ra)
+
+            activas[ra] = activas[rb] = True
+            aplicados += 1
+
+        ruta_de = np.array(ruta_l, dtype=np.int64)
+        n = np.array(nl, dtype=np.float64)
+        sx, sy, s2 = np.array(sxl), np.array(syl), np.array(s2l)
+
+        if not aplicados:
+            break
+
+    # 4. Reconstruir cada ruta conservando el orden relativo original
+    orden = np.argsort(ruta_de, kind="stable")
+    cortes = np.cumsum(np.bincount(ruta_de, minlength=n_rutas))[:-1]
+    for ruta, posiciones in zip(rutas, np.split(orden, cortes)):
+        ruta["idx"] = puntos[posiciones]
+        ruta["total_pdv"] = len(ruta["idx"]) if pesos is None else int(w[posiciones].sum())
+
+    return rutas
@@ -1,194 +1,298 @@
-from app.services.metrics import centroide, haversine
+from app.services.distances import distancias_desde
+from app.services.routes_local_search import mejorar_rutas
+from app.core.telemetria import medido
 import math
+import numpy as np
 
 # Distancia máxima para considerar fusión de bloques enteros
-MAX_MERGE_DISTANCE_KM = 5.0 
+MAX_MERGE_DISTANCE_KM = 5.0
 
 # Aumentamos el radio de transferencia para permitir movimientos más agresivos entre vecinos
-MAX_TRANSFER_DISTANCE_KM = 6.0 
+MAX_TRANSFER_DISTANCE_KM = 6.0
 
-def fusionar_rutas(rutas, rango, target_n_rutas):
+
+# =========================
+# AGREGADOS INCREMENTALES POR RUTA
+# =========================
+class AgregadosRutas:
+    """
+    Sumas de coordenadas, conteos y pertenencia de PDVs para una lista de
+    rutas internas ({"idx": posiciones en la TablaPDV}); cada ruta se
+    identifica por su fila en 'rutas'.
+    El centroide sale de las sumas en O(1) y mover un PDV actualiza las sumas
+    en O(1), sin volver a recorrer la ruta.
+    'pesos' (opcional): carga de cada fila de la tabla (ej. GOLPEO de un
+    cliente único). El conteo de una ruta es la suma de sus pesos y el
+    centroide se pondera por ellos; sin pesos, cada fila cuenta 1.
+    """
+
+    def __init__(self, rutas, tabla, pesos=None):
+        self.rutas = rutas
+        self.lat = tabla.lat
+        self.lon = tabla.lon
+        self.pesos = pesos
+        n = len(rutas)
+        self.suma_lat = np.zeros(n)
+        self.suma_lon = np.zeros(n)
+        self.conteo = np.zeros(n, dtype=np.int64)
+        # posición en la tabla -> fila de la ruta que la contiene (-1: ninguna)
+        self.ruta_de = np.full(len(tabla), -1, dtype=np.int64)
+
+        for i, r in enumerate(rutas):
+            if pesos is None:
+                # Misma suma secuencial que metrics.centroide
+                self.suma_lat[i] = sum(self.lat[r["idx"]].tolist())
+                self.suma_lon[i] = sum(self.lon[r["idx"]].tolist())
+                self.conteo[i] = len(r["idx"])
+            else:
+                w = pesos[r["idx"]]
+                self.suma_lat[i] = np.dot(w, self.lat[r["idx"]])
+                self.suma_lon[i] = np.dot(w, self.lon[r["idx"]])
+                self.conteo[i] = w.sum()
+            self.ruta_de[r["idx"]] = i
+            self._sincronizar(i)
+
+    def centroide(self, i):
+        return self.suma_lat[i] / self.conteo[i], self.suma_lon[i] / self.conteo[i]
+
+    def centroides(self, filas):
+        """
+        Centroides de varias rutas como dos arrays (lats, lons) alineados con 'filas'.
+        """
+        return self.suma_lat[filas] / self.conteo[filas], self.suma_lon[filas] / self.conteo[filas]
+
+    def _sincronizar(self, i):
+        self.rutas[i]["total_pdv"] = int(self.conteo[i])
+
+    def fusionar(self, destino, origen):
+        """
+        Agrega todos los PDVs de la ruta 'origen' al final de 'destino'.
+        """
+        idx = self.rutas[origen]["idx"]
+        self.rutas[destino]["idx"] = np.concatenate((self.rutas[destino]["idx"], idx))
+        self.ruta_de[idx] = destino
+
+        self.suma_lat[destino] += self.suma_lat[origen]
+        self.suma_lon[destino] += self.suma_lon[origen]
+        self.conteo[destino] += self.conteo[origen]
+        self._sincronizar(destino)
+
+    def mover(self, origen, destino, posiciones):
+        """
+        Mueve los PDVs en 'posiciones' (índices en rutas[origen]["idx"]) al
+        final de 'destino', en ese orden. La ruta origen conserva el orden
+        relativo de los que quedan.
+        """
+        idx_origen = self.rutas[origen]["idx"]
+        movidos = idx_origen[posiciones]
+        movidos = movidos[self.ruta_de[movidos] == origen]
+        if not movidos.size:
+            return
+
+        if self.pesos is None:
+            pesos = [1] * movidos.size
+        else:
+            pesos = self.pesos[movidos].tolist()
+        for lat, lon, w in zip(self.lat[movidos].tolist(), self.lon[movidos].tolist(), pesos):
+            self.suma_lat[origen] -= w * lat
+            self.suma_lon[origen] -= w * lon
+            self.suma_lat[destino] += w * lat
+            self.suma_lon[destino] += w * lon
+        self.ruta_de[movidos] = destino
+
+        # Una sola pasada para sacar los movidos
+        self.rutas[origen]["idx"] = idx_origen[self.ruta_de[idx_origen] == origen]
+        self.rutas[destino]["idx"] = np.concatenate((self.rutas[destino]["idx"], movidos))
+
+        self.conteo[origen] -= sum(pesos)
+        self.conteo[destino] += sum(pesos)
+        self._sincronizar(origen)
+        self._sincronizar(destino)
+
+
+@medido("fusion")
+def fusionar_rutas(rutas, rango, target_n_rutas, tabla, pesos=None):
     """
     1. Fusión Espacial
     2. Reducción Forzada
     3. Balanceo Agresivo (Desbordamiento)
+    4. Búsqueda local entre rutas
+    'rutas' son rutas internas ({"idx": posiciones en 'tabla'}).
+    'pesos' (opcional): carga de cada fila (ver AgregadosRutas); el rango y
+    el total_pdv de cada ruta se miden en esa carga.
     """
-    
+    agregados = AgregadosRutas(rutas, tabla, pesos)
+    conteo = agregados.conteo
+
     # --- FASE 1: Fusión Espacial (Idéntica a antes) ---
     SAFE_MAX = rango["max"]
-    rutas_ok = []
-    rutas_chicas = []
-
-    for r in rutas:
-        if len(r["pdvs"]) >= rango["min"]:
-            rutas_ok.append(r)
-        else:
-            rutas_chicas.append(r)
+    filas_ok = [i for i in range(len(rutas)) if conteo[i] >= rango["min"]]
+    rutas_chicas = [i for i in range(len(rutas)) if conteo[i] < rango["min"]]
 
-    rutas_chicas.sort(key=lambda x: len(x["pdvs"]), reverse=True)
+    rutas_chicas.sort(key=lambda i: conteo[i], reverse=True)
     rutas_pendientes = []
+    ok = np.array(filas_ok, dtype=np.int64)
+
+    for actual in rutas_chicas:
+        lat_c, lon_c = agregados.centroide(actual)
+
+        lats_ok, lons_ok = agregados.centroides(ok)
+        dists_ok = distancias_desde(lat_c, lon_c, lats_ok, lons_ok)
 
-    while rutas_chicas:
-        actual = rutas_chicas.pop(0)
-        lat_c, lon_c = centroide(actual["pdvs"])
-        mejor_match = None
-        mejor_dist = float("inf")
-
-        for r in rutas_ok:
-            lat_r, lon_r = centroide(r["pdvs"])
-            dist = haversine(lat_c, lon_c, lat_r, lon_r)
-            if dist < mejor_dist and dist <= MAX_MERGE_DISTANCE_KM:
-                if len(r["pdvs"]) + len(actual["pdvs"]) <= SAFE_MAX:
-                    mejor_dist = dist
-                    mejor_match = r
-        
-        if mejor_match:
-            mejor_match["pdvs"].extend(actual["pdvs"])
-            mejor_match["total_pdv"] = len(mejor_match["pdvs"])
+        # El más cercano (primero ante empates) dentro de distancia y capacidad
+        validos = (dists_ok <= MAX_MERGE_DISTANCE_KM) & (conteo[ok] + conteo[actual] <= SAFE_MAX)
+
+        if validos.any():
+            candidatos = np.flatnonzero(validos)
+            mejor_match = ok[candidatos[np.argmin(dists_ok[candidatos])]]
+            agregados.fusionar(mejor_match, actual)
         else:
             rutas_pendientes.append(actual)
 
-    rutas_totales = rutas_ok + rutas_pendientes
+    rutas_totales = filas_ok + rutas_pendientes
 
     # --- FASE 2: Reducción Forzada (Idéntica a antes) ---
     LIMITE_ACEPTABLE = target_n_rutas + 1
-    
+
     # Tolerancia extendida para casos de reducción forzada
-    HARD_MAX = rango["promedio"] * 1.5 
+    HARD_MAX = rango["promedio"] * 1.5
 
     while len(rutas_totales) > LIMITE_ACEPTABLE:
-        rutas_totales.sort(key=lambda x: len(x["pdvs"]))
+        rutas_totales.sort(key=lambda i: conteo[i])
         pequena = rutas_totales.pop(0)
-        lat_p, lon_p = centroide(pequena["pdvs"])
+        lat_p, lon_p = agregados.centroide(pequena)
+
+        filas = np.array(rutas_totales, dtype=np.int64)
+        lats_t, lons_t = agregados.centroides(filas)
+        dists_t = distancias_desde(lat_p, lon_p, lats_t, lons_t)
+
+        # Candidatos por cercanía (argsort estable = mismo orden que sort())
+        orden = np.argsort(dists_t, kind="stable")
+        nuevo_total = conteo[filas[orden]] + conteo[pequena]
+
         candidato_elegido = None
-        candidatos = []
-        
-        for r in rutas_totales:
-            lat_r, lon_r = centroide(r["pdvs"])
-            dist = haversine(lat_p, lon_p, lat_r, lon_r)
-            nuevo_total = len(r["pdvs"]) + len(pequena["pdvs"])
-            candidatos.append({"ruta": r, "dist": dist, "nuevo_total": nuevo_total})
-
-        candidatos.sort(key=lambda x: x["dist"])
-
-        for c in candidatos:
-            if c["nuevo_total"] <= SAFE_MAX:
-                candidato_elegido = c["ruta"]; break
-        
-        if not candidato_elegido:
-            for c in candidatos:
-                if c["nuevo_total"] <= HARD_MAX:
-                    candidato_elegido = c["ruta"]; break
-        
+        for limite in (SAFE_MAX, HARD_MAX):
+            entran = np.flatnonzero(nuevo_total <= limite)
+            if entran.size:
+                candidato_elegido = filas[orden[entran[0]]]
+                break
+
         # Fallback: Unir al más cercano aunque se pase un poco, es mejor que dejar una ruta sola
-        if not candidato_elegido and candidatos:
-            candidato_elegido = candidatos[0]["ruta"]
+        if candidato_elegido is None and orden.size:
+            candidato_elegido = filas[orden[0]]
 
-        if candidato_elegido:
-            candidato_elegido["pdvs"].extend(pequena["pdvs"])
-            candidato_elegido["total_pdv"] = len(candidato_elegido["pdvs"])
+        if candidato_elegido is not None:
+            agregados.fusionar(candidato_elegido, pequena)
         else:
             rutas_totales.append(pequena)
             break
 
     # --- FASE 3: BALANCEO AGRESIVO (Modificado) ---
     # Aquí es donde arreglamos el problema 44 vs 21
-    rutas_totales = balancear_cargas_agresivo(rutas_totales, rango)
+    rutas_totales = balancear_cargas_agresivo([rutas[i] for i in rutas_totales], rango, tabla, pesos)
+
+    # --- FASE 4: BÚSQUEDA LOCAL (relocate / swap entre rutas vecinas) ---
+    rutas_totales = mejorar_rutas(rutas_totales, rango, tabla, pesos=pesos)
 
     # Reordenar IDs
-    rutas_totales.sort(key=lambda x: len(x["pdvs"]), reverse=True)
+    rutas_totales.sort(key=lambda x: x["total_pdv"], reverse=True)
     for i, r in enumerate(rutas_totales, start=1):
         r["ruta_id"] = i
 
     return rutas_totales
 
 
-def balancear_cargas_agresivo(rutas, rango):
+@medido("balanceo")
+def balancear_cargas_agresivo(rutas, rango, tabla, pesos=None):
     """
     Busca equilibrar las cargas moviendo puntos desde las rutas más llenas
     hacia sus vecinos más vacíos, priorizando la proximidad al receptor.
+    Con visitas repetidas (GOLPEO) no mueve un cliente a una ruta que ya lo
+    tiene. Con 'pesos' (ver AgregadosRutas) las cargas son sumas de pesos.
     """
     PROMEDIO = rango["promedio"]
     # Umbral para considerar que una ruta está "llena" y debe donar
-    UMBRAL_RICO = math.floor(PROMEDIO * 1.1) 
+    UMBRAL_RICO = math.floor(PROMEDIO * 1.1)
     # Umbral para considerar que una ruta necesita ayuda
     UMBRAL_POBRE = math.ceil(PROMEDIO * 0.9)
 
+    agregados = AgregadosRutas(rutas, tabla, pesos)
+    conteo = agregados.conteo
+    orden = np.arange(len(rutas))
+    clientes = tabla.id
+    # Clientes con más de una visita entre estas rutas (GOLPEO)
+    visitas = clientes[np.concatenate([r["idx"] for r in rutas])] if rutas else clientes[:0]
+    hay_repetidos = len(np.unique(visitas)) < len(visitas)
+
     # Iteramos más veces para asegurar que el flujo de puntos se propague
-    for _ in range(10): 
+    for _ in range(10):
         cambios_hechos = False
-        
-        # Ordenamos: Primero las rutas más cargadas
-        rutas.sort(key=lambda x: len(x["pdvs"]), reverse=True)
-        
-        for donante in rutas:
+
+        # Ordenamos: Primero las rutas más cargadas (estable, como list.sort)
+        orden = orden[np.argsort(-conteo[orden], kind="stable")]
+
+        for donante in orden:
             # Si no es "Rica", no dona
-            if len(donante["pdvs"]) <= UMBRAL_RICO:
+            if conteo[donante] <= UMBRAL_RICO:
                 continue
-            
-            lat_d, lon_d = centroide(donante["pdvs"])
-
-            # Buscar vecinos "Pobres"
-            vecinos_pobres = []
-            for r in rutas:
-                if r == donante: continue
-                if len(r["pdvs"]) < PROMEDIO: # Si está bajo el promedio, acepta donaciones
-                    lat_r, lon_r = centroide(r["pdvs"])
-                    dist = haversine(lat_d, lon_d, lat_r, lon_r)
-                    if dist <= MAX_MERGE_DISTANCE_KM * 1.5: # Buscamos vecinos en un radio amplio
-                        vecinos_pobres.append({"ruta": r, "dist": dist, "centro": (lat_r, lon_r)})
-            
-            if not vecinos_pobres:
+
+            lat_d, lon_d = agregados.centroide(donante)
+
+            # Buscar vecinos "Pobres": bajo el promedio aceptan donaciones
+            pobres = orden[(orden != donante) & (conteo[orden] < PROMEDIO)]
+            lats_p, lons_p = agregados.centroides(pobres)
+            dists_p = distancias_desde(lat_d, lon_d, lats_p, lons_p)
+            cercanos = np.flatnonzero(dists_p <= MAX_MERGE_DISTANCE_KM * 1.5) # Buscamos vecinos en un radio amplio
+
+            if not cercanos.size:
                 continue
 
-            # Ordenamos vecinos por cercanía al donante
-            vecinos_pobres.sort(key=lambda x: x["dist"])
-            
-            # Intentamos donar al vecino más cercano que lo necesite
-            mejor_vecino_info = vecinos_pobres[0]
-            receptor = mejor_vecino_info["ruta"]
-            lat_rec, lon_rec = mejor_vecino_info["centro"]
+            # Intentamos donar al vecino más cercano (primero ante empates)
+            mejor = cercanos[np.argmin(dists_p[cercanos])]
+            receptor = pobres[mejor]
+            lat_rec, lon_rec = lats_p[mejor], lons_p[mejor]
 
             # --- LÓGICA DE DESBORDAMIENTO ---
             # Ordenamos los puntos del DONANTE según su cercanía al RECEPTOR
             # Los que estén más cerca del receptor son los primeros en irse
-            puntos_candidatos = sorted(
-                donante["pdvs"], 
-                key=lambda p: haversine(p["latitud"], p["longitud"], lat_rec, lon_rec)
-            )
+            lats_d, lons_d = tabla.coordenadas(rutas[donante]["idx"])
+            dists_rec = distancias_desde(lat_rec, lon_rec, lats_d, lons_d)
+            # argsort estable: mismo orden que el sorted() original ante empates
+            orden_candidatos = np.argsort(dists_rec, kind="stable")
 
-            puntos_a_mover = []
-            
             # Cuantos puntos sobran?
-            exceso = len(donante["pdvs"]) - PROMEDIO
+            exceso = conteo[donante] - PROMEDIO
             # Cuantos puntos faltan?
-            falta = PROMEDIO - len(receptor["pdvs"])
-            
+            falta = PROMEDIO - conteo[receptor]
+
             # Movemos lo que se pueda (el menor de los dos)
             cantidad_a_mover = min(exceso, falta, 5) # Movemos de 5 en 5 para ser graduales
 
-            for pdv in puntos_candidatos:
-                if len(puntos_a_mover) >= cantidad_a_mover:
-                    break
-                
-                dist_al_receptor = haversine(pdv["latitud"], pdv["longitud"], lat_rec, lon_rec)
-                
-                # Solo movemos si está "alcanzable" (no mover puntos al extremo opuesto)
-                if dist_al_receptor <= MAX_TRANSFER_DISTANCE_KM:
-                    puntos_a_mover.append(pdv)
+            # Solo movemos si está "alcanzable" (no mover puntos al extremo opuesto)
+            alcanzables = orden_candidatos[dists_rec[orden_candidatos] <= MAX_TRANSFER_DISTANCE_KM]
+            if hay_repetidos:
+                # Ni clientes que el receptor ya tiene, ni dos visitas del mismo
+                clientes_c = clientes[rutas[donante]["idx"][alcanzables]]
+                _, primeras = np.unique(clientes_c, return_index=True)
+                primera = np.zeros(len(alcanzables), dtype=bool)
+                primera[primeras] = True
+                alcanzables = alcanzables[primera & ~np.isin(clientes_c, clientes[rutas[receptor]["idx"]])]
+            cupo = max(0, math.ceil(cantidad_a_mover))
+            if pesos is None:
+                puntos_a_mover = alcanzables[:cupo]
+            else:
+                # Los primeros cuya carga acumulada entra en el cupo
+                acumulado = np.cumsum(pesos[rutas[donante]["idx"][alcanzables]])
+                puntos_a_mover = alcanzables[:int(np.searchsorted(acumulado, cupo, side="right"))]
 
             # Ejecutar transferencia
-            if puntos_a_mover:
-                for p in puntos_a_mover:
-                    if p in donante["pdvs"]:
-                        donante["pdvs"].remove(p)
-                        receptor["pdvs"].append(p)
-                
-                donante["total_pdv"] = len(donante["pdvs"])
-                receptor["total_pdv"] = len(receptor["pdvs"])
+            if puntos_a_mover.size:
+                agregados.mover(donante, receptor, puntos_a_mover)
                 cambios_hechos = True
-        
+
         if not cambios_hechos:
             break
-            
-    return rutas
\ No newline at end of file
+
+    # Mismo orden final que dejaba el sort in-place original
+    rutas[:] = [rutas[i] for i in orden]
+    return rutas
@@ -1,16 +1,33 @@
 from collections import defaultdict
+from functools import partial
 import math
 
-from app.services.h3_utils import asignar_h3
-from app.services.clustering import clusterizar_rutas
+import numpy as np
+
+from app.services.pdv_store import TablaPDV
+from app.services.clustering import clusterizar_rutas, CLUSTERIZADOR_CAPACITADO
+from app.services.coubicados import nodos_coubicados, expandir_nodos
+from app.services.plan_referencia import conservar_ids
+from app.config.settings import CLUSTERIZADOR_DEFAULT
 # Ya no necesitamos importar fusionar_rutas aquí porque lo usa clustering internamente
-from app.services.route_optimizer import optimizar_orden_pdvs
-from app.services.metrics import evaluar_ruta
+from app.services.route_optimizer import secuenciar
+from app.services.metrics import evaluar_coordenadas
+from app.services.parallel import mapear_grupos
 
-def construir_rutas(df, frecuencia: str, sabado: bool, flex: float):
+def construir_rutas(df, frecuencia: str, sabado: bool, flex: float, secuenciador: str = None,
+                    workers: int = None, chunk_size: int = None, clusterizador: str = None,
+                    referencia: dict = None, cancelacion=None):
     """
     Construye rutas por mercaderista usando:
     H3 -> Clustering -> Fusión Espacial -> Reducción Forzada -> Balance Final
+    'secuenciador' elige el motor TSP de cada ruta (ver secuenciar) y
+    'clusterizador' el de agrupación (ver clusterizar_rutas).
+    'referencia' (por mercaderista, ver referencia_desde_plan): arranque en
+    caliente desde un plan anterior; los mercaderistas sin referencia
+    arrancan de cero.
+    Cada mercaderista es independiente: con workers > 1 se reparten en un
+    pool de procesos (ver mapear_grupos); el orden del resultado no cambia.
+    'cancelacion' (threading.Event, opcional): se revisa entre mercaderistas.
     """
 
     resultado = {
@@ -21,58 +38,97 @@ def construir_rutas(df, frecuencia: str, sabado: bool, flex: float):
     }
 
     # 1. Agrupar por mercaderista
-    for vendedor, df_vendedor in df.groupby("NOMBRE_VENDEDOR"):
-        total_pdv = len(df_vendedor)
-
-        # 2. Calcular número de rutas (Target)
-        if frecuencia.upper() == "SEMANAL":
-            num_rutas = 6 if sabado else 5
-        elif frecuencia.upper() == "QUINCENAL":
-            num_rutas = 12 if sabado else 10
-        else: # MENSUAL
-            num_rutas = 24 if sabado else 20
-
-        # 🔐 No permitir más rutas que PDVs (caso bordes extremos)
-        num_rutas = min(num_rutas, total_pdv)
-
-        # Cálculo del Rango (Promedio, Min, Max)
-        promedio = total_pdv / num_rutas if num_rutas > 0 else 0
-        rango = {
-            "promedio": round(promedio, 2),
-            "min": max(1, math.floor(promedio * (1 - flex))),
-            "max": math.ceil(promedio * (1 + flex))
-        }
-
-        # 3. Asignar H3 (Resolution 9 para mayor precisión zonal)
-        df_h3 = asignar_h3(df_vendedor, resolution=9)
-
-        # 4. Clustering Inteligente (Incluye la fusión y reducción forzada)
-        # Aquí pasamos 'num_rutas' para que el algoritmo sepa cuánto debe reducir
-        rutas = clusterizar_rutas(
-            df=df_h3,
-            num_rutas=num_rutas,
-            rango=rango
-        )
-
-        # 5. Optimización final de cada ruta resultante
-        for ruta in rutas:
-            # A. Optimizar orden interno (Viajero Comerciante - TSP)
-            ruta["pdvs"] = optimizar_orden_pdvs(ruta["pdvs"])
-
-            # B. Calcular métricas finales (Distancia real, tiempos)
-            metricas = evaluar_ruta(ruta, rango)
-            ruta.update(metricas)
-
-            # C. Asegurar totales
-            ruta["total_pdv"] = len(ruta["pdvs"])
-
-        # Agregamos al resultado final
-        resultado["mercaderistas"].append({
-            "mercaderista": vendedor,
-            "total_pdv": total_pdv,
-            "num_rutas": len(rutas),
-            "rango": rango,
-            "rutas": rutas
-        })
-
-    return resultado
\ No newline at end of file
+    planificar_grupo = partial(
+        _planificar_vendedor,
+        frecuencia=frecuencia,
+        sabado=sabado,
+        flex=flex,
+        secuenciador=secuenciador,
+        clusterizador=clusterizador,
+        referencia=referencia
+    )
+    resultado["mercaderistas"] = mapear_grupos(
+        planificar_grupo,
+        df.groupby("NOMBRE_VENDEDOR"),
+        workers=workers,
+        chunk_size=chunk_size,
+        cancelacion=cancelacion
+    )
+
+    return resultado
+
+
+def _planificar_vendedor(grupo, frecuencia: str, sabado: bool, flex: float, secuenciador: str = None,
+                         clusterizador: str = None, referencia: dict = None):
+    vendedor, df_vendedor = grupo
+    total_pdv = len(df_vendedor)
+
+    # 2. Calcular número de rutas (Target)
+    if frecuencia.upper() == "SEMANAL":
+        num_rutas = 6 if sabado else 5
+    elif frecuencia.upper() == "QUINCENAL":
+        num_rutas = 12 if sabado else 10
+    else: # MENSUAL
+        num_rutas = 24 if sabado else 20
+
+    # 🔐 No permitir más rutas que PDVs (caso bordes extremos)
+    num_rutas = min(num_rutas, total_pdv)
+
+    # Cálculo del Rango (Promedio, Min, Max)
+    promedio = total_pdv / num_rutas if num_rutas > 0 else 0
+    rango = {
+        "promedio": round(promedio, 2),
+        "min": max(1, math.floor(promedio * (1 - flex))),
+        "max": math.ceil(promedio * (1 + flex))
+    }
+
+    # 3. Asignar H3 (Resolution 9 para mayor precisión zonal)
+    # Desde aquí los PDVs viven como columnas; las rutas son arrays de posiciones
+    tabla = TablaPDV.desde_df(df_vendedor).con_h3(resolution=9)
+
+    # 4. Clustering Inteligente (Incluye la fusión y reducción forzada)
+    # Aquí pasamos 'num_rutas' para que el algoritmo sepa cuánto debe reducir.
+    # Se agrupan nodos (PDVs co-ubicados juntos, ver nodos_coubicados) que
+    # pesan sus miembros; recién al emitir cada ruta vuelven a ser PDVs
+    una_visita = np.ones(len(tabla), dtype=np.int64)
+    nodos, nodo_de, carga = nodos_coubicados(tabla, una_visita, rango["promedio"])
+    referencia = (referencia or {}).get(vendedor)
+    rutas = clusterizar_rutas(
+        tabla=nodos,
+        num_rutas=num_rutas,
+        rango=rango,
+        clusterizador=clusterizador,
+        pesos=carga,
+        referencia=referencia,
+        cupo_fila=carga
+    )
+    if (clusterizador or CLUSTERIZADOR_DEFAULT) == CLUSTERIZADOR_CAPACITADO:
+        # El 'idx' repite el nodo por cada PDV que le tocó a la ruta
+        rutas = expandir_nodos(rutas, nodo_de, una_visita)
+    else:
+        rutas = expandir_nodos(rutas, nodo_de, una_visita, pesos_fila=carga)
+    if referencia is not None:
+        # Identidad de rutas por PDV (no por nodo)
+        rutas = conservar_ids(rutas, tabla, referencia)
+
+    # 5. Optimización final de cada ruta resultante
+    for ruta in rutas:
+        # A. Optimizar orden interno (Viajero Comerciante - TSP); los nodos
+        # co-ubicados se expanden con su sub-orden
+        ruta["idx"] = ruta["idx"][secuenciar(
+            *tabla.coordenadas(ruta["idx"]), secuenciador=secuenciador, codigos=tabla.cod[ruta["idx"]],
+            nodos=nodo_de[ruta["idx"]]
+        )]
+
+        # B. Calcular métricas finales (Distancia real, tiempos)
+        metricas = evaluar_coordenadas(*tabla.coordenadas(ruta["idx"]), rango, tabla.cod[ruta["idx"]])
+        ruta.update(metricas)
+
+    # Agregamos al resultado final (recién aquí se arman los dicts por PDV)
+    return {
+        "mercaderista": vendedor,
+        "total_pdv": total_pdv,
+        "num_rutas": len(rutas),
+        "rango": rango,
+        "rutas": [tabla.serializar_ruta(ruta) for ruta in rutas]
+    }
@@ -1,82 +1,135 @@
 import math
 import pandas as pd
-from app.services.h3_utils import asignar_h3
-from app.services.clustering import clusterizar_rutas
-from app.services.route_optimizer import optimizar_orden_pdvs
-from app.services.metrics import evaluar_ruta, haversine
-
-def resolver_colisiones_golpeo(rutas):
-    # ... (Tu función resolver_colisiones_golpeo queda EXACTAMENTE IGUAL) ...
-    # 1. Calcular centroides de cada ruta para saber cuáles están cerca
-    centroides = {}
-    for ruta in rutas:
-        if ruta["pdvs"]:
-            lats = [p["latitud"] for p in ruta["pdvs"]]
-            lons = [p["longitud"] for p in ruta["pdvs"]]
-            centroides[ruta["ruta_id"]] = {
-                "lat": sum(lats) / len(lats),
-                "lon": sum(lons) / len(lons)
-            }
+from app.services.pdv_store import TablaPDV
+from app.services.clustering import clusterizar_rutas, CLUSTERIZADOR_CAPACITADO
+from app.services.coubicados import nodos_coubicados, expandir_nodos
+from app.services.plan_referencia import conservar_ids
+from app.services.routes_merges import balancear_cargas_agresivo
+from app.services.routes_local_search import mejorar_rutas
+from app.services.route_optimizer import secuenciar
+from app.services.metrics import evaluar_coordenadas
+from app.services.distances import proyectar_km
+from app.config.settings import GOLPEO_RUTAS_VECINAS, CLUSTERIZADOR_DEFAULT
+import numpy as np
+from sklearn.neighbors import KDTree
+from functools import partial
+from app.services.parallel import mapear_grupos
+from app.core.telemetria import medido
+
+@medido("reparto_golpeo")
+def distribuir_visitas_golpeo(rutas, tabla, rango: dict, vecinos: int = None, pesos=None):
+    """
+    Reparte las visitas de clientes con GOLPEO > 1 en rutas distintas:
+    en cada ruta se queda la primera visita de cada cliente y las demás van
+    a la ruta más cercana al cliente que aún no lo tenga y tenga cupo bajo
+    rango["max"]. Si ninguna de las cercanas tiene cupo, a la menos cargada
+    de ellas (nunca a una lejana solo por cupo).
+    - Índice de pertenencia: set de (ruta, cliente) -> consulta O(1).
+    - Índice espacial: KD-tree sobre los centroides de las rutas.
+    Después se re-balancean las rutas tocadas (balanceo + búsqueda local,
+    ambos sin repetir clientes): el reparto no deshace el balanceo previo.
+    Garantiza que ningún cliente se repite en una ruta mientras su GOLPEO no
+    supere la cantidad de rutas (si la supera, el excedente vuelve a su ruta).
+    'rutas' son rutas internas ({"idx": posiciones en 'tabla'}).
+    'pesos' (opcional, por fila de 'tabla'): visitas de cada fila, ej. una
+    rebanada de un nodo co-ubicado (ver nodos_coubicados) que se mueve
+    entera; el cupo y el re-balanceo cuentan esas visitas.
+    """
+    if vecinos is None:
+        vecinos = GOLPEO_RUTAS_VECINAS
+    n_rutas = len(rutas)
+    if not n_rutas:
+        return rutas
+
+    # 1. Visitas sobrantes: repeticiones de (ruta, cliente) después de la primera
+    puntos = np.concatenate([r["idx"] for r in rutas])
+    ruta_de = np.repeat(np.arange(n_rutas), [len(r["idx"]) for r in rutas])
+    n_clientes = int(tabla.id.max()) + 1 if len(tabla) else 0
+    clave = ruta_de * n_clientes + tabla.id[puntos]
+    presentes, primeras = np.unique(clave, return_index=True)
+    se_queda = np.zeros(len(puntos), dtype=bool)
+    se_queda[primeras] = True
+
+    a_mover = np.flatnonzero(~se_queda)
+    w = np.ones(len(tabla), dtype=np.int64) if pesos is None else np.asarray(pesos, dtype=np.int64)
+    if not a_mover.size:
+        for ruta in rutas:
+            ruta["total_pdv"] = int(w[ruta["idx"]].sum())
+        return rutas
+
+    # 2. Índices: pertenencia (ruta, cliente), carga y centroides (km) por ruta
+    pertenece = set(presentes.tolist())
+    x, y = proyectar_km(tabla.lat, tabla.lon)
+    w_queda = w[puntos[se_queda]]
+    conteo = np.bincount(ruta_de[se_queda], weights=w_queda, minlength=n_rutas).astype(np.int64)
+    base = np.maximum(conteo, 1)
+    cx = np.bincount(ruta_de[se_queda], weights=w_queda * x[puntos[se_queda]], minlength=n_rutas) / base
+    cy = np.bincount(ruta_de[se_queda], weights=w_queda * y[puntos[se_queda]], minlength=n_rutas) / base
+    arbol = KDTree(np.column_stack((cx, cy)))
+
+    # 3. Candidatas para todas las visitas sobrantes en una sola consulta
+    sobrantes = puntos[a_mover]
+    k = min(n_rutas, vecinos + int(tabla.golpeo.max()))
+    _, candidatas = arbol.query(np.column_stack((x[sobrantes], y[sobrantes])), k=k)
+
+    conteo = conteo.tolist()
+    destinos = [[] for _ in range(n_rutas)]
+    maximo = rango["max"]
+
+    for pdv, origen, cercanas in zip(sobrantes.tolist(), ruta_de[a_mover].tolist(), candidatas.tolist()):
+        cliente = int(tabla.id[pdv])
+        libres = [r for r in cercanas if r * n_clientes + cliente not in pertenece]
+        if not libres and k < n_rutas:
+            # Todas las vecinas ya lo tienen: se abre a todas las rutas
+            _, todas = arbol.query([[x[pdv], y[pdv]]], k=n_rutas)
+            libres = [r for r in todas[0].tolist() if r * n_clientes + cliente not in pertenece]
+
+        con_cupo = [r for r in libres if conteo[r] + w[pdv] <= maximo]
+        if con_cupo:
+            destino = con_cupo[0]
+        elif libres:
+            # Todas las candidatas están llenas: la que menos se pasa
+            destino = min(libres, key=conteo.__getitem__)
         else:
-            centroides[ruta["ruta_id"]] = {"lat": 0, "lon": 0}
-
-    # 2. Iterar para limpiar duplicados
-    # Hacemos un par de pasadas para asegurar que se acomoden bien
-    for _ in range(2): 
-        cambio_realizado = False
-        
-        for ruta_origen in rutas:
-            ids_vistos = set()
-            pdvs_unicos = []
-            pdvs_a_mover = []
-
-            # Separar los que se quedan de los que sobran (duplicados)
-            for pdv in ruta_origen["pdvs"]:
-                cod = pdv["cod_live_tra"]
-                if cod in ids_vistos:
-                    pdvs_a_mover.append(pdv) # Ya existe en esta ruta, ¡fuera!
-                    cambio_realizado = True
-                else:
-                    ids_vistos.add(cod)
-                    pdvs_unicos.append(pdv)
-            
-            # Si encontramos duplicados, actualizamos la ruta y buscamos hogar a los huerfanos
-            if pdvs_a_mover:
-                ruta_origen["pdvs"] = pdvs_unicos
-                
-                for pdv_move in pdvs_a_mover:
-                    mejor_ruta = None
-                    menor_distancia = float('inf')
-                    
-                    # Buscar la mejor ruta vecina
-                    for ruta_destino in rutas:
-                        if ruta_destino["ruta_id"] == ruta_origen["ruta_id"]:
-                            continue
-                        
-                        # REGLA DE ORO: La ruta destino NO debe tener ya a este cliente
-                        dest_ids = {p["cod_live_tra"] for p in ruta_destino["pdvs"]}
-                        if pdv_move["cod_live_tra"] in dest_ids:
-                            continue 
-                        
-                        # Calcular cercanía entre rutas
-                        c1 = centroides[ruta_origen["ruta_id"]]
-                        c2 = centroides[ruta_destino["ruta_id"]]
-                        dist = haversine(c1['lat'], c1['lon'], c2['lat'], c2['lon'])
-                        
-                        if dist < menor_distancia:
-                            menor_distancia = dist
-                            mejor_ruta = ruta_destino
-                    
-                    # Asignar a la nueva ruta o devolver (si no hay opción)
-                    if mejor_ruta:
-                        mejor_ruta["pdvs"].append(pdv_move)
-                    else:
-                        # Caso extremo: Golpeo > Cantidad total de rutas (imposible separar)
-                        ruta_origen["pdvs"].append(pdv_move) 
+            # Caso extremo: GOLPEO > cantidad de rutas (imposible separar)
+            destino = origen
+
+        pertenece.add(destino * n_clientes + cliente)
+        conteo[destino] += int(w[pdv])
+        destinos[destino].append(pdv)
+
+    # 4. Reconstruir: las que se quedan en su orden + las recibidas al final
+    cortes = np.cumsum([len(r["idx"]) for r in rutas])[:-1]
+    for ruta, queda, recibidas in zip(rutas, np.split(se_queda, cortes), destinos):
+        ruta["idx"] = np.concatenate((ruta["idx"][queda], np.asarray(recibidas, dtype=ruta["idx"].dtype)))
+        ruta["total_pdv"] = int(w[ruta["idx"]].sum())
 
+    # 5. Re-balancear las rutas que dieron o recibieron visitas
+    tocadas = np.zeros(n_rutas, dtype=bool)
+    tocadas[ruta_de[a_mover]] = True
+    tocadas[[r for r in range(n_rutas) if destinos[r]]] = True
+    if tocadas.sum() > 1:
+        rebalanceo = [rutas[r] for r in np.flatnonzero(tocadas)]
+        balancear_cargas_agresivo(rebalanceo, rango, tabla, pesos)
+        mejorar_rutas(rebalanceo, rango, tabla, pesos=pesos)
     return rutas
 
-def planificar_bolsa_grandes(df, capacidad_objetivo: int, flex: float, sabado_activo: bool = False):
+def _miembros_por_rebanada(nodo_de, visitas, nodo_rebanada, vez):
+    """
+    Visitas de cada rebanada (nodo, vez): cuántos miembros del nodo tienen
+    más de 'vez' visitas.
+    """
+    n_nodos = int(nodo_de.max()) + 1 if len(nodo_de) else 0
+    n_vez = int(visitas.max()) if len(visitas) else 0
+    # conteo[nodo, v] = miembros con exactamente v + 1 visitas
+    conteo = np.zeros((n_nodos, n_vez + 1), dtype=np.int64)
+    np.add.at(conteo, (nodo_de, visitas - 1), 1)
+    con_mas = np.cumsum(conteo[:, ::-1], axis=1)[:, ::-1]
+    return con_mas[nodo_rebanada, vez]
+
+def planificar_bolsa_grandes(df, capacidad_objetivo: int, flex: float, sabado_activo: bool = False,
+                             secuenciador: str = None, workers: int = None, chunk_size: int = None,
+                             clusterizador: str = None, referencia: dict = None, cancelacion=None):
     """
     Planifica territorios agrupando por Departamento.
     
@@ -85,6 +138,12 @@ def planificar_bolsa_grandes(df, capacidad_objetivo: int, flex: float, sabado_ac
       Calculamos que en un ciclo de 6 personas, 5 son Full y 1 es Half.
       Esto reduce la capacidad efectiva promedio a un 91.6%.
       Esto obliga a generar MÁS RUTAS (Headcount) para cubrir los mismos puntos.
+
+    Cada departamento es independiente: con workers > 1 se reparten en un
+    pool de procesos (ver mapear_grupos); el orden del resultado no cambia.
+    'referencia' (por zona, ver referencia_desde_plan): arranque en caliente
+    desde un plan anterior.
+    'cancelacion' (threading.Event, opcional): se revisa entre departamentos.
     """
     resultado = {
         "frecuencia": "TERRITORIO", 
@@ -100,54 +159,105 @@ def planificar_bolsa_grandes(df, capacidad_objetivo: int, flex: float, sabado_ac
         capacidad_calculo = int(capacidad_objetivo * 0.916)
 
     # Agrupamos por lo que el Parser definió como VENDEDOR (ej. "ANCASH", "AREQUIPA")
-    for zona, df_zona in df.groupby("NOMBRE_VENDEDOR"):
-        
-        # 1. EXPANSIÓN POR GOLPEO (MULTIPLICACIÓN)
-        df_expandido = df_zona.loc[df_zona.index.repeat(df_zona['GOLPEO'])].copy()
-        total_visitas = len(df_expandido)
-        clientes_unicos = len(df_zona)
-        
-        if total_visitas == 0: continue
-
-        # 2. CÁLCULO DE RUTAS (Usando la capacidad ajustada)
-        num_rutas = math.ceil(total_visitas / capacidad_calculo)
-        if num_rutas < 1: num_rutas = 1
-        
-        rango = {
-            "promedio": capacidad_calculo,
-            "min": math.floor(capacidad_calculo * (1 - flex)),
-            "max": math.ceil(capacidad_calculo * (1 + flex))
-        }
-
-        # 3. PROCESO DE RUTEO
-        df_h3 = asignar_h3(df_expandido, resolution=9) # Resolución fina
-
-        rutas = clusterizar_rutas(
-            df=df_h3,
-            num_rutas=num_rutas,
-            rango=rango
-        )
-
-        # 4. RESOLUCIÓN DE COLISIONES
-        if num_rutas > 1:
-            rutas = resolver_colisiones_golpeo(rutas)
+    planificar_grupo = partial(
+        _planificar_zona,
+        capacidad_calculo=capacidad_calculo,
+        flex=flex,
+        secuenciador=secuenciador,
+        clusterizador=clusterizador,
+        referencia=referencia
+    )
+    zonas = mapear_grupos(
+        planificar_grupo,
+        df.groupby("NOMBRE_VENDEDOR"),
+        workers=workers,
+        chunk_size=chunk_size,
+        cancelacion=cancelacion
+    )
+    resultado["mercaderistas"] = [z for z in zonas if z is not None]
+
+    return resultado
+
+
+def _planificar_zona(grupo, capacidad_calculo: int, flex: float, secuenciador: str = None,
+                     clusterizador: str = None, referencia: dict = None):
+    zona, df_zona = grupo
+    referencia = (referencia or {}).get(zona)
+
+    # 1. VISITAS POR GOLPEO
+    # Una fila por cliente; GOLPEO viaja como peso (ver paso 3)
+    tabla = TablaPDV.desde_df(df_zona)
+    total_visitas = int(tabla.golpeo.sum())
+    clientes_unicos = len(df_zona)
+    
+    if total_visitas == 0: return None
+
+    # 2. CÁLCULO DE RUTAS (Usando la capacidad ajustada)
+    num_rutas = math.ceil(total_visitas / capacidad_calculo)
+    if num_rutas < 1: num_rutas = 1
+    
+    rango = {
+        "promedio": capacidad_calculo,
+        "min": math.floor(capacidad_calculo * (1 - flex)),
+        "max": math.ceil(capacidad_calculo * (1 + flex))
+    }
 
-        # 5. OPTIMIZACIÓN FINAL (TSP)
+    # 3. PROCESO DE RUTEO
+    tabla = tabla.con_h3(resolution=9) # Resolución fina (una vez por cliente)
+
+    # Se agrupan nodos (PDVs co-ubicados juntos, ver nodos_coubicados): cada
+    # fila pesa las visitas de sus miembros (GOLPEO). "CAPACITADO" reparte
+    # hasta tantas visitas del nodo por ruta como miembros tiene
+    capacitado = (clusterizador or CLUSTERIZADOR_DEFAULT) == CLUSTERIZADOR_CAPACITADO
+    nodos, nodo_de, carga = nodos_coubicados(tabla, tabla.golpeo, rango["promedio"], parejos=capacitado)
+    rutas = clusterizar_rutas(
+        tabla=nodos,
+        num_rutas=num_rutas,
+        rango=rango,
+        clusterizador=clusterizador,
+        pesos=carga,
+        referencia=referencia,
+        cupo_fila=np.bincount(nodo_de) if capacitado else None
+    )
+
+    if capacitado:
+        # "CAPACITADO" ya reparte las visitas: el 'idx' repite el nodo por visita
+        rutas = expandir_nodos(rutas, nodo_de, tabla.golpeo)
+    else:
+        # "H3" deja cada nodo entero en una ruta. Sus visitas pasan a ser
+        # rebanadas (la k-ésima visita de cada miembro) que se reparten
+        # como una unidad: un cliente nunca dos veces en la misma ruta
+        rebanadas = nodos.expandir_golpeo()
         for ruta in rutas:
-            ruta["pdvs"] = optimizar_orden_pdvs(ruta["pdvs"])
-            metricas = evaluar_ruta(ruta, rango)
-            ruta.update(metricas)
-            ruta["total_pdv"] = len(ruta["pdvs"])
-
-        # 6. Guardar Resultado
-        resultado["mercaderistas"].append({
-            "mercaderista": zona, 
-            "total_pdv": total_visitas,
-            "clientes_unicos": clientes_unicos,
-            "num_rutas": len(rutas),
-            "capacidad_objetivo_usada": capacidad_calculo, # Dato útil para ver el ajuste
-            "rango": rango,
-            "rutas": rutas
-        })
-
-    return resultado
\ No newline at end of file
+            ruta["idx"] = nodos.visitas_de(ruta["idx"])
+        nodo_rebanada = np.repeat(np.arange(len(nodos)), nodos.golpeo)
+        vez = np.arange(len(rebanadas)) - np.repeat(np.cumsum(nodos.golpeo) - nodos.golpeo, nodos.golpeo)
+        pesos_rebanada = _miembros_por_rebanada(nodo_de, tabla.golpeo, nodo_rebanada, vez)
+
+        # 4. REPARTO DE VISITAS (GOLPEO)
+        if num_rutas > 1:
+            rutas = distribuir_visitas_golpeo(rutas, rebanadas, rango, pesos=pesos_rebanada)
+        rutas = expandir_nodos(rutas, nodo_de, tabla.golpeo, nodo_fila=nodo_rebanada, pesos_fila=pesos_rebanada)
+    if referencia is not None:
+        # Identidad de rutas por PDV (no por nodo)
+        rutas = conservar_ids(rutas, tabla, referencia)
+
+    # 5. OPTIMIZACIÓN FINAL (TSP): los nodos se expanden con su sub-orden
+    for ruta in rutas:
+        ruta["idx"] = ruta["idx"][secuenciar(
+            *tabla.coordenadas(ruta["idx"]), secuenciador=secuenciador, codigos=tabla.cod[ruta["idx"]],
+            nodos=nodo_de[ruta["idx"]]
+        )]
+        metricas = evaluar_coordenadas(*tabla.coordenadas(ruta["idx"]), rango, tabla.cod[ruta["idx"]])
+        ruta.update(metricas)
+
+    # 6. Guardar Resultado
+    return {
+        "mercaderista": zona, 
+        "total_pdv": total_visitas,
+        "clientes_unicos": clientes_unicos,
+        "num_rutas": len(rutas),
+        "capacidad_objetivo_usada": capacidad_calculo, # Dato útil para ver el ajuste
+        "rango": rango,
+        "rutas": [tabla.serializar_ruta(ruta) for ruta in rutas]
+    }
@@ -0,0 +1,8 @@
+"""
+Benchmarks del motor de ruteo: maestros sintéticos reproducibles (semilla)
+y tiempos por etapa / end-to-end en JSON para comparar corridas.
+
+    python -m benchmarks --tamanos 1000 20000 --salida resultados.json
+    python -m benchmarks.generador --pdvs 50000 --salida maestro.xlsx
+    python -m benchmarks.comparar base.json nuevo.json
+"""
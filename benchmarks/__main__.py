@@ -0,0 +1,189 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from app.config import settings
+from benchmarks import etapas
+from benchmarks.generador import generar_maestro, escribir_maestro
+
+TAMANOS_DEFAULT = (1000, 5000, 20000, 50000, 200000)
+
+ETAPAS = (
+    "lectura_xlsx", "lectura_csv", "asignar_h3", "tablas_vendedor", "particion_h3",
+    "fusion_balanceo", "clustering_capacitado", "secuenciacion", "evaluar_ruta",
+    "end_to_end_asignado", "end_to_end_bolsa", "replanificar_bolsa", "exportar_excel",
+)
+
+# Bajas del maestro para la re-planificación BOLSA (primeras filas)
+BAJAS_REPLANIFICACION = 50
+
+# Settings que cambian los tiempos: quedan registrados junto a cada corrida
+SETTINGS_REGISTRADOS = (
+    "SECUENCIADOR_DEFAULT", "CLUSTERIZADOR_DEFAULT", "TSP_TIEMPO_MAX_SEG", "TSP_VECINOS",
+    "BUSQUEDA_LOCAL_MAX_RONDAS", "BUSQUEDA_LOCAL_TIEMPO_MAX_SEG", "CAPACITADO_MAX_ITER",
+    "PLAN_WORKERS", "PLAN_METODO_INICIO", "H3_PARTICION", "H3_RESOLUCION_MIN", "H3_RESOLUCION_MAX",
+    "COUBICADOS_ACTIVO", "COUBICADOS_TOLERANCIA_M",
+)
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _meta(args):
+    return {
+        "fecha": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+        "semilla": args.semilla,
+        "repeticiones": args.repeticiones,
+        "settings": {nombre: getattr(settings, nombre, None) for nombre in SETTINGS_REGISTRADOS},
+    }
+
+
+def correr_tamano(n: int, args, directorio: str):
+    """
+    Todas las etapas pedidas sobre un maestro de 'n' PDVs. Los archivos se
+    generan una vez por tamaño (fuera de los tiempos).
+    """
+    pedidas = set(args.etapas)
+    resultado = {"pdvs": n, "etapas": {}, "calidad": {}}
+
+    inicio = time.perf_counter()
+    df = generar_maestro(n, semilla=args.semilla)
+    xlsx = escribir_maestro(df, os.path.join(directorio, f"maestro_{n}.xlsx")) if "lectura_xlsx" in pedidas else None
+    csv = escribir_maestro(df, os.path.join(directorio, f"maestro_{n}.csv"))
+    csv_bolsa = escribir_maestro(
+        df.drop(columns=["NOMBRE_VENDEDOR"]), os.path.join(directorio, f"maestro_{n}_bolsa.csv")
+    )
+    csv_bajas = escribir_maestro(
+        df.drop(columns=["NOMBRE_VENDEDOR"]).iloc[BAJAS_REPLANIFICACION:],
+        os.path.join(directorio, f"maestro_{n}_bolsa_bajas.csv")
+    ) if "replanificar_bolsa" in pedidas else None
+    resultado["preparacion_seg"] = round(time.perf_counter() - inicio, 3)
+    resultado["vendedores"] = int(df["NOMBRE_VENDEDOR"].nunique())
+    resultado["visitas_bolsa"] = int(df["GOLPEO"].sum())
+
+    def correr(nombre, etapa):
+        if nombre not in pedidas:
+            return None
+        salida, tiempos = etapas.medir(etapa, args.repeticiones)
+        resultado["etapas"][nombre] = tiempos
+        print(f"  {n:>7} {nombre:<24} {tiempos['seg']:>9.3f} s", flush=True)
+        return salida
+
+    # Lectura del maestro (lo que entrega sirve a las etapas siguientes)
+    correr("lectura_xlsx", etapas.lectura(xlsx))
+    leido = correr("lectura_csv", etapas.lectura(csv))
+    if leido is None:
+        leido, _ = etapas.lectura(csv)()
+    correr("asignar_h3", etapas.h3(leido))
+
+    # Etapas del modo ASIGNADO, por vendedor
+    grupos = correr("tablas_vendedor", etapas.tablas_vendedor(leido))
+    if grupos is None:
+        grupos, _ = etapas.tablas_vendedor(leido)()
+    correr("particion_h3", etapas.particion(grupos))
+
+    rutas_h3 = correr("fusion_balanceo", etapas.fusion_balanceo(grupos))
+    if rutas_h3 is None and pedidas & {"secuenciacion", "evaluar_ruta"}:
+        rutas_h3, _ = etapas.fusion_balanceo(grupos)()
+    if rutas_h3 is not None:
+        resultado["calidad"]["H3"] = _calidad(grupos, rutas_h3)
+
+    rutas_cap = correr("clustering_capacitado", etapas.capacitado(grupos))
+    if rutas_cap is not None:
+        resultado["calidad"]["CAPACITADO"] = _calidad(grupos, rutas_cap)
+
+    ordenadas = correr("secuenciacion", etapas.secuenciacion(grupos, rutas_h3)) if rutas_h3 is not None else None
+    if ordenadas is None and "evaluar_ruta" in pedidas:
+        ordenadas, _ = etapas.secuenciacion(grupos, rutas_h3)()
+    if ordenadas is not None:
+        correr("evaluar_ruta", etapas.evaluacion(grupos, ordenadas))
+
+    # End-to-end (lectura + planificación completa)
+    plan = correr("end_to_end_asignado", etapas.end_to_end_asignado(csv))
+    if plan is not None:
+        resultado["calidad"]["end_to_end_asignado"] = _calidad_plan(plan)
+    plan_bolsa = correr("end_to_end_bolsa", etapas.end_to_end_bolsa(csv_bolsa))
+    if plan_bolsa is not None:
+        resultado["calidad"]["end_to_end_bolsa"] = _calidad_plan(plan_bolsa)
+
+    # Re-planificación incremental de un plan BOLSA con bajas
+    if "replanificar_bolsa" in pedidas:
+        replan = correr("replanificar_bolsa", etapas.replanificacion_bolsa(csv_bolsa, csv_bajas))
+        resultado["calidad"]["replanificar_bolsa"] = _calidad_plan(replan)
+
+    if "exportar_excel" in pedidas:
+        if plan is None:
+            plan, _ = etapas.end_to_end_asignado(csv)()
+        correr("exportar_excel", etapas.exportacion(plan))
+
+    # Pico de RSS del proceso hasta este tamaño (ru_maxrss en KB en Linux)
+    resultado["memoria_pico_proceso_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return resultado
+
+
+def _calidad(grupos, rutas_por_grupo):
+    rutas, fuera = 0, 0
+    for (_, _, _, rango), rutas_grupo in zip(grupos, rutas_por_grupo):
+        r = etapas.resumen_rango(rutas_grupo, rango)
+        rutas += r["rutas"]
+        fuera += r["fuera_de_rango"]
+    return {"rutas": rutas, "fuera_de_rango": fuera}
+
+
+def _calidad_plan(plan: dict):
+    rutas, fuera, repetidos = 0, 0, 0
+    for merc in plan["mercaderistas"]:
+        r = etapas.resumen_rango(merc["rutas"], merc["rango"])
+        rutas += r["rutas"]
+        fuera += r["fuera_de_rango"]
+        repetidos += r["repetidos"]
+    return {"rutas": rutas, "fuera_de_rango": fuera, "repetidos": repetidos}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks por etapa y end-to-end del motor de ruteo.")
+    parser.add_argument("--tamanos", type=int, nargs="+", default=list(TAMANOS_DEFAULT))
+    parser.add_argument("--etapas", nargs="+", choices=ETAPAS, default=list(ETAPAS))
+    parser.add_argument("--repeticiones", type=int, default=1)
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--directorio", default=None,
+                        help="Dónde dejar los maestros generados (por defecto un temporal)")
+    parser.add_argument("--salida", default="benchmark.json")
+    args = parser.parse_args()
+
+    salida = {"meta": _meta(args), "resultados": []}
+    with tempfile.TemporaryDirectory() as temporal:
+        directorio = args.directorio or temporal
+        os.makedirs(directorio, exist_ok=True)
+        for n in args.tamanos:
+            salida["resultados"].append(correr_tamano(n, args, directorio))
+            # Se reescribe tras cada tamaño: una corrida cortada deja lo medido
+            with open(args.salida, "w", encoding="utf-8") as f:
+                json.dump(salida, f, indent=2, ensure_ascii=False)
+    print(f"Resultados -> {os.path.abspath(args.salida)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import argparse
+import json
+
+
+def comparar(base: dict, nuevo: dict):
+    """
+    Filas (pdvs, etapa, seg base, seg nuevo, razón nuevo/base) de las
+    etapas medidas en ambas corridas.
+    """
+    por_tamano = {r["pdvs"]: r["etapas"] for r in base["resultados"]}
+    filas = []
+    for resultado in nuevo["resultados"]:
+        etapas_base = por_tamano.get(resultado["pdvs"], {})
+        for etapa, tiempos in resultado["etapas"].items():
+            if etapa in etapas_base:
+                antes, ahora = etapas_base[etapa]["seg"], tiempos["seg"]
+                filas.append((resultado["pdvs"], etapa, antes, ahora, ahora / antes if antes else None))
+    return filas
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara dos corridas de benchmarks (JSON).")
+    parser.add_argument("base")
+    parser.add_argument("nuevo")
+    args = parser.parse_args()
+
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.nuevo, encoding="utf-8") as f:
+        nuevo = json.load(f)
+
+    print(f"base: {base['meta'].get('commit')}  nuevo: {nuevo['meta'].get('commit')}")
+    print(f"{'pdvs':>7}  {'etapa':<24} {'base':>9} {'nuevo':>9} {'razón':>7}")
+    for pdvs, etapa, antes, ahora, razon in comparar(base, nuevo):
+        texto = f"{razon:>6.2f}x" if razon is not None else "      -"
+        print(f"{pdvs:>7}  {etapa:<24} {antes:>9.3f} {ahora:>9.3f} {texto}")
+
+
+if __name__ == "__main__":
+    main()
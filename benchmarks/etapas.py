@@ -0,0 +1,217 @@
+import copy
+import math
+import statistics
+import time
+from collections import Counter, defaultdict
+
+from fastapi import UploadFile
+
+from app.services.excel_reader import leer_maestro_pdv
+from app.services.h3_utils import asignar_h3
+from app.services.pdv_store import TablaPDV
+from app.services.clustering import particionar_h3
+from app.services.clustering_capacitado import clusterizar_capacitado
+from app.services.routes_merges import fusionar_rutas
+from app.services.route_optimizer import optimizar_orden_pdvs
+from app.services.metrics import evaluar_ruta
+from app.services.rutas_builder import construir_rutas
+from app.services.territory_planner import planificar_bolsa_grandes
+from app.services.replanificador import replanificar
+from app.services.exporter import generar_excel_final
+
+# Parámetros fijos de las corridas (comparables entre commits)
+FRECUENCIA = "SEMANAL"
+FLEX = 0.2
+CAPACIDAD_BOLSA = 60
+# Rutas más chicas: la re-planificación llega a eliminar rutas de un grupo
+CAPACIDAD_REPLANIFICACION = 40
+
+
+# =========================
+# MEDICIÓN
+# =========================
+def medir(etapa, repeticiones: int = 1):
+    """
+    Corre 'etapa' (retorna (resultado, segundos medidos)) varias veces.
+    Cada etapa cronometra solo su parte: la preparación queda afuera.
+    Retorna (último resultado, {"seg": mínimo, "mediana", "repeticiones"}).
+    """
+    tiempos = []
+    resultado = None
+    for _ in range(max(1, repeticiones)):
+        resultado, segundos = etapa()
+        tiempos.append(round(segundos, 4))
+    return resultado, {
+        "seg": min(tiempos),
+        "mediana": round(statistics.median(tiempos), 4),
+        "repeticiones": tiempos,
+    }
+
+
+def _cronometrar(funcion, *args, **kwargs):
+    inicio = time.perf_counter()
+    resultado = funcion(*args, **kwargs)
+    return resultado, time.perf_counter() - inicio
+
+
+def _rango_asignado(total_pdv: int):
+    # Mismo cálculo que _planificar_vendedor (frecuencia SEMANAL, sin sábado)
+    num_rutas = min(5, total_pdv)
+    promedio = total_pdv / num_rutas if num_rutas > 0 else 0
+    return num_rutas, {
+        "promedio": round(promedio, 2),
+        "min": max(1, math.floor(promedio * (1 - FLEX))),
+        "max": math.ceil(promedio * (1 + FLEX)),
+    }
+
+
+def resumen_rango(rutas, rango: dict):
+    """
+    Calidad del plan (para que un cambio más rápido no pase por uno peor).
+    """
+    tamanos = [len(r["pdvs"]) if "pdvs" in r else len(r["idx"]) for r in rutas]
+    # Visitas de un cliente repetidas en una ruta cuando tenía otras rutas
+    # libres (debe ser 0; con GOLPEO > rutas la repetición es inevitable)
+    visitas, rutas_cliente = Counter(), defaultdict(set)
+    for j, r in enumerate(rutas):
+        for p in r.get("pdvs", ()):
+            visitas[str(p["cod_live_tra"])] += 1
+            rutas_cliente[str(p["cod_live_tra"])].add(j)
+    repetidos = sum(min(v, len(rutas)) - len(rutas_cliente[c]) for c, v in visitas.items())
+    return {
+        "rutas": len(tamanos),
+        "fuera_de_rango": sum(not rango["min"] <= t <= rango["max"] for t in tamanos),
+        "repetidos": repetidos,
+    }
+
+
+# =========================
+# ETAPAS
+# =========================
+def lectura(ruta: str):
+    def etapa():
+        with open(ruta, "rb") as f:
+            return _cronometrar(leer_maestro_pdv, UploadFile(file=f, filename=ruta))
+    return etapa
+
+
+def h3(df):
+    return lambda: _cronometrar(asignar_h3, df.copy())
+
+
+def tablas_vendedor(df):
+    """
+    (vendedor, TablaPDV con h3, num_rutas, rango) por vendedor, igual que el
+    modo ASIGNADO; cronometra la construcción de las tablas.
+    """
+    def etapa():
+        inicio = time.perf_counter()
+        grupos = []
+        for vendedor, df_v in df.groupby("NOMBRE_VENDEDOR"):
+            num_rutas, rango = _rango_asignado(len(df_v))
+            grupos.append((vendedor, TablaPDV.desde_df(df_v).con_h3(resolution=9), num_rutas, rango))
+        return grupos, time.perf_counter() - inicio
+    return etapa
+
+
+def particion(grupos):
+    def etapa():
+        inicio = time.perf_counter()
+        particiones = [particionar_h3(tabla, rango) for _, tabla, _, rango in grupos]
+        return particiones, time.perf_counter() - inicio
+    return etapa
+
+
+def fusion_balanceo(grupos):
+    """
+    fusionar_rutas (fusión + balanceo + búsqueda local) sobre la partición
+    H3 de cada vendedor; la partición se rehace fuera del cronómetro.
+    """
+    def etapa():
+        segundos = 0.0
+        rutas = []
+        for _, tabla, num_rutas, rango in grupos:
+            particiones = particionar_h3(tabla, rango)
+            inicio = time.perf_counter()
+            rutas.append(fusionar_rutas(particiones, rango, num_rutas, tabla))
+            segundos += time.perf_counter() - inicio
+        return rutas, segundos
+    return etapa
+
+
+def capacitado(grupos):
+    def etapa():
+        inicio = time.perf_counter()
+        rutas = [clusterizar_capacitado(tabla, num_rutas, rango) for _, tabla, num_rutas, rango in grupos]
+        return rutas, time.perf_counter() - inicio
+    return etapa
+
+
+def secuenciacion(grupos, rutas_por_grupo):
+    """
+    optimizar_orden_pdvs sobre las rutas ya agrupadas (dicts de PDV como
+    los recibe la edición manual); la serialización queda afuera.
+    """
+    def etapa():
+        serializadas = [
+            [tabla.serializar_pdvs(r["idx"]) for r in rutas]
+            for (_, tabla, _, _), rutas in zip(grupos, rutas_por_grupo)
+        ]
+        inicio = time.perf_counter()
+        ordenadas = [[optimizar_orden_pdvs(pdvs) for pdvs in rutas] for rutas in serializadas]
+        return ordenadas, time.perf_counter() - inicio
+    return etapa
+
+
+def evaluacion(grupos, rutas_ordenadas):
+    def etapa():
+        inicio = time.perf_counter()
+        metricas = [
+            [evaluar_ruta({"pdvs": pdvs}, rango) for pdvs in rutas]
+            for (_, _, _, rango), rutas in zip(grupos, rutas_ordenadas)
+        ]
+        return metricas, time.perf_counter() - inicio
+    return etapa
+
+
+def end_to_end_asignado(ruta: str):
+    def etapa():
+        inicio = time.perf_counter()
+        with open(ruta, "rb") as f:
+            df = leer_maestro_pdv(UploadFile(file=f, filename=ruta))
+        resultado = construir_rutas(df, FRECUENCIA, False, FLEX)
+        return resultado, time.perf_counter() - inicio
+    return etapa
+
+
+def end_to_end_bolsa(ruta: str):
+    def etapa():
+        inicio = time.perf_counter()
+        with open(ruta, "rb") as f:
+            df = leer_maestro_pdv(UploadFile(file=f, filename=ruta))
+        resultado = planificar_bolsa_grandes(df, CAPACIDAD_BOLSA, FLEX)
+        return resultado, time.perf_counter() - inicio
+    return etapa
+
+
+def replanificacion_bolsa(ruta: str, ruta_bajas: str):
+    """
+    replanificar de un plan BOLSA (maestro de 'ruta') con el maestro de
+    'ruta_bajas'; el plan, la lectura y la copia quedan afuera.
+    """
+    with open(ruta, "rb") as f:
+        plan = planificar_bolsa_grandes(leer_maestro_pdv(UploadFile(file=f, filename=ruta)),
+                                        CAPACIDAD_REPLANIFICACION, FLEX)
+
+    def etapa():
+        with open(ruta_bajas, "rb") as f:
+            df = leer_maestro_pdv(UploadFile(file=f, filename=ruta_bajas))
+        data = copy.deepcopy(plan)
+        inicio = time.perf_counter()
+        replanificar(data, df)
+        return data, time.perf_counter() - inicio
+    return etapa
+
+
+def exportacion(resultado: dict):
+    return lambda: _cronometrar(generar_excel_final, resultado)
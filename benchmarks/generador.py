@@ -0,0 +1,156 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# =========================
+# CIUDADES (centro, dispersión en grados, peso en el maestro)
+# =========================
+# Urbano denso: varios núcleos comerciales por ciudad; el resto del
+# departamento es rural disperso alrededor
+CIUDADES = (
+    ("LIMA", (-12.06, -77.04), 0.09, 0.55),
+    ("AREQUIPA", (-16.40, -71.54), 0.05, 0.12),
+    ("LA LIBERTAD", (-8.11, -79.03), 0.05, 0.10),
+    ("PIURA", (-5.19, -80.63), 0.04, 0.08),
+    ("CUSCO", (-13.53, -71.97), 0.03, 0.06),
+    ("JUNIN", (-12.07, -75.21), 0.03, 0.05),
+    ("ANCASH", (-9.53, -77.53), 0.03, 0.04),
+)
+
+SUBCANALES = ("BODEGA", "MINIMARKET", "FARMACIA", "PUESTO MERCADO", "LICORERIA", "RESTAURANTE")
+PESOS_SUBCANAL = (0.50, 0.15, 0.10, 0.12, 0.06, 0.07)
+
+# GOLPEO: la mayoría una visita por ciclo; cuentas clave hasta 4
+GOLPEOS = (1, 2, 3, 4)
+PESOS_GOLPEO = (0.62, 0.24, 0.10, 0.04)
+
+# PDVs por vendedor en el maestro (rango realista para modo ASIGNADO)
+PDVS_POR_VENDEDOR = 400
+
+
+def generar_maestro(n: int, semilla: int = 0, vendedores: int = None, frac_rural: float = 0.15,
+                    frac_mismo_punto: float = 0.03, con_vendedor: bool = True) -> pd.DataFrame:
+    """
+    Maestro sintético de 'n' PDVs, reproducible por 'semilla':
+    - urbano denso: núcleos comerciales (mercados, avenidas) dentro de cada
+      ciudad, de tamaño y dispersión variables;
+    - rural disperso ('frac_rural'): puntos sueltos a decenas de km;
+    - 'frac_mismo_punto': PDVs en las mismas coordenadas que otro (galerías,
+      puestos de mercado);
+    - GOLPEO, SUBCANAL y DISTRITO con distribuciones fijas;
+    - vendedores ('vendedores', por defecto ~PDVS_POR_VENDEDOR PDVs cada uno)
+      con cartera espacialmente contigua dentro de su departamento.
+    con_vendedor=False omite NOMBRE_VENDEDOR: el lector agrupa por
+    DEPARTAMENTO (territorios del modo BOLSA).
+    """
+    rng = np.random.default_rng(semilla)
+    nombres = np.array([c[0] for c in CIUDADES])
+    centros = np.array([c[1] for c in CIUDADES])
+    dispersion = np.array([c[2] for c in CIUDADES])
+    pesos = np.array([c[3] for c in CIUDADES])
+
+    ciudad = rng.choice(len(CIUDADES), size=n, p=pesos / pesos.sum())
+    lat = np.empty(n)
+    lon = np.empty(n)
+
+    # Urbano: cada ciudad con ~1 núcleo cada 300 PDVs, tamaños desparejos
+    rural = rng.random(n) < frac_rural
+    for c in range(len(CIUDADES)):
+        filas = np.flatnonzero((ciudad == c) & ~rural)
+        if not len(filas):
+            continue
+        n_nucleos = max(1, len(filas) // 300)
+        nucleos = centros[c] + rng.normal(0, dispersion[c], (n_nucleos, 2))
+        radio = rng.uniform(0.004, 0.015, n_nucleos)
+        nucleo = rng.choice(n_nucleos, size=len(filas), p=rng.dirichlet(np.ones(n_nucleos)))
+        puntos = nucleos[nucleo] + rng.normal(0, 1, (len(filas), 2)) * radio[nucleo, None]
+        lat[filas], lon[filas] = puntos[:, 0], puntos[:, 1]
+
+    # Rural: alrededor de la ciudad, a 10-80 km
+    filas = np.flatnonzero(rural)
+    angulo = rng.uniform(0, 2 * np.pi, len(filas))
+    distancia = rng.uniform(0.1, 0.7, len(filas))
+    lat[filas] = centros[ciudad[filas], 0] + distancia * np.sin(angulo)
+    lon[filas] = centros[ciudad[filas], 1] + distancia * np.cos(angulo)
+
+    # Mismo punto: copian las coordenadas de otro PDV de su ciudad
+    copias = np.flatnonzero(rng.random(n) < frac_mismo_punto)
+    if len(copias):
+        origen = rng.integers(0, n, len(copias))
+        origen = np.where(ciudad[origen] == ciudad[copias], origen, copias)
+        lat[copias], lon[copias] = lat[origen], lon[origen]
+
+    df = pd.DataFrame({
+        "COD_LIVE_TRA": rng.permutation(n) + 100000,
+        "RAZON_SOCIAL": [f"NEGOCIO {i}" for i in range(n)],
+        "LATITUD": np.round(lat, 6),
+        "LONGITUD": np.round(lon, 6),
+        "DEPARTAMENTO": nombres[ciudad],
+        "DISTRITO": [f"{d} {z}" for d, z in zip(nombres[ciudad], rng.integers(1, 15, n))],
+        "SUBCANAL": rng.choice(SUBCANALES, size=n, p=PESOS_SUBCANAL),
+        "GOLPEO": rng.choice(GOLPEOS, size=n, p=PESOS_GOLPEO),
+    })
+
+    if con_vendedor:
+        df["NOMBRE_VENDEDOR"] = _vendedores(df, vendedores or max(1, round(n / PDVS_POR_VENDEDOR)))
+    return df
+
+
+def _vendedores(df: pd.DataFrame, vendedores: int):
+    """
+    Reparte vendedores por departamento (según su tamaño) y dentro de cada
+    uno corta por franjas de longitud: carteras contiguas como en la práctica.
+    """
+    asignado = np.empty(len(df), dtype=object)
+    conteo = df["DEPARTAMENTO"].value_counts()
+    cupos = np.maximum(1, np.round(conteo.to_numpy() / len(df) * vendedores)).astype(int)
+    siguiente = 1
+    for depto, cupo in zip(conteo.index, cupos):
+        filas = np.flatnonzero(df["DEPARTAMENTO"].to_numpy() == depto)
+        filas = filas[np.argsort(df["LONGITUD"].to_numpy()[filas], kind="stable")]
+        for parte in np.array_split(filas, min(cupo, len(filas))):
+            asignado[parte] = f"VENDEDOR {siguiente:04d}"
+            siguiente += 1
+    return asignado
+
+
+def escribir_maestro(df: pd.DataFrame, ruta: str) -> str:
+    """
+    Escribe el maestro según la extensión: .xlsx, .csv, .csv.gz o .parquet.
+    """
+    if ruta.endswith(".xlsx"):
+        # xlsxwriter: bastante más rápido que openpyxl para archivos grandes
+        with pd.ExcelWriter(ruta, engine="xlsxwriter") as writer:
+            df.to_excel(writer, index=False)
+    elif ruta.endswith(".csv") or ruta.endswith(".csv.gz"):
+        df.to_csv(ruta, index=False)
+    elif ruta.endswith(".parquet"):
+        df.to_parquet(ruta, index=False)
+    else:
+        raise ValueError(f"Extensión no soportada: {ruta} (use .xlsx, .csv, .csv.gz o .parquet)")
+    return ruta
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera un maestro de PDVs sintético.")
+    parser.add_argument("--pdvs", type=int, default=10000)
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--vendedores", type=int, default=None)
+    parser.add_argument("--frac-rural", type=float, default=0.15)
+    parser.add_argument("--sin-vendedor", action="store_true",
+                        help="Sin NOMBRE_VENDEDOR: territorios por DEPARTAMENTO (modo BOLSA)")
+    parser.add_argument("--salida", default="maestro.xlsx")
+    args = parser.parse_args()
+
+    df = generar_maestro(
+        args.pdvs, semilla=args.semilla, vendedores=args.vendedores,
+        frac_rural=args.frac_rural, con_vendedor=not args.sin_vendedor
+    )
+    escribir_maestro(df, args.salida)
+    print(f"{len(df)} PDVs -> {os.path.abspath(args.salida)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,13 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.routes import router
+from app.config.settings import TELEMETRIA_ACTIVA
+from app.core.telemetria import middleware_http
+from app.core.respuestas import RespuestaJSON
 
 
-app = FastAPI(title="Motor de Ruteo Inteligente")
+# orjson por defecto; /planificar y /planes/{id} además comprimen (ver respuestas.py)
+app = FastAPI(title="Motor de Ruteo Inteligente", default_response_class=RespuestaJSON)
 
 # CORS (habilitado para pruebas)
 app.add_middleware(
@@ -14,6 +18,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Latencia y conteo por endpoint para /metrics
+if TELEMETRIA_ACTIVA:
+    app.middleware("http")(middleware_http)
+
 @app.get("/")
 def health():
     return {"status": "ok"}